@@ -4,15 +4,20 @@ import * as cdk from 'aws-cdk-lib';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
 import * as iam from "aws-cdk-lib/aws-iam"
 import * as path from 'path';
-import * as sfn from 'aws-cdk-lib/aws-stepfunctions';
-import * as tasks from 'aws-cdk-lib/aws-stepfunctions-tasks';
+import * as sqs from 'aws-cdk-lib/aws-sqs';
+import { SqsEventSource } from 'aws-cdk-lib/aws-lambda-event-sources';
 import * as events from 'aws-cdk-lib/aws-events';
 import * as targets from 'aws-cdk-lib/aws-events-targets';
 
 export interface EbsThroughputTunerAddOnProps {
+  // Seconds after launch before the data volume returns to baseline, at most 900
   duration: number;
   throughput: number;
   iops: number;
+  dataDeviceName?: string;
+  dataVolumeTagKey?: string;
+  // Seconds to collect launch events into one invocation
+  batchWindow?: number;
 }
 
 export class EbsThroughputTunerAddOn implements ClusterAddOn {
@@ -26,7 +31,11 @@ export class EbsThroughputTunerAddOn implements ClusterAddOn {
   deploy(clusterInfo: ClusterInfo): Promise<Construct> {
     const cluster = clusterInfo.cluster;
 
-    const lambdaTimeout: number = 300
+    const lambdaTimeout: number = 60
+
+    if (this.options.duration > 900) {
+      throw new Error('EBS throughput tuner duration must be at most 900 seconds');
+    }
 
     //EBS Throughput Modify lambda function
     const lambdaFunction = new lambda.Function(cluster.stack, 'EbsThroughputTunerLambda', {
@@ -38,7 +47,9 @@ export class EbsThroughputTunerAddOn implements ClusterAddOn {
         "TARGET_EC2_TAG_KEY": "stack",
         "TARGET_EC2_TAG_VALUE": cdk.Aws.STACK_NAME,
         "THROUGHPUT_VALUE": this.options.throughput.toString(),
-        "IOPS_VALUE": this.options.iops.toString()
+        "IOPS_VALUE": this.options.iops.toString(),
+        "DATA_DEVICE_NAME": this.options.dataDeviceName ?? "/dev/xvdb",
+        "DATA_VOLUME_TAG_KEY": this.options.dataVolumeTagKey ?? ""
       },
     });
 
@@ -47,28 +58,18 @@ export class EbsThroughputTunerAddOn implements ClusterAddOn {
         'AmazonEC2FullAccess',
       ))
 
-    // Step Functions definition
-    const waitTask = new sfn.Wait(cluster.stack, 'Wait time', {
-      time: sfn.WaitTime.duration(cdk.Duration.seconds(this.options.duration)),
-    });
-
-    const triggerTask = new tasks.LambdaInvoke(cluster.stack, 'Change throughput', {
-      lambdaFunction: lambdaFunction
-    }).addRetry({
-      backoffRate: 2,
-      maxAttempts: 3,
-      interval: cdk.Duration.seconds(5)
-    })
-
-    const stateDefinition = waitTask
-      .next(triggerTask)
-
-    const stateMachine = new sfn.StateMachine(cluster.stack, 'EbsThroughputTunerStateMachine', {
-      definitionBody: sfn.DefinitionBody.fromChainable(stateDefinition),
-      timeout: cdk.Duration.seconds(this.options.duration + lambdaTimeout + 30),
+    // Launch events wait out the warm-up as delayed messages, then are handled in batches
+    const launchQueue = new sqs.Queue(cluster.stack, 'EbsThroughputTunerQueue', {
+      deliveryDelay: cdk.Duration.seconds(this.options.duration),
+      visibilityTimeout: cdk.Duration.seconds(lambdaTimeout * 6),
+      retentionPeriod: cdk.Duration.hours(1),
     });
 
-    lambdaFunction.grantInvoke(stateMachine)
+    lambdaFunction.addEventSource(new SqsEventSource(launchQueue, {
+      batchSize: 100,
+      maxBatchingWindow: cdk.Duration.seconds(this.options.batchWindow ?? 20),
+      reportBatchItemFailures: true,
+    }));
 
     const rule = new events.Rule(cluster.stack, 'EbsThroughputTunerRule', {
       eventPattern: {
@@ -80,7 +81,7 @@ export class EbsThroughputTunerAddOn implements ClusterAddOn {
       }
     });
 
-    rule.addTarget(new targets.SfnStateMachine(stateMachine))
+    rule.addTarget(new targets.SqsQueue(launchQueue))
 
     return Promise.resolve(rule);
   }
@@ -3,7 +3,9 @@ import { Construct } from "constructs";
 import * as cdk from 'aws-cdk-lib';
 import * as sns from 'aws-cdk-lib/aws-sns';
 import * as s3 from 'aws-cdk-lib/aws-s3';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
 import * as lambda from 'aws-cdk-lib/aws-lambda';
+import * as iam from 'aws-cdk-lib/aws-iam';
 import * as apigw from "aws-cdk-lib/aws-apigateway";
 import * as xray from "aws-cdk-lib/aws-xray"
 import * as path from 'path';
@@ -12,6 +14,7 @@ export interface SharedComponentAddOnProps {
   inputSns: sns.ITopic;
   outputSns: sns.ITopic;
   outputBucket: s3.IBucket;
+  statusTable?: dynamodb.ITable;
   apiGWProps?: {
     stageName?: string,
     throttle?: {
@@ -62,14 +65,26 @@ export class SharedComponentAddOn implements ClusterAddOn {
       runtime: lambda.Runtime.PYTHON_3_13,
       environment: {
         "SNS_TOPIC_ARN": this.options.inputSns.topicArn,
-        "S3_OUTPUT_BUCKET": this.options.outputBucket.bucketName
+        "S3_OUTPUT_BUCKET": this.options.outputBucket.bucketName,
+        "STATUS_TABLE_NAME": this.options.statusTable?.tableName ?? ""
       },
       tracing: lambda.Tracing.ACTIVE,
-      reservedConcurrentExecutions: 100
+      reservedConcurrentExecutions: 100,
+      // Batch requests publish up to 100 tasks
+      timeout: cdk.Duration.seconds(29)
     });
 
     this.options.inputSns.grantPublish(v1Alpha1Parser);
     this.options.inputSns.grantPublish(v1Alpha2Parser);
+    // Large task content is stored under claim-check/ and read back by the queue agents
+    this.options.outputBucket.grantPut(v1Alpha2Parser, 'claim-check/*');
+    // Tasks are recorded as queued on submission and looked up by GET /v1alpha2/{id}
+    this.options.statusTable?.grantReadWriteData(v1Alpha2Parser);
+    // Admission control reads the completion rate of each runtime queue, GetMetricData has no resource-level permissions
+    v1Alpha2Parser.addToRolePolicy(new iam.PolicyStatement({
+      actions: ['cloudwatch:GetMetricData'],
+      resources: ['*'],
+    }));
 
     const api = new apigw.RestApi(cluster.stack, 'FrontAPI', {
       restApiName: 'FrontAPI',
@@ -99,6 +114,7 @@ export class SharedComponentAddOn implements ClusterAddOn {
 
     const v1alpha2Resource = api.root.addResource('v1alpha2');
     v1alpha2Resource.addMethod('POST', new apigw.LambdaIntegration(v1Alpha2Parser), { apiKeyRequired: true });
+    v1alpha2Resource.addResource('{id}').addMethod('GET', new apigw.LambdaIntegration(v1Alpha2Parser), { apiKeyRequired: true });
 
     api.node.addDependency(v1Alpha1Parser);
     api.node.addDependency(v1Alpha2Parser);
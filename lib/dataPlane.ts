@@ -6,10 +6,12 @@ import * as eksv2 from "@aws-cdk/aws-eks-v2-alpha";
 import * as sns from 'aws-cdk-lib/aws-sns';
 import * as ec2 from 'aws-cdk-lib/aws-ec2';
 import * as s3 from 'aws-cdk-lib/aws-s3';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
 import SDRuntimeAddon, { SDRuntimeAddOnProps } from './runtime/sdRuntime';
 import { EbsThroughputTunerAddOn, EbsThroughputTunerAddOnProps } from './addons/ebsThroughputTuner'
 import { SharedComponentAddOn, SharedComponentAddOnProps } from './addons/sharedComponent';
 import { SNSResourceProvider } from './resourceProvider/sns'
+import { TaskStatusTableProvider } from './resourceProvider/dynamodb'
 import { s3GWEndpointProvider } from './resourceProvider/s3GWEndpoint'
 import { SingleNatVpcProvider } from './resourceProvider/vpc'
 import { KarpenterAddOn } from './addons/karpenter';
@@ -35,6 +37,7 @@ export interface dataPlaneProps {
     type: string,
     modelFilename?: string,
     dynamicModel?: boolean,
+    maxQueueWaitSeconds?: number,
     chartRepository?: string,
     chartVersion?: string,
     extraValues?: Record<string, unknown>
@@ -85,6 +88,7 @@ export default class DataPlaneStack {
       inputSns: blueprints.getNamedResource("inputSNSTopic"),
       outputSns: blueprints.getNamedResource("outputSNSTopic"),
       outputBucket: blueprints.getNamedResource("outputS3Bucket"),
+      statusTable: blueprints.getNamedResource("taskStatusTable"),
       apiGWProps: dataplaneProps.APIGW
     };
 
@@ -120,11 +124,13 @@ export default class DataPlaneStack {
         outputSns: blueprints.getNamedResource("outputSNSTopic") as sns.ITopic,
         inputSns: blueprints.getNamedResource("inputSNSTopic") as sns.ITopic,
         outputBucket: blueprints.getNamedResource("outputS3Bucket") as s3.IBucket,
+        statusTable: blueprints.getNamedResource("taskStatusTable") as dynamodb.ITable,
         type: val.type.toLowerCase(),
         chartRepository: val.chartRepository,
         chartVersion: val.chartVersion,
         extraValues: val.extraValues,
         targetNamespace: val.namespace,
+        maxQueueWaitSeconds: val.maxQueueWaitSeconds,
       };
 
       if (val.type.toLowerCase() === "sdwebui") {
@@ -176,8 +182,17 @@ export default class DataPlaneStack {
       .resourceProvider("inputSNSTopic", new SNSResourceProvider("sdNotificationLambda"))
       .resourceProvider("outputSNSTopic", new SNSResourceProvider("sdNotificationOutput"))
       .resourceProvider("outputS3Bucket", new blueprints.CreateS3BucketProvider({
-        id: 'outputS3Bucket'
+        id: 'outputS3Bucket',
+        s3BucketProps: {
+          // Claim-checked task content, kept longer than the input queues retain messages (4 days)
+          lifecycleRules: [{
+            id: 'ExpireClaimChecks',
+            prefix: 'claim-check/',
+            expiration: cdk.Duration.days(7)
+          }]
+        }
       }))
+      .resourceProvider("taskStatusTable", new TaskStatusTableProvider("taskStatusTable"))
       .resourceProvider("s3GWEndpoint", new s3GWEndpointProvider("s3GWEndpoint"))
       .clusterProvider(clusterProvider)
       .build(scope, id + 'Stack', props);
@@ -0,0 +1,24 @@
+import * as cdk from 'aws-cdk-lib';
+import * as blueprints from '@aws-quickstart/eks-blueprints';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
+
+export class TaskStatusTableProvider implements blueprints.ResourceProvider<dynamodb.ITable> {
+  constructor(readonly tableName: string) { }
+
+  provide(context: blueprints.ResourceContext): dynamodb.ITable {
+
+    // One item per task ID, expired by DynamoDB TTL
+    const table = new dynamodb.Table(context.scope, this.tableName, {
+      partitionKey: { name: 'id', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expires_at',
+      removalPolicy: cdk.RemovalPolicy.DESTROY
+    });
+
+    new cdk.CfnOutput(context.scope, this.tableName + 'Name', {
+      value: table.tableName
+    })
+
+    return table
+  }
+}
@@ -5,6 +5,8 @@ import * as blueprints from '@aws-quickstart/eks-blueprints';
 import * as iam from 'aws-cdk-lib/aws-iam';
 import * as sqs from 'aws-cdk-lib/aws-sqs';
 import * as s3 from 'aws-cdk-lib/aws-s3';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
+import * as lambda from 'aws-cdk-lib/aws-lambda';
 import { aws_sns_subscriptions } from "aws-cdk-lib";
 import { createNamespace }  from "../utils/namespace"
 
@@ -15,8 +17,10 @@ export interface SDRuntimeAddOnProps extends blueprints.addons.HelmAddOnUserProp
   outputSns?: sns.ITopic,
   inputSns?: sns.ITopic,
   outputBucket?: s3.IBucket
+  statusTable?: dynamodb.ITable,
   sdModelCheckpoint?: string,
   dynamicModel?: boolean,
+  maxQueueWaitSeconds?: number,
   chartRepository?: string,
   chartVersion?: string,
   extraValues?: object
@@ -85,13 +89,45 @@ export default class SDRuntimeAddon extends blueprints.addons.HelmAddOn {
 
     this.options.outputBucket!.grantWrite(runtimeSA);
     this.options.outputBucket!.grantPutAcl(runtimeSA);
+    this.options.outputBucket!.grantRead(runtimeSA, 'claim-check/*');
+    // Presigned result URLs are only as good as the signer's own read access
+    if ((this.options.extraValues as Record<string, any>)?.runtime?.queueAgent?.presignedUrlExpiry > 0) {
+      this.options.outputBucket!.grantRead(runtimeSA);
+    }
+    // Workflow templates may live in any bucket, not only the model and output buckets
+    const workflowTemplatePath: string = (this.options.extraValues as Record<string, any>)?.runtime?.queueAgent?.workflowTemplatePath || "";
+    if (workflowTemplatePath.startsWith("s3://")) {
+      const [templateBucketName, ...templatePrefix] = workflowTemplatePath.slice("s3://".length).split("/");
+      const templateKeys = templatePrefix.filter(part => part).map(part => part + "/").join("") + "*";
+      s3.Bucket.fromBucketName(cluster.stack, 'WorkflowTemplateBucket' + this.id, templateBucketName)
+        .grantRead(runtimeSA, templateKeys);
+    }
     this.options.outputSns!.grantPublish(runtimeSA);
+    this.options.statusTable?.grantWriteData(runtimeSA);
+
+    // Admission control in the v1alpha2 input function estimates the wait from this queue
+    const v1Alpha2Parser = cluster.stack.node.tryFindChild('v1Alpha2ParserFunction') as lambda.Function | undefined;
+    if (v1Alpha2Parser) {
+      const envKey = this.id.replace(/[^a-zA-Z0-9]/g, '_').toUpperCase();
+      v1Alpha2Parser.addEnvironment('RUNTIME_QUEUE_' + envKey, inputQueue.queueUrl);
+      if (this.options.maxQueueWaitSeconds) {
+        v1Alpha2Parser.addEnvironment('RUNTIME_MAX_WAIT_' + envKey, this.options.maxQueueWaitSeconds.toString());
+      }
+      inputQueue.grant(v1Alpha2Parser, 'sqs:GetQueueAttributes');
+    }
 
     runtimeSA.role.addManagedPolicy(
       iam.ManagedPolicy.fromAwsManagedPolicyName(
         'AWSXRayDaemonWriteAccess',
       ))
 
+    // Backlog in GPU-seconds, published by the queue agents for the KEDA CloudWatch trigger
+    runtimeSA.addToPrincipalPolicy(new iam.PolicyStatement({
+      actions: ['cloudwatch:PutMetricData'],
+      resources: ['*'],
+      conditions: { StringEquals: { 'cloudwatch:namespace': 'SDonEKS' } },
+    }));
+
     const nodeRole = clusterInfo.cluster.node.findChild(`${cdk.Stack.of(cluster).stackName}-karpenter-node-role`) as iam.IRole
 
     // Resolve image repository: use extraValues override or default per runtime type
@@ -115,6 +151,7 @@ export default class SDRuntimeAddon extends blueprints.addons.HelmAddOn {
           s3Bucket: this.options.outputBucket!.bucketName,
           snsTopicArn: this.options.outputSns!.topicArn,
           sqsQueueUrl: inputQueue.queueUrl,
+          statusTableName: this.options.statusTable?.tableName ?? "",
         },
         persistence: {
           enabled: true,
@@ -1,18 +1,23 @@
+import copy
 import csv
 import datetime
+import io
 import json
 import logging
+import math
 import random
 import os
+import time
+import uuid
+from collections import defaultdict, deque
 
 import boto3
 import gevent
 from botocore.exceptions import ClientError
-from dateutil import parser
-from flask import send_file
+from flask import Response
 from locust import HttpUser, events, run_single_user, task
-from locust.runners import LocalRunner, MasterRunner
-from locust.user.wait_time import between
+from locust.runners import LocalRunner, MasterRunner, WorkerRunner
+from locust.user.wait_time import constant
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(process)s - %(levelname)s - %(message)s')
 
@@ -23,6 +28,28 @@ API_ENDPOINT=os.getenv("API_ENDPOINT")
 API_KEY=os.getenv("API_KEY")
 OUTPUT_SQS_NAME=os.getenv("OUTPUT_SQS_NAME")
 
+# Open-loop arrival profile, rates are requests per second per simulated user:
+#   constant - fixed interval of 1/ARRIVAL_RATE
+#   ramp     - rate rises linearly from RAMP_START_RATE to ARRIVAL_RATE over RAMP_SECONDS, then holds
+#   poisson  - exponential inter-arrival times; with BURST_FACTOR > 1 the rate is multiplied by
+#              BURST_FACTOR for BURST_SECONDS out of every BURST_PERIOD_SECONDS
+ARRIVAL_PROFILE=os.getenv("ARRIVAL_PROFILE", "poisson").lower()
+ARRIVAL_RATE=float(os.getenv("ARRIVAL_RATE", "1.0"))
+RAMP_START_RATE=float(os.getenv("RAMP_START_RATE", "0.1"))
+RAMP_SECONDS=float(os.getenv("RAMP_SECONDS", "300"))
+BURST_FACTOR=float(os.getenv("BURST_FACTOR", "1.0"))
+BURST_SECONDS=float(os.getenv("BURST_SECONDS", "30"))
+BURST_PERIOD_SECONDS=float(os.getenv("BURST_PERIOD_SECONDS", "300"))
+
+# Optional task mix, e.g. "../test/v1alpha2/t2i.json:3,../test/v1alpha2/i2i.json:1"
+TASK_FILES=os.getenv("TASK_FILES", "")
+RUNTIME=os.getenv("RUNTIME", "")
+# Only notifications carrying this run ID are counted
+RUN_ID=os.getenv("RUN_ID", "locust")
+# How often workers push their latency histograms to the master
+REPORT_INTERVAL_SECONDS=float(os.getenv("REPORT_INTERVAL_SECONDS", "5"))
+MAX_FAILED_RECORDS=1000
+
 TEMPLATE=json.loads("""{
   "task": {
     "metadata": {
@@ -43,56 +70,201 @@ TEMPLATE=json.loads("""{
 }""")
 
 
+def load_templates():
+    """Return a list of (template, weight) built from TASK_FILES or the default text-to-image task"""
+    if not TASK_FILES:
+        return [(TEMPLATE, 1.0)]
+    templates = []
+    for item in TASK_FILES.split(","):
+        path, _, weight = item.partition(":")
+        with open(path.strip()) as f:
+            templates.append((json.load(f), float(weight or 1)))
+    return templates
+
+
+TEMPLATES = load_templates()
+
+
+class LatencyHistogram(object):
+    """Streaming log-bucketed histogram, percentiles are accurate to about 1%.
+
+    Memory is bounded by the number of buckets, not the number of samples, and
+    histograms from several workers can be merged bucket by bucket.
+    """
+
+    PRECISION = 0.01
+
+    def __init__(self):
+        self.buckets = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value_ms: float):
+        value_ms = max(value_ms, 1.0)
+        self.buckets[int(math.log(value_ms) / math.log1p(self.PRECISION))] += 1
+        self.count += 1
+        self.total += value_ms
+        self.min = value_ms if self.min is None else min(self.min, value_ms)
+        self.max = value_ms if self.max is None else max(self.max, value_ms)
+
+    def percentile(self, p: float) -> float:
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(math.exp((index + 0.5) * math.log1p(self.PRECISION)), self.max)
+        return self.max
+
+    def merge(self, data: dict):
+        for index, count in data["buckets"].items():
+            self.buckets[int(index)] += count
+        self.count += data["count"]
+        self.total += data["total"]
+        if data["min"] is not None:
+            self.min = data["min"] if self.min is None else min(self.min, data["min"])
+            self.max = data["max"] if self.max is None else max(self.max, data["max"])
+
+    def to_dict(self) -> dict:
+        return {"buckets": dict(self.buckets), "count": self.count, "total": self.total,
+                "min": self.min, "max": self.max}
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 1) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 1),
+            "p90_ms": round(self.percentile(90), 1),
+            "p99_ms": round(self.percentile(99), 1),
+            "max_ms": round(self.max or 0.0, 1),
+        }
+
+
+class Stats(object):
+    """Counters and histograms keyed by (tasktype, runtime)"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.submitted = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.completed = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.latency = defaultdict(LatencyHistogram)
+        self.failed_tasks = deque(maxlen=MAX_FAILED_RECORDS)
+
+    def merge(self, data: dict):
+        for name in ("submitted", "rejected", "completed", "failed"):
+            counter = getattr(self, name)
+            for key, value in data[name].items():
+                counter[key] += value
+        for key, hist in data["latency"].items():
+            self.latency[key].merge(hist)
+        self.failed_tasks.extend(data["failed_tasks"])
+
+    def to_dict(self) -> dict:
+        return {
+            "submitted": dict(self.submitted),
+            "rejected": dict(self.rejected),
+            "completed": dict(self.completed),
+            "failed": dict(self.failed),
+            "latency": {key: hist.to_dict() for key, hist in self.latency.items()},
+            "failed_tasks": list(self.failed_tasks),
+        }
+
+    def report(self) -> dict:
+        keys = set(self.submitted) | set(self.completed) | set(self.failed) | set(self.rejected)
+        total = LatencyHistogram()
+        breakdown = {}
+        for key in sorted(keys):
+            hist = self.latency[key]
+            total.merge(hist.to_dict())
+            done = self.completed[key] + self.failed[key]
+            breakdown[key] = {
+                "submitted": self.submitted[key],
+                "rejected": self.rejected[key],
+                "completed": self.completed[key],
+                "failed": self.failed[key],
+                "failure_rate": self.failed[key] / done if done else 0.0,
+                "latency": hist.summary(),
+            }
+        completed = sum(self.completed.values())
+        failed = sum(self.failed.values())
+        return {
+            "task_count": sum(self.submitted.values()),
+            "rejected_count": sum(self.rejected.values()),
+            "completed_count": completed,
+            "failed_count": failed,
+            "failure_rate": failed / (completed + failed) if completed + failed else 0.0,
+            "latency": total.summary(),
+            "by_task": breakdown,
+        }
+
 
-stats = {}
+def stats_key(tasktype: str, runtime: str) -> str:
+    return f"{tasktype}/{runtime}"
+
+
+# Stats collected locally since the last report to the master
+local_stats = Stats()
+# Combined stats, only meaningful on the master or a local runner
+combined_stats = Stats()
+test_started_at = time.time()
 
 sqs = boto3.resource('sqs')
 
 @events.init.add_listener
 def locust_init(environment, **kwargs):
-    global stats
-    stats = {}
+    runner = environment.runner
+
+    if isinstance(runner, MasterRunner):
+        runner.register_message("latency_stats", lambda msg, **kw: combined_stats.merge(msg.data))
 
-    if isinstance(environment.runner, MasterRunner) or isinstance(environment.runner, LocalRunner):
+    if isinstance(runner, WorkerRunner) or isinstance(runner, LocalRunner):
         gevent.spawn(checker, environment)
+        gevent.spawn(reporter, environment)
 
     if environment.web_ui:
         @environment.web_ui.app.route("/result")
         def get_result():
-            task_count = len(stats)
-            completed_count = sum((i["complete"] == True) for i in stats.values())
-            failed_count = sum((i["error"] == True) for i in stats.values())
-            failure_rate = failed_count / task_count
-            avg_time_usage = sum(i["time_usage"] for i in stats.values()) / task_count
-            response = {
-                "task_count": task_count,
-                "completed_count": completed_count,
-                "failed_count": failed_count,
-                "failure_rate": failure_rate,
-                "avg_time_usage": avg_time_usage
-            }
-            return json.dumps(response)
+            return json.dumps(combined_stats.report())
 
         @environment.web_ui.app.route("/dump_failed")
         def dump_failed():
-            failed = dict(filter(lambda x: x[1]["error"], stats.items()))
-            return json.dumps(failed)
+            return json.dumps(list(combined_stats.failed_tasks))
 
         @environment.web_ui.app.route("/dump_all")
         def dump_all():
-            data_file = open('/tmp/result.csv', 'w')
-            csv_writer = csv.writer(data_file)
-            count = 0
-            for item in stats.values():
-                if count == 0:
-                    header = item.keys()
-                    csv_writer.writerow(header)
-                    count += 1
-                item["start_time"] = int(item["start_time"])
-                item["complete_time"] = int(item["complete_time"])
-                csv_writer.writerow(item.values())
-            data_file.close()
-            return send_file('/tmp/result.csv', as_attachment=True)
+            output = io.StringIO()
+            csv_writer = csv.writer(output)
+            csv_writer.writerow(["task", "submitted", "rejected", "completed", "failed", "failure_rate",
+                                 "avg_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"])
+            for key, item in combined_stats.report()["by_task"].items():
+                latency = item["latency"]
+                csv_writer.writerow([key, item["submitted"], item["rejected"], item["completed"], item["failed"],
+                                     item["failure_rate"], latency["avg_ms"], latency["p50_ms"],
+                                     latency["p90_ms"], latency["p99_ms"], latency["max_ms"]])
+            return Response(output.getvalue(), mimetype="text/csv",
+                            headers={"Content-Disposition": "attachment; filename=result.csv"})
+
+def flush_local_stats(environment):
+    """Hand the stats collected since the last flush to the master, or merge them directly when running locally"""
+    global local_stats
+    data, local_stats = local_stats.to_dict(), Stats()
+    if isinstance(environment.runner, WorkerRunner):
+        environment.runner.send_message("latency_stats", data)
+    else:
+        combined_stats.merge(data)
+
+def reporter(environment):
+    while True:
+        gevent.sleep(REPORT_INTERVAL_SECONDS)
+        flush_local_stats(environment)
 
 def receive_messages(queue, max_number, wait_time):
     try:
@@ -104,6 +276,7 @@ def receive_messages(queue, max_number, wait_time):
         )
     except Exception as error:
         logger.error(f"Error receiving messages: {error}")
+        return []
     else:
         return messages
 
@@ -114,74 +287,118 @@ def delete_message(message):
         raise error
 
 def checker(environment):
-    global stats
+    """Consume completion notifications and record end-to-end latency.
+
+    The submit time travels in the task context, so any worker's checker can
+    account for a task submitted by another worker.
+    """
     logger.info(f'Checker launched')
     queue = sqs.get_queue_by_name(QueueName=OUTPUT_SQS_NAME)
-    # while not environment.runner.state in [STATE_STOPPED]:
     while True:
         received_messages = receive_messages(queue, 10, 20)
         if len(received_messages) == 0:
             logger.debug('No message received')
-        else:
-            for message in received_messages:
-                payload = json.loads(message.body)
-                msg = json.loads(payload['Message'])
-                succeed = msg['result']
-                task_id = msg['id']
-                logger.debug('Received task')
-                if task_id in stats.keys():
-                    logger.debug('Processing task')
-                    time = parser.parse(payload["Timestamp"]).now(datetime.timezone.utc).timestamp()
-                    time_usage = int((time - stats[task_id]['start_time']) * 1000)
-                    if succeed:
-                        stats[task_id]['complete'] = True
-                        stats[task_id]['error'] = False
-                        stats[task_id]['complete_time'] = time
-                        stats[task_id]['time_usage'] = time_usage
-                    else:
-                        stats[task_id]['complete'] = True
-                        stats[task_id]['error'] = True
-                        stats[task_id]['complete_time'] = time
-                        stats[task_id]['time_usage'] = time_usage
-                else:
-                    logger.debug(f'Ignored {task_id}')
+        for message in received_messages:
+            payload = json.loads(message.body)
+            msg = json.loads(payload['Message'])
+            context = msg.get('context') or {}
+            if not isinstance(context, dict) or context.get('run_id') != RUN_ID \
+                    or context.get('submitted_at', 0) < test_started_at:
+                logger.debug(f'Ignored {msg.get("id")}')
+                delete_message(message)
+                continue
+            if msg.get('status') == 'running':
                 delete_message(message)
+                continue
+
+            completed_at = datetime.datetime.fromisoformat(payload["Timestamp"]).timestamp()
+            time_usage = (completed_at - context['submitted_at']) * 1000
+            key = stats_key(context.get('tasktype', ''), context.get('runtime', ''))
+            local_stats.latency[key].record(time_usage)
+            if msg['result']:
+                local_stats.completed[key] += 1
+            else:
+                local_stats.failed[key] += 1
+                local_stats.failed_tasks.append({"task-id": msg['id'], "task": key, "time_usage": int(time_usage)})
+            delete_message(message)
 
 @events.test_start.add_listener
 def on_test_start(**kwargs):
-    global stats
-    stats = {}
+    global test_started_at
+    test_started_at = time.time()
+    local_stats.reset()
+    combined_stats.reset()
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    flush_local_stats(environment)
+
+
+class ArrivalProcess(object):
+    """Inter-arrival times for one simulated user under the configured profile"""
+
+    def __init__(self, profile: str, started_at: float):
+        self.profile = profile
+        self.started_at = started_at
+
+    def rate(self, now: float) -> float:
+        elapsed = now - self.started_at
+        if self.profile == "ramp":
+            return RAMP_START_RATE + (ARRIVAL_RATE - RAMP_START_RATE) * min(elapsed / RAMP_SECONDS, 1.0)
+        if self.profile == "poisson" and BURST_FACTOR > 1 and elapsed % BURST_PERIOD_SECONDS < BURST_SECONDS:
+            return ARRIVAL_RATE * BURST_FACTOR
+        return ARRIVAL_RATE
+
+    def next_interval(self, now: float) -> float:
+        rate = self.rate(now)
+        if self.profile == "poisson":
+            return random.expovariate(rate)
+        return 1.0 / rate
+
 
 class MyUser(HttpUser):
+    """Open-loop user: requests are fired on schedule without waiting for earlier responses"""
     host = "http://0.0.0.0:8089"
-    wait_time = between(0.5, 2.0)
+    wait_time = constant(0)
+
+    def on_start(self):
+        self.arrivals = ArrivalProcess(ARRIVAL_PROFILE, time.time())
+        self.next_arrival = time.time()
 
     @task
-    def txt_to_img(self):
-        random_number = str(random.randint(1, 999999999)).zfill(9)
-        body = TEMPLATE.copy()
-        body["task"]["metadata"]["id"] = str(random_number)
-        logger.debug(f'Send request with {random_number}')
-        self.client.post(API_ENDPOINT+"v1alpha2",
-                         data = json.dumps(body),
-                         headers={"x-api-key": API_KEY, "Content-Type": "application/json"},
-                         context={"task-id": random_number})
-
-@events.request.add_listener
-def on_request(context, **kwargs):
-    """
-    Event handler that get triggered on every request.
-    """
-    global stats
-    stats[context["task-id"]] = {
-                  "task-id": context["task-id"],
-                  "start_time": datetime.datetime.now(datetime.timezone.utc).timestamp(),
-                  "complete_time": 0.0,
-                  "complete": False,
-                  "error": False,
-                  "time_usage": 0
-                }
+    def submit(self):
+        now = time.time()
+        if self.next_arrival > now:
+            gevent.sleep(self.next_arrival - now)
+        self.next_arrival = max(self.next_arrival, now) + self.arrivals.next_interval(now)
+        gevent.spawn(self.send_task)
+
+    def send_task(self):
+        template = random.choices([t for t, _ in TEMPLATES], weights=[w for _, w in TEMPLATES])[0]
+        body = copy.deepcopy(template)
+        metadata = body["task"]["metadata"]
+        task_id = str(uuid.uuid4())
+        metadata["id"] = task_id
+        if RUNTIME:
+            metadata["runtime"] = RUNTIME
+        key = stats_key(metadata["tasktype"], metadata["runtime"])
+        metadata["context"] = {
+            "run_id": RUN_ID,
+            "submitted_at": time.time(),
+            "tasktype": metadata["tasktype"],
+            "runtime": metadata["runtime"],
+        }
+        logger.debug(f'Send request with {task_id}')
+        with self.client.post(API_ENDPOINT+"v1alpha2", data=json.dumps(body),
+                               headers={"x-api-key": API_KEY, "Content-Type": "application/json"},
+                               catch_response=True) as response:
+            if response.status_code == 200:
+                local_stats.submitted[key] += 1
+                response.success()
+            else:
+                local_stats.rejected[key] += 1
+                response.failure(f"HTTP {response.status_code}")
 
 # if launched directly, e.g. "python3 debugging.py", not "locust -f debugging.py"
 if __name__ == "__main__":
-    run_single_user(MyUser)
\ No newline at end of file
+    run_single_user(MyUser)
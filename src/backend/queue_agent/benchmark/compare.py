@@ -0,0 +1,87 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Compare two benchmark result files produced by harness.py.
+
+Prints the relative change of throughput, per-stage time, peak RSS and bytes
+moved for every scenario present in both files, or of time and allocations per
+case for micro.py results, and exits with status 1 when any metric regresses by
+more than --threshold.
+
+Usage:
+    python benchmark/compare.py benchmark/results/<old>.json benchmark/results/<new>.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+
+# Metrics where a higher value is better; everything else is lower-is-better
+HIGHER_IS_BETTER = {"tasks_per_sec"}
+
+
+def flatten(scenario: dict) -> dict:
+    metrics = {
+        "tasks_per_sec": scenario.get("tasks_per_sec"),
+        "peak_rss_mb": scenario.get("peak_rss_mb"),
+        "peak_traced_alloc_mb": scenario.get("peak_traced_alloc_mb"),
+        "cpu_ms_per_task": scenario.get("cpu_ms_per_task"),
+        "import_main_s": scenario.get("import_main_s"),
+    }
+    for event, offset in scenario.get("startup", {}).items():
+        metrics[f"startup.{event}_s"] = offset
+    for stage, values in scenario.get("stages", {}).items():
+        metrics[f"stage.{stage}.per_task_ms"] = values.get("per_task_ms")
+    for name, value in scenario.get("bytes", {}).items():
+        metrics[f"bytes.{name}"] = value
+    # Cases of micro.py, the median is left out as the noisier of the two times
+    for name in ("min_ms", "peak_alloc_kb"):
+        if name in scenario:
+            metrics[name] = scenario[name]
+    return metrics
+
+
+def compare(old: dict, new: dict, threshold: float) -> list:
+    regressions = []
+    for name in sorted(set(old["scenarios"]) & set(new["scenarios"])):
+        if "error" in old["scenarios"][name] or "error" in new["scenarios"][name]:
+            print(f"[{name}] skipped, one of the runs failed")
+            continue
+        before = flatten(old["scenarios"][name])
+        after = flatten(new["scenarios"][name])
+        print(f"[{name}]")
+        for metric in sorted(set(before) & set(after)):
+            a, b = before[metric], after[metric]
+            if not a or b is None:
+                continue
+            change = (b - a) / abs(a)
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > threshold:
+                flag = "  REGRESSION"
+                regressions.append((name, metric, change))
+            print(f"  {metric:<40} {a:>14.3f} -> {b:>14.3f}  {change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare queue agent benchmark results")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Allowed relative regression, 0.1 = 10%%")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        old = json.load(f)
+    with open(args.candidate) as f:
+        new = json.load(f)
+
+    print(f"Baseline {old['label']} vs candidate {new['label']}")
+    regressions = compare(old, new, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
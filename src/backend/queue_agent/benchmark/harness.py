@@ -0,0 +1,499 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Offline benchmark for the queue agent.
+
+Drives main.process_message (direct mode) or main.main (loop mode) against
+in-process SQS/SNS/S3 provided by moto and the stub runtimes in stubs.py, and
+reports tasks/sec, time per stage, peak RSS and bytes moved for each scenario.
+Every scenario runs in a fresh interpreter so peak RSS is not shared.
+
+Usage:
+    python benchmark/harness.py --tasks 50 --image-size 1024 --latency 0.05
+    python benchmark/compare.py benchmark/results/<old>.json benchmark/results/<new>.json
+"""
+
+import argparse
+import copy
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+AGENT_SRC = os.path.join(BENCH_DIR, "..", "src")
+FIXTURES = os.path.join(BENCH_DIR, "..", "..", "..", "..", "test", "v1alpha2")
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+SCENARIOS = {
+    "t2i": {"runtime": "sdwebui", "fixture": "t2i.json"},
+    "i2i": {"runtime": "sdwebui", "fixture": "i2i.json"},
+    "extra-batch": {"runtime": "sdwebui", "fixture": None},
+    "comfyui-multi": {"runtime": "comfyui", "fixture": "pipeline.json"},
+    "comfyui-template": {"runtime": "comfyui", "fixture": "pipeline.json", "template": True},
+}
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURES, name)) as f:
+        return json.load(f)["task"]
+
+
+def build_task(scenario: str, index: int, stub, config: dict) -> dict:
+    """Build the v1alpha2 task for one request of a scenario"""
+    spec = SCENARIOS[scenario]
+    if spec["fixture"]:
+        task = copy.deepcopy(load_fixture(spec["fixture"]))
+    else:
+        task = {"metadata": {"tasktype": "extra-batch-image", "prefix": "output", "context": ""},
+                "content": {"upscaling_resize": 2, "upscaler_1": "R-ESRGAN 4x+"}}
+    if spec.get("template"):
+        # Only the parameters of the workflow registered by write_template
+        task["content"] = {"template_id": "pipeline", "parameters": {"prompt": f"bench {index}", "seed": index}}
+    task["metadata"]["id"] = f"bench-{scenario}-{index}"
+    task["metadata"]["runtime"] = "benchruntime"
+    content = task["content"]
+
+    if scenario in ("t2i", "i2i"):
+        content["batch_size"] = config["batch_size"]
+    if scenario == "i2i":
+        # Unique URLs so every task pays for the download instead of hitting the local cache
+        content["init_images"] = [stub.asset_url(f"input-{index}.png")]
+    if scenario == "extra-batch":
+        content["imageList"] = [{"data": stub.asset_url(f"input-{index}-{n}.png"), "name": f"{n}.png"}
+                                for n in range(config["batch_size"])]
+    return task
+
+
+def write_template(directory: str) -> None:
+    """Register pipeline.json as a workflow template with prompt and seed parameters"""
+    template = {
+        "workflow": load_fixture("pipeline.json")["content"],
+        "parameters": {
+            "prompt": {"type": "string", "targets": [["6", "text"]]},
+            "seed": {"type": "integer", "targets": [["3", "seed"]], "default": 0},
+        },
+    }
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "pipeline.json"), "w") as f:
+        json.dump(template, f)
+
+
+class StageRecorder(object):
+    """Wraps agent module functions to accumulate wall time, call count and bytes per stage"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def wrap(self, module, attr: str, stage: str, size_of=None):
+        original = getattr(module, attr)
+
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = None
+            try:
+                result = original(*args, **kwargs)
+                return result
+            finally:
+                elapsed = time.perf_counter() - start
+                size = size_of(args, result) if size_of else 0
+                with self.lock:
+                    self.seconds[stage] += elapsed
+                    self.calls[stage] += 1
+                    self.bytes[stage] += size
+
+        setattr(module, attr, wrapper)
+
+    def report(self, tasks: int, total_seconds: float) -> dict:
+        stages = {}
+        for stage in sorted(self.seconds):
+            stages[stage] = {
+                "calls": self.calls[stage],
+                "total_s": round(self.seconds[stage], 6),
+                "per_task_ms": round(self.seconds[stage] * 1000 / max(tasks, 1), 3),
+                "bytes": self.bytes[stage],
+            }
+        # Receiving happens outside process_message and notifying in the background, everything
+        # else is nested inside it
+        outside = ("process_message", "sqs_receive", "sns_publish", "sqs_delete")
+        accounted = sum(self.seconds[s] for s in self.seconds if s not in outside)
+        if "process_message" in self.seconds:
+            stages["agent_other"] = {
+                "per_task_ms": round((self.seconds["process_message"] - accounted) * 1000 / max(tasks, 1), 3)
+            }
+        return stages
+
+
+def _len_or_zero(obj) -> int:
+    try:
+        return len(obj)
+    except TypeError:
+        pass
+    # Streamed outputs are temporary files
+    if hasattr(obj, "seek") and not getattr(obj, "closed", True):
+        position = obj.tell()
+        size = obj.seek(0, os.SEEK_END)
+        obj.seek(position)
+        return size
+    return 0
+
+
+def instrument(recorder: StageRecorder):
+    from modules import http_action, s3_action, sns_action, sqs_action, status_store
+
+    recorder.wrap(http_action, "do_invocations", "runtime_api")
+    recorder.wrap(http_action, "get", "http_get", lambda args, res: _len_or_zero(res))
+    recorder.wrap(http_action, "download_spooled", "output_download", lambda args, res: _len_or_zero(res))
+    recorder.wrap(s3_action, "upload_file", "s3_upload", lambda args, res: _len_or_zero(args[0]))
+    recorder.wrap(sns_action, "publish_message", "sns_publish", lambda args, res: _len_or_zero(args[1]))
+    recorder.wrap(sqs_action, "receive_messages", "sqs_receive")
+    recorder.wrap(sqs_action, "delete_message", "sqs_delete")
+    recorder.wrap(status_store, "update", "status_update")
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    if platform.system() == "Darwin":
+        return round(peak / 1024 / 1024, 2)
+    return round(peak / 1024, 2)
+
+
+def run_scenario(scenario: str, config: dict) -> dict:
+    """Run one scenario in the current (fresh) interpreter and return its metrics"""
+    os.chdir(tempfile.mkdtemp(prefix="queue-agent-bench-"))
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "LOGLEVEL": config["log_level"],
+        "LOG_DEBUG_SAMPLE_RATE": str(config["log_sample_rate"]),
+        "IMAGE_PRESIZE": "true" if config["presize"] else "false",
+        "RUNTIME_ACCEPT_ENCODING": config["accept_encoding"],
+        "RUNTIME_REQUEST_ENCODING": config["request_encoding"],
+        "HEALTH_PORT": "0",
+    })
+
+    import boto3
+    from moto import mock_aws
+
+    import stubs
+
+    spec = SCENARIOS[scenario]
+    collector = None
+    if config["tracing"] == "otlp":
+        collector = stubs.OTLPCollectorStub().start()
+        os.environ.update({
+            "TRACING_EXPORTER": "otlp",
+            "OTEL_EXPORTER_OTLP_ENDPOINT": collector.endpoint,
+            "OTEL_BSP_SCHEDULE_DELAY": "100",
+        })
+    else:
+        os.environ["TRACING_EXPORTER"] = "none"
+    os.environ["TRACE_SAMPLE_RATE"] = str(config["trace_sample_rate"])
+    if spec.get("template"):
+        write_template(os.path.join(os.getcwd(), "templates"))
+        os.environ["WORKFLOW_TEMPLATE_PATH"] = os.path.join(os.getcwd(), "templates")
+
+    # One stub per backend, the first one also serves input images
+    runtime_stubs = []
+    for i in range(config["backends"]):
+        if spec["runtime"] == "sdwebui":
+            uds_path = os.path.join(os.getcwd(), f"sdwebui-{i}.sock") if config["runtime_uds"] else None
+            runtime_stubs.append(stubs.SDWebUIStub(config["latency"], config["image_size"],
+                                                   config["images_per_task"], uds_path=uds_path).start())
+        else:
+            runtime_stubs.append(stubs.ComfyUIStub(config["latency"], config["image_size"], config["images_per_task"],
+                                                   config["output_nodes"]).start())
+        stubs.wait_for_port(runtime_stubs[-1].port)
+    stub = runtime_stubs[0]
+
+    with mock_aws():
+        sqs = boto3.resource("sqs")
+        sns = boto3.resource("sns")
+        s3 = boto3.resource("s3")
+        bucket = s3.create_bucket(Bucket="bench-output")
+        input_topic = sns.create_topic(Name="bench-input")
+        output_topic = sns.create_topic(Name="bench-output")
+        input_queue = sqs.create_queue(QueueName="bench-input")
+        output_queue = sqs.create_queue(QueueName="bench-output")
+        input_topic.subscribe(Protocol="sqs", Endpoint=input_queue.attributes["QueueArn"])
+        output_topic.subscribe(Protocol="sqs", Endpoint=output_queue.attributes["QueueArn"])
+
+        os.environ["STATUS_STORE"] = config["status_store"]
+        if config["status_store"] == "dynamodb":
+            boto3.client("dynamodb").create_table(
+                TableName="bench-status",
+                KeySchema=[{"AttributeName": "id", "KeyType": "HASH"}],
+                AttributeDefinitions=[{"AttributeName": "id", "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST")
+            os.environ["STATUS_TABLE_NAME"] = "bench-status"
+
+        os.environ.update({
+            "RUNTIME_TYPE": spec["runtime"],
+            "RUNTIME_NAME": "benchruntime",
+            "API_BASE_URL": stub.api_base_url,
+            "API_BASE_URLS": ",".join(runtime_stub.api_base_url for runtime_stub in runtime_stubs),
+            "SQS_QUEUE_URL": input_queue.url,
+            "SNS_TOPIC_ARN": output_topic.arn,
+            "S3_BUCKET": bucket.name,
+        })
+        sys.path.insert(0, os.path.abspath(AGENT_SRC))
+        import_start = time.perf_counter()
+        import main
+        import_main_s = time.perf_counter() - import_start
+
+        if collector:
+            main.tracing.init("bench-queue-agent")
+            deadline = time.monotonic() + 10
+            while not main.tracing.enabled() and time.monotonic() < deadline:
+                time.sleep(0.05)
+
+        if config["sns_latency"]:
+            # moto answers in process, SNS is a network round trip away
+            publish = main.sns_action.publish_message
+
+            def delayed_publish(*args, **kwargs):
+                time.sleep(config["sns_latency"])
+                return publish(*args, **kwargs)
+            main.sns_action.publish_message = delayed_publish
+
+        recorder = StageRecorder()
+        instrument(recorder)
+        recorder.wrap(main, "process_message", "process_message")
+
+        tasks = config["tasks"]
+        task_message_bytes = 0
+        for i in range(tasks):
+            body = json.dumps(build_task(scenario, i, stub, config))
+            attributes = {"runtime": {"DataType": "String", "StringValue": "benchruntime"}}
+            if config["encoding"] != "none":
+                body = main.task_message.compress(body, config["encoding"])
+                attributes[main.task_message.ENCODING_ATTRIBUTE] = {"DataType": "String",
+                                                                    "StringValue": config["encoding"]}
+            task_message_bytes += len(body.encode())
+            input_topic.publish(Message=body, MessageAttributes=attributes)
+
+        if config["trace_alloc"]:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        if config["mode"] == "loop":
+            processed, finished = run_loop(main, output_queue, tasks)
+        else:
+            processed = run_direct(main, input_queue, output_topic, tasks)
+            finished = time.perf_counter()
+        elapsed = finished - start
+        # Includes the stubs and moto, which do the same work for every agent version
+        cpu_seconds = time.process_time() - cpu_start
+
+        main.image_utils.shutdown()
+
+        alloc_peak = None
+        if config["trace_alloc"]:
+            alloc_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        statuses = None
+        store = main.status_store.get_store()
+        if store is not None:
+            statuses = defaultdict(int)
+            for i in range(tasks):
+                item = store.get(f"bench-{scenario}-{i}")
+                statuses[item["status"] if item else "missing"] += 1
+            statuses = dict(statuses)
+
+        runtime_io = defaultdict(int)
+        for runtime_stub in runtime_stubs:
+            runtime_stub.stop()
+            for key, value in runtime_stub.counters.snapshot().items():
+                runtime_io[key] += value
+        trace_exports = None
+        if collector:
+            from opentelemetry import trace
+            trace.get_tracer_provider().force_flush()
+            trace_exports = {"exports": collector.exports, "bytes": collector.counters.snapshot()["bytes_in"]}
+            collector.stop()
+
+    return {
+        "runtime": spec["runtime"],
+        "mode": config["mode"],
+        "tasks": processed,
+        "wall_s": round(elapsed, 4),
+        "tasks_per_sec": round(processed / elapsed, 3) if elapsed else None,
+        "cpu_ms_per_task": round(cpu_seconds * 1000 / processed, 2) if processed else None,
+        "import_main_s": round(import_main_s, 4),
+        "startup": main.health.timeline(),
+        "stages": recorder.report(processed, elapsed),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_traced_alloc_mb": round(alloc_peak / 1024 / 1024, 2) if alloc_peak is not None else None,
+        "trace_exports": trace_exports,
+        "statuses": statuses,
+        "bytes": {
+            "task_message": task_message_bytes,
+            "runtime_request": runtime_io["bytes_in"],
+            "runtime_response": runtime_io["bytes_out"],
+            "runtime_request_wire": runtime_io["wire_bytes_in"],
+            "runtime_response_wire": runtime_io["wire_bytes_out"],
+            "input_download": recorder.bytes["http_get"],
+            "output_download": recorder.bytes["output_download"],
+            "s3_upload": recorder.bytes["s3_upload"],
+            "sns_publish": recorder.bytes["sns_publish"],
+        },
+    }
+
+
+def run_direct(main, input_queue, output_topic, tasks: int) -> int:
+    processed = 0
+    while processed < tasks:
+        messages = input_queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=0,
+                                                AttributeNames=["All"], MessageAttributeNames=["All"])
+        if not messages:
+            break
+        for message in messages:
+            main.process_message(message, output_topic, main.s3_bucket, main.runtime_type, main.runtime_name,
+                                 main.api_base_url, main.dynamic_sd_model if main.runtime_type == "sdwebui" else None)
+            processed += 1
+    # Tasks are done once their notifications are out and their messages deleted
+    main.sns_action.get_publisher().flush(30)
+    return processed
+
+
+def run_loop(main, output_queue, tasks: int) -> tuple:
+    """Returns the number of completed tasks and when the last one completed, excluding shutdown"""
+    main.SQS_WAIT_TIME_SECONDS = 1
+    worker = threading.Thread(target=main.main, daemon=True)
+    worker.start()
+    completed = 0
+    while completed < tasks and worker.is_alive():
+        messages = output_queue.receive_messages(MaxNumberOfMessages=10, WaitTimeSeconds=1)
+        for message in messages:
+            if json.loads(json.loads(message.body)["Message"]).get("status") in ("completed", "failed"):
+                completed += 1
+            message.delete()
+    finished = time.perf_counter()
+    main.shutdown = True
+    worker.join(timeout=30)
+    return completed, finished
+
+
+def _scenario_entry(scenario: str, config: dict, results):
+    sys.path.insert(0, BENCH_DIR)
+    try:
+        results.put(run_scenario(scenario, config))
+    except Exception as e:
+        traceback.print_exc()
+        results.put({"error": repr(e)})
+
+
+def git_label() -> str:
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD", "--", ".."], cwd=BENCH_DIR) != 0
+        return sha + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline queue agent benchmark")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated scenario names")
+    parser.add_argument("--mode", choices=["direct", "loop"], default="direct",
+                        help="direct calls process_message, loop runs main.main against the queue")
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--image-size", type=int, default=512, help="Edge length of generated images in pixels")
+    parser.add_argument("--latency", type=float, default=0.0, help="Stub runtime latency per task in seconds")
+    parser.add_argument("--sns-latency", type=float, default=0.0, help="Seconds added to every SNS publish")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--backends", type=int, default=1,
+                        help="Runtime stubs served by one agent through API_BASE_URLS, used concurrently in loop mode")
+    parser.add_argument("--images-per-task", type=int, default=2, help="ComfyUI images per output node")
+    parser.add_argument("--output-nodes", type=int, default=2, help="ComfyUI output nodes")
+    parser.add_argument("--encoding", choices=["none", "gzip+base64", "zstd+base64"], default="none",
+                        help="Compress task messages as the input functions do with MESSAGE_ENCODING")
+    parser.add_argument("--status-store", choices=["none", "memory", "dynamodb"], default="none",
+                        help="Record task statuses in process or in a moto DynamoDB table")
+    parser.add_argument("--trace-alloc", action="store_true", help="Also report peak traced Python allocations")
+    parser.add_argument("--tracing", choices=["none", "otlp"], default="none",
+                        help="otlp exports traces to a local collector stand-in")
+    parser.add_argument("--trace-sample-rate", type=float, default=1.0)
+    parser.add_argument("--presize", action="store_true",
+                        help="Downscale input images to the requested size before sending them to the runtime")
+    parser.add_argument("--runtime-uds", action="store_true",
+                        help="Talk to SD Web UI stubs over Unix domain sockets instead of TCP")
+    parser.add_argument("--accept-encoding", default="identity",
+                        help="Accept-Encoding the agent sends to the runtime, e.g. gzip or zstd")
+    parser.add_argument("--request-encoding", choices=["none", "gzip", "zstd"], default="none",
+                        help="Compression of request bodies sent to the runtime")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--log-sample-rate", type=float, default=0.0,
+                        help="Fraction of tasks logged at DEBUG level whatever --log-level is")
+    parser.add_argument("--label", default=None, help="Result file name, defaults to the git commit")
+    args = parser.parse_args()
+
+    config = {
+        "mode": args.mode,
+        "tasks": args.tasks,
+        "image_size": args.image_size,
+        "latency": args.latency,
+        "sns_latency": args.sns_latency,
+        "batch_size": args.batch_size,
+        "images_per_task": args.images_per_task,
+        "output_nodes": args.output_nodes,
+        "backends": args.backends,
+        "encoding": args.encoding,
+        "status_store": args.status_store,
+        "trace_alloc": args.trace_alloc,
+        "tracing": args.tracing,
+        "trace_sample_rate": args.trace_sample_rate,
+        "log_level": args.log_level,
+        "log_sample_rate": args.log_sample_rate,
+        "presize": args.presize,
+        "runtime_uds": args.runtime_uds,
+        "accept_encoding": args.accept_encoding,
+        "request_encoding": args.request_encoding,
+    }
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            parser.error(f"Unknown scenario {scenario}")
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_scenario_entry, args=(scenario, config, queue))
+        proc.start()
+        results[scenario] = queue.get()
+        proc.join()
+        r = results[scenario]
+        if "error" in r:
+            print(f"{scenario:>14}: failed with {r['error']}")
+        else:
+            print(f"{scenario:>14}: {r['tasks_per_sec']} tasks/s, {r['wall_s']} s, {r['cpu_ms_per_task']} CPU ms/task, "
+                  f"peak RSS {r['peak_rss_mb']} MB")
+
+    label = args.label or git_label()
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{label}.json")
+    with open(path, "w") as f:
+        json.dump({"label": label, "timestamp": int(time.time()), "python": platform.python_version(),
+                   "config": config, "scenarios": results}, f, indent=2)
+    print(f"Results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Micro-benchmarks of the queue agent's CPU-bound hot paths.
+
+Times single agent functions on fixtures built from test/v1alpha2/*.json, scaled
+to large batches and images, and reports the best and median time per call and
+the peak traced allocation of one call. Runs offline: nothing is sent over the
+network, URL downloads are answered from memory and no AWS API is called.
+
+Usage:
+    python benchmark/micro.py --image-size 1024 --batch-size 8
+    python benchmark/micro.py --baseline benchmark/results/<old>-micro.json --threshold 0.1
+"""
+
+import argparse
+import base64
+import copy
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+from harness import AGENT_SRC, RESULTS_DIR, git_label, load_fixture
+from stubs import make_png
+
+import compare
+
+# Each case is (setup, call): setup(config) builds the fixture once, and returns the
+# arguments of a call, copied before every call when the function changes them
+CASES = {}
+
+
+def case(name: str, mutates: bool = False):
+    def register(setup):
+        CASES[name] = (setup, mutates)
+        return setup
+    return register
+
+
+class _Message(object):
+    """SQS message as seen by task_message.decode"""
+
+    def __init__(self, body: str):
+        self.body = body
+
+
+def _controlnet_units(config: dict, url: str) -> list:
+    return [{"enabled": True, "module": "canny", "model": "control_v11p_sd15_canny", "weight": 1.0,
+             "image": {"image": url, "mask": url}, "processor_res": 512, "resize_mode": "Crop and Resize"}
+            for _ in range(config["controlnet_units"])]
+
+
+@case("sdwebui.download_image", mutates=True)
+def _download_image(config: dict):
+    from runtimes import sdwebui
+    content = copy.deepcopy(load_fixture("i2i.json")["content"])
+    url = "http://assets.local/input.png"
+    content["init_images"] = [url] * config["batch_size"]
+    content.setdefault("alwayson_scripts", {})["controlnet"] = {"args": _controlnet_units(config, url)}
+    return sdwebui.download_image, (content,)
+
+
+@case("sdwebui.post_invocations")
+def _post_invocations(config: dict):
+    from runtimes import sdwebui
+    image_b64 = base64.b64encode(config["image"]).decode()
+    response = {"images": [image_b64] * config["batch_size"], "parameters": {}, "info": "{}"}
+    return sdwebui.post_invocations, (response,)
+
+
+@case("misc.exclude_keys")
+def _exclude_keys(config: dict):
+    from modules import misc
+    from runtimes import sdwebui
+    scripts = {"sd_model_checkpoint": "sd_xl_base_1.0.safetensors", "id_task": "bench", "uid": "bench",
+               "save_dir": "output", "controlnet": {"args": _controlnet_units(config, "http://assets.local/input.png")}}
+    scripts.update({f"script_{i}": {"args": [i]} for i in range(20)})
+    return misc.exclude_keys, (scripts, sdwebui.ALWAYSON_SCRIPTS_EXCLUDE_KEYS)
+
+
+@case("task_message.decode")
+def _decode(config: dict):
+    from modules import task_message
+    task = copy.deepcopy(load_fixture("i2i.json"))
+    # Inline images, as sent by clients that don't link them
+    task["content"]["init_images"] = [base64.b64encode(config["image"]).decode()] * config["batch_size"]
+    message = _Message(json.dumps({"Type": "Notification", "Message": json.dumps(task)}))
+    return task_message.decode, (message,)
+
+
+@case("s3_action.mime_type")
+def _mime_type(config: dict):
+    from modules import s3_action
+    return s3_action._mime_type, (config["image"],)
+
+
+def measure(func, args: tuple, mutates: bool, repeat: int, min_seconds: float) -> dict:
+    """Best and median time of repeat rounds, each long enough to time reliably"""
+    def run(count: int) -> float:
+        inputs = [copy.deepcopy(args) for _ in range(count)] if mutates else [args] * count
+        start = time.perf_counter()
+        for call_args in inputs:
+            func(*call_args)
+        return time.perf_counter() - start
+
+    run(1)
+    count = 1
+    while run(count) < min_seconds and count < 1_000_000:
+        count *= 2
+    times = [run(count) / count for _ in range(repeat)]
+
+    call_args = copy.deepcopy(args) if mutates else args
+    tracemalloc.start()
+    func(*call_args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "calls_per_round": count,
+        "min_ms": round(min(times) * 1000, 4),
+        "median_ms": round(statistics.median(times) * 1000, 4),
+        "peak_alloc_kb": round(peak / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queue agent micro-benchmarks")
+    parser.add_argument("--cases", default=",".join(CASES), help="Comma separated case names")
+    parser.add_argument("--image-size", type=int, default=1024, help="Edge length of images in pixels")
+    parser.add_argument("--batch-size", type=int, default=8, help="Images per request and response")
+    parser.add_argument("--controlnet-units", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=7, help="Timed rounds per case")
+    parser.add_argument("--min-seconds", type=float, default=0.2, help="Minimum duration of a round")
+    parser.add_argument("--baseline", default=None, help="Result file to compare with, exit 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Allowed relative regression, 0.1 = 10%%")
+    parser.add_argument("--label", default=None, help="Result file name, defaults to the git commit")
+    args = parser.parse_args()
+
+    sys.path.insert(0, AGENT_SRC)
+    logging.getLogger("queue-agent").setLevel(logging.WARNING)
+    from modules import http_action
+
+    config = {
+        "image_size": args.image_size,
+        "batch_size": args.batch_size,
+        "controlnet_units": args.controlnet_units,
+    }
+    config["image"] = make_png(args.image_size, args.image_size)
+    # Downloads are answered from memory, this measures the agent's own work on them
+    http_action.get = lambda url: config["image"]
+
+    results = {}
+    for name in args.cases.split(","):
+        if name not in CASES:
+            parser.error(f"Unknown case {name}")
+        setup, mutates = CASES[name]
+        func, call_args = setup(config)
+        results[name] = measure(func, call_args, mutates, args.repeat, args.min_seconds)
+        r = results[name]
+        print(f"{name:>26}: {r['min_ms']:>10.3f} ms best, {r['median_ms']:>10.3f} ms median, "
+              f"peak alloc {r['peak_alloc_kb']} KB")
+
+    del config["image"]
+    label = args.label or f"{git_label()}-micro"
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{label}.json")
+    result = {"label": label, "timestamp": int(time.time()), "python": platform.python_version(),
+              "config": config, "scenarios": results}
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results saved to {path}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"Baseline {baseline['label']} vs candidate {label}")
+        regressions = compare.compare(baseline, result, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""Local stand-ins for SD Web UI and ComfyUI used by the benchmark harness.
+
+Both servers answer the subset of the runtime API the queue agent uses, return
+images of a configurable size after a configurable latency, and count the bytes
+they receive and send so the harness can report data movement per task.
+"""
+
+import base64
+import gzip
+import hashlib
+import os
+import json
+import random
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+def make_png(width: int, height: int, seed: int = 0) -> bytes:
+    """Build a valid, incompressible RGB PNG so MIME sniffing and upload sizes are realistic"""
+    rnd = random.Random(seed)
+    row_len = width * 3
+    raw = b"".join(b"\x00" + rnd.randbytes(row_len) for _ in range(height))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    ihdr = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(raw, 0)) + chunk(b"IEND", b"")
+
+
+class _Counters(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.wire_bytes_in = 0
+        self.wire_bytes_out = 0
+        self.requests = 0
+
+    def add(self, bytes_in: int, bytes_out: int, wire_in: int = None, wire_out: int = None):
+        """Payload bytes, and the bytes actually transferred when they were compressed"""
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.wire_bytes_in += bytes_in if wire_in is None else wire_in
+            self.wire_bytes_out += bytes_out if wire_out is None else wire_out
+            self.requests += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                    "wire_bytes_in": self.wire_bytes_in, "wire_bytes_out": self.wire_bytes_out,
+                    "requests": self.requests}
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    # Responses are compressed like SD Web UI's GZipMiddleware does
+    gzip_level = 9
+    compress_min_bytes = 1000
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length) if length else b""
+        self.wire_in = len(data)
+        encoding = self.headers.get("Content-Encoding", "").lower()
+        if encoding == "gzip":
+            data = gzip.decompress(data)
+        elif encoding == "zstd":
+            data = zstandard.ZstdDecompressor().decompress(data)
+        return data
+
+    def encode(self, data: bytes, content_type: str):
+        if len(data) < self.compress_min_bytes or not content_type.startswith("application/json"):
+            return data, None
+        accepted = [e.split(";")[0].strip() for e in self.headers.get("Accept-Encoding", "").lower().split(",")]
+        if "zstd" in accepted and zstandard is not None:
+            return zstandard.ZstdCompressor(level=3).compress(data), "zstd"
+        if "gzip" in accepted:
+            return gzip.compress(data, self.gzip_level), "gzip"
+        return data, None
+
+    def send_bytes(self, data: bytes, content_type: str = "application/json", status: int = 200, bytes_in: int = 0):
+        wire, encoding = self.encode(data, content_type)
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(wire)))
+        self.end_headers()
+        self.wfile.write(wire)
+        self.server.counters.add(bytes_in, len(data), getattr(self, "wire_in", None), len(wire))
+        self.wire_in = None
+
+    def send_json(self, obj, bytes_in: int = 0):
+        self.send_bytes(json.dumps(obj).encode(), bytes_in=bytes_in)
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, latency: float, image_size: int, images_per_task: int):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.image = make_png(image_size, image_size)
+        self.image_b64 = base64.b64encode(self.image).decode()
+        self.images_per_task = images_per_task
+        self.counters = _Counters()
+        self.thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _SDWebUIHandler(_StubHandler):
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == "/sdapi/v1/options":
+            self.send_json({"sd_model_checkpoint": self.server.model})
+        elif path == "/sdapi/v1/sd-models":
+            self.send_json([{"title": self.server.model}])
+        elif path == "/sdapi/v1/progress":
+            self.send_json({"progress": 0.0, "eta_relative": 0.0, "state": {"sampling_step": 0, "sampling_steps": 0}})
+        elif path.startswith("/assets/"):
+            self.send_bytes(self.server.image, content_type="image/png")
+        else:
+            self.send_json({"detail": "Not Found"}, bytes_in=0)
+
+    def do_POST(self):
+        body = self.read_body()
+        path = urllib.parse.urlparse(self.path).path
+        endpoint = path.rsplit("/", 1)[-1]
+        if endpoint in ("txt2img", "img2img"):
+            request = json.loads(body)
+            count = int(request.get("batch_size", 1)) * int(request.get("n_iter", 1))
+            time.sleep(self.server.latency)
+            seeds = [random.randint(0, 2**31) for _ in range(count)]
+            response = {
+                "images": [self.server.image_b64] * count,
+                "parameters": {k: v for k, v in request.items() if not isinstance(v, (list, dict))},
+                "info": json.dumps({"all_seeds": seeds})
+            }
+            self.send_json(response, bytes_in=len(body))
+        elif endpoint == "extra-single-image":
+            time.sleep(self.server.latency)
+            self.send_json({"image": self.server.image_b64, "html_info": ""}, bytes_in=len(body))
+        elif endpoint == "extra-batch-images":
+            request = json.loads(body)
+            time.sleep(self.server.latency)
+            count = len(request.get("imageList", [])) or 1
+            self.send_json({"images": [self.server.image_b64] * count, "html_info": ""}, bytes_in=len(body))
+        elif endpoint == "options":
+            request = json.loads(body)
+            if "sd_model_checkpoint" in request:
+                self.server.model = request["sd_model_checkpoint"]
+            self.send_json(None, bytes_in=len(body))
+        else:
+            self.send_json({}, bytes_in=len(body))
+
+
+class _UnixListener(ThreadingMixIn, UnixStreamServer):
+    """Second listener of a stub on a Unix domain socket, sharing the stub's state"""
+    daemon_threads = True
+
+    def __init__(self, path: str, handler, primary):
+        self.primary = primary
+        super().__init__(path, handler)
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def __setattr__(self, name, value):
+        # The model switched over either listener is the same model
+        if name == "model":
+            setattr(self.primary, name, value)
+        else:
+            super().__setattr__(name, value)
+
+
+class SDWebUIStub(_StubServer):
+    """Answers /sdapi/v1/* like SD Web UI and serves a source image at /assets/. With uds_path
+    the API is also served on that Unix domain socket, and api_base_url points to it"""
+
+    def __init__(self, latency: float = 0.0, image_size: int = 512, images_per_task: int = 1,
+                 model: str = "sd_xl_turbo_1.0.safetensors", uds_path: str = None):
+        super().__init__(_SDWebUIHandler, latency, image_size, images_per_task)
+        self.model = model
+        self.uds_path = uds_path
+        self.unix_listener = None
+
+    def start(self):
+        if self.uds_path:
+            if os.path.exists(self.uds_path):
+                os.unlink(self.uds_path)
+            self.unix_listener = _UnixListener(self.uds_path, _SDWebUIHandler, self)
+            threading.Thread(target=self.unix_listener.serve_forever, daemon=True).start()
+        return super().start()
+
+    def stop(self):
+        if self.unix_listener is not None:
+            self.unix_listener.shutdown()
+            self.unix_listener.server_close()
+            os.unlink(self.uds_path)
+        super().stop()
+
+    @property
+    def api_base_url(self) -> str:
+        if self.uds_path:
+            return f"http+unix://{urllib.parse.quote(self.uds_path, safe='')}/sdapi/v1/"
+        return f"http://127.0.0.1:{self.port}/sdapi/v1/"
+
+    def asset_url(self, name: str = "input.png") -> str:
+        return f"http://127.0.0.1:{self.port}/assets/{name}"
+
+
+class _ComfyUIHandler(_StubHandler):
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        if parsed.path == "/ws":
+            self.websocket(urllib.parse.parse_qs(parsed.query).get("clientId", [""])[0])
+        elif parsed.path == "/system_stats":
+            self.send_json({"system": {}, "devices": []})
+        elif parsed.path.startswith("/history/"):
+            prompt_id = parsed.path.rsplit("/", 1)[-1]
+            self.send_json({prompt_id: self.server.history.get(prompt_id, {"outputs": {}})})
+        elif parsed.path == "/view":
+            self.send_bytes(self.server.image, content_type="image/png")
+        else:
+            self.send_json({}, bytes_in=0)
+
+    def do_POST(self):
+        body = self.read_body()
+        if urllib.parse.urlparse(self.path).path == "/prompt":
+            request = json.loads(body)
+            prompt_id = str(uuid.uuid4())
+            self.server.history[prompt_id] = {"outputs": self.server.outputs_for(prompt_id)}
+            threading.Thread(target=self.server.execute, args=(request["client_id"], prompt_id, request["prompt"]),
+                             daemon=True).start()
+            self.send_json({"prompt_id": prompt_id, "number": 0, "node_errors": {}}, bytes_in=len(body))
+        else:
+            self.send_json({}, bytes_in=len(body))
+
+    def websocket(self, client_id: str):
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        self.send_response(101, "Switching Protocols")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.server.clients[client_id] = (self.connection, threading.Lock())
+        self.close_connection = True
+        # Hold the connection open until the client goes away
+        try:
+            while self.connection.recv(4096):
+                pass
+        except OSError:
+            pass
+        finally:
+            self.server.clients.pop(client_id, None)
+
+
+class ComfyUIStub(_StubServer):
+    """Answers /prompt, /history, /view and pushes execution events over /ws like ComfyUI"""
+
+    def __init__(self, latency: float = 0.0, image_size: int = 512, images_per_task: int = 1,
+                 output_nodes: int = 1):
+        super().__init__(_ComfyUIHandler, latency, image_size, images_per_task)
+        self.output_nodes = output_nodes
+        self.history = {}
+        self.clients = {}
+
+    @property
+    def api_base_url(self) -> str:
+        return f"127.0.0.1:{self.port}"
+
+    def outputs_for(self, prompt_id: str) -> dict:
+        outputs = {}
+        for n in range(self.output_nodes):
+            images = [{"filename": f"ComfyUI_{prompt_id}_{n}_{i}.png", "subfolder": "", "type": "output"}
+                      for i in range(self.images_per_task)]
+            outputs[f"out{n}"] = {"images": images}
+        return outputs
+
+    def send_event(self, client_id: str, message: dict):
+        client = self.clients.get(client_id)
+        if client is None:
+            return
+        payload = json.dumps(message).encode()
+        if len(payload) < 126:
+            header = struct.pack("!BB", 0x81, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack("!BBH", 0x81, 126, len(payload))
+        else:
+            header = struct.pack("!BBQ", 0x81, 127, len(payload))
+        conn, lock = client
+        with lock:
+            try:
+                conn.sendall(header + payload)
+            except OSError:
+                pass
+
+    def execute(self, client_id: str, prompt_id: str, prompt: dict):
+        for node_id in prompt:
+            self.send_event(client_id, {"type": "executing", "data": {"node": node_id, "prompt_id": prompt_id}})
+        time.sleep(self.latency)
+        self.send_event(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+
+class _CollectorHandler(_StubHandler):
+
+    def do_POST(self):
+        body = self.read_body()
+        if urllib.parse.urlparse(self.path).path == "/v1/traces":
+            with self.server.counters.lock:
+                self.server.exports += 1
+        self.send_bytes(b"", content_type="application/x-protobuf", bytes_in=len(body))
+
+
+class OTLPCollectorStub(_StubServer):
+    """Accepts OTLP/HTTP trace exports and counts them, standing in for an OpenTelemetry collector"""
+
+    def __init__(self):
+        super().__init__(_CollectorHandler, 0.0, 1, 0)
+        self.exports = 0
+
+    @property
+    def endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+
+def wait_for_port(port: int, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Stub server on port {port} did not start")
@@ -1,23 +1,22 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import importlib
 import json
 import logging
 import os
 import signal
 import sys
-import uuid
+import threading
 import time
-import functools
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import boto3
-from botocore.exceptions import EndpointConnectionError
-from aws_xray_sdk.core import patch_all, xray_recorder
-from aws_xray_sdk.core.models.trace_header import TraceHeader
-from modules import s3_action, sns_action, sqs_action
-from runtimes import comfyui, sdwebui
+from modules import (backend_pool, cost_model, degradation, fair_queue, health, http_action, image_utils, log_utils,
+                     s3_action, sns_action, sqs_action, status_store, task_message, time_utils, tracing,
+                     workflow_templates)
 
-# Initialize logging first so we can log X-Ray initialization attempts
 logging.basicConfig()
 logging.getLogger().setLevel(logging.ERROR)
 
@@ -32,61 +31,8 @@ if logger.handlers:
 
 # Add a single handler
 handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
 logger.addHandler(handler)
-
-# Check if X-Ray is manually disabled via environment variable
-DISABLE_XRAY = os.environ.get('DISABLE_XRAY', 'false').lower() == 'true'
-if DISABLE_XRAY:
-    logger.info("X-Ray tracing manually disabled via DISABLE_XRAY environment variable")
-    xray_enabled = False
-else:
-    # Try to initialize X-Ray SDK with retries, as the daemon might be starting up
-    MAX_XRAY_INIT_ATTEMPTS = 5
-    XRAY_RETRY_DELAY = 3  # seconds
-    xray_enabled = False
-
-    for attempt in range(MAX_XRAY_INIT_ATTEMPTS):
-        try:
-            logger.info(f"Attempting to initialize X-Ray SDK (attempt {attempt+1}/{MAX_XRAY_INIT_ATTEMPTS})")
-            patch_all()
-            xray_enabled = True
-            logger.info("X-Ray SDK initialized successfully")
-            break
-        except EndpointConnectionError:
-            logger.warning(f"Could not connect to X-Ray daemon (attempt {attempt+1}/{MAX_XRAY_INIT_ATTEMPTS})")
-            if attempt < MAX_XRAY_INIT_ATTEMPTS - 1:
-                logger.info(f"Retrying in {XRAY_RETRY_DELAY} seconds...")
-                time.sleep(XRAY_RETRY_DELAY)
-        except Exception as e:
-            logger.warning(f"Error initializing X-Ray: {str(e)} (attempt {attempt+1}/{MAX_XRAY_INIT_ATTEMPTS})")
-            if attempt < MAX_XRAY_INIT_ATTEMPTS - 1:
-                logger.info(f"Retrying in {XRAY_RETRY_DELAY} seconds...")
-                time.sleep(XRAY_RETRY_DELAY)
-
-    if not xray_enabled:
-        logger.warning("X-Ray initialization failed after all attempts. Tracing will be disabled.")
-
-# Create a decorator for safe X-Ray instrumentation
-def safe_xray_capture(name):
-    """Decorator that safely applies X-Ray instrumentation if available"""
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            if xray_enabled:
-                try:
-                    # Try to use X-Ray instrumentation
-                    with xray_recorder.in_segment(name):
-                        return func(*args, **kwargs)
-                except Exception as e:
-                    logger.warning(f"X-Ray instrumentation failed for {name}: {str(e)}")
-                    # Fall back to non-instrumented execution
-                    return func(*args, **kwargs)
-            else:
-                # X-Ray is disabled, just call the function directly
-                return func(*args, **kwargs)
-        return wrapper
-    return decorator
+log_utils.setup(logger, handler)
 
 # Get base environment variable
 aws_default_region = os.getenv("AWS_DEFAULT_REGION")
@@ -96,6 +42,10 @@ s3_bucket = os.getenv("S3_BUCKET")
 runtime_name = os.getenv("RUNTIME_NAME", "")
 api_base_url = ""
 
+# Where this agent runs, reported with every task result
+node_name = os.getenv("NODE_NAME", "")
+pod_name = os.getenv("POD_NAME", os.getenv("HOSTNAME", ""))
+
 exp_callback_when_running = os.getenv("EXP_CALLBACK_WHEN_RUNNING", "")
 
 # Check current runtime type
@@ -122,29 +72,99 @@ if runtime_type == "comfyui":
     # Change here to ComfyUI's base URL
     # You can specify any required environment variable here
 
-sqsRes = boto3.resource('sqs')
-snsRes = boto3.resource('sns')
+# Several runtime endpoints, e.g. one per GPU, can be served by one agent. Tasks run
+# concurrently, one per endpoint
+api_base_urls = [url.strip() for url in os.getenv("API_BASE_URLS", "").split(",") if url.strip()] or [api_base_url]
+backends = backend_pool.BackendPool(api_base_urls)
 
 SQS_WAIT_TIME_SECONDS = 20
-
-# For graceful shutdown
+SQS_MAX_MESSAGES = 10
+
+# Outputs up to this size are sent in the notification instead of uploaded as a .out object,
+# 0 always uploads. Capped to keep notifications within the 256 KiB SNS message limit
+INLINE_OUTPUT_MAX_BYTES = min(int(os.getenv("INLINE_OUTPUT_MAX_BYTES", "0")), 128 * 1024)
+# Seconds the presigned S3 URLs added to notifications stay valid, 0 leaves them out
+PRESIGNED_URL_EXPIRY = int(os.getenv("PRESIGNED_URL_EXPIRY", "0"))
+# SNS rejects larger messages, and a task whose result can't be published is received and run again
+SNS_MESSAGE_MAX_BYTES = 256 * 1024
+
+# For graceful shutdown: stop receiving at once and give in-flight tasks this long to
+# finish, then interrupt them and hand their messages back to the queue
+DRAIN_TIMEOUT_SECONDS = int(os.getenv("DRAIN_TIMEOUT_SECONDS", "45"))
+# Seconds queued notifications get to go out at shutdown when the drain used up its timeout
+NOTIFY_FLUSH_SECONDS = 5
 shutdown = False
 
+# Messages being processed by run_task, by message ID
+inflight = {}
+inflight_lock = threading.Lock()
+
+def load_runtime(runtime_type: str):
+    """Import only the runtime this agent serves"""
+    return importlib.import_module(f"runtimes.{runtime_type}")
+
+def init_aws_resources():
+    sqsRes = boto3.resource('sqs')
+    snsRes = boto3.resource('sns')
+    s3_action.init()
+    sns_action.get_client()
+    sqs_action.get_client()
+    http_action.init()
+    image_utils.init()
+    status_store.get_store()
+    health.mark("aws_resources_ready")
+    return sqsRes.Queue(sqs_queue_url), snsRes.Topic(sns_topic_arn)
+
+def check_backend(runtime, url: str) -> bool:
+    if runtime_type == "sdwebui":
+        ready = runtime.check_readiness(url, dynamic_sd_model)
+        model = runtime.current_models.get(url)
+    else:
+        ready = runtime.check_readiness(url)
+        model = None
+    if not ready:
+        logger.warning(f"Backend {url} failed its readiness check, serving it anyway")
+    # Backends join the pool once checked, tasks that fail on them take them out again
+    backends.set_ready(url, True, model)
+    return ready
+
+def wait_runtime_ready() -> bool:
+    runtime = load_runtime(runtime_type)
+    health.mark("runtime_imported")
+    results = {}
+    checks = [threading.Thread(target=lambda url=url: results.update({url: check_backend(runtime, url)}),
+                               name=f"readiness-{i}", daemon=True) for i, url in enumerate(api_base_urls)]
+    for check in checks:
+        check.start()
+    # Start serving with the first backend, the others join when they are ready
+    while not results and any(check.is_alive() for check in checks):
+        checks[0].join(0.1)
+    ready = any(results.values())
+    health.set_ready(ready, next((b["model"] for b in backends.status() if b["model"]), None))
+    health.mark("runtime_ready" if ready else "runtime_not_ready")
+    return ready
+
 def main():
     # Initialization:
-    # 1. Environment parameters;
-    # 2. AWS services resources(sqs/sns/s3);
+    # 1. Environment parameters, health endpoint;
+    # 2. AWS services resources(sqs/sns/s3), in parallel with
     # 3. SD API readiness check, current checkpoint cached;
+    health.start()
+    health.add_status("backends", backends.status)
+    health.add_status("notifications", sns_action.get_publisher().status)
+    if image_utils.IMAGE_PRESIZE:
+        health.add_status("image_presize", image_utils.stats)
+    tracing.init(runtime_name+"-queue-agent")
     print_env()
 
-    queue = sqsRes.Queue(sqs_queue_url)
-    topic = snsRes.Topic(sns_topic_arn)
-
-    if runtime_type == "sdwebui":
-        sdwebui.check_readiness(api_base_url, dynamic_sd_model)
-
-    if runtime_type == "comfyui":
-        comfyui.check_readiness(api_base_url)
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup") as pool:
+        resources = pool.submit(init_aws_resources)
+        readiness = pool.submit(wait_runtime_ready)
+        queue, topic = resources.result()
+        readiness.result()
+    health.mark("startup_complete")
+    cost_model.start_publisher(queue, runtime_name)
+    degradation.start(queue)
 
     # main loop
     # 1. Pull msg from sqs;
@@ -154,41 +174,179 @@ def main():
     # 5. Call SD API;
     # 6. Prepare outputs for decoding, uploading and notifying;
     # 7. Delete msg;
-    while True:
-        if shutdown:
-            logger.info('Received SIGTERM, shutting down...')
+    # Messages are only received for idle backends, so none wait in the agent
+    workers = ThreadPoolExecutor(max_workers=len(backends), thread_name_prefix="task")
+    receiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="receiver")
+    receiving = None
+    # With a tenant key, messages are held in a buffer and run in fair order instead
+    scheduler = fair_queue.FairQueue(queue) if fair_queue.TENANT_KEY else None
+    if scheduler is not None:
+        health.add_status("tenants", scheduler.status)
+    while not shutdown:
+        health.heartbeat()
+
+        if scheduler is not None:
+            receiving = schedule(scheduler, queue, topic, workers, receiver, receiving)
+            continue
+
+        slots = backends.reserve(SQS_MAX_MESSAGES, 1)
+        if slots == 0:
+            continue
+        receiving = receiver.submit(receive, queue, slots)
+        try:
+            received_messages = wait_received(receiving)
+        except Exception:
+            backends.unreserve(slots)
+            raise
+        if received_messages is None:
+            backends.unreserve(slots)
             break
-
-        received_messages = sqs_action.receive_messages(queue, 1, SQS_WAIT_TIME_SECONDS)
+        receiving = None
+        backends.unreserve(slots - len(received_messages))
 
         for message in received_messages:
-            # Process with X-Ray if enabled, otherwise just process the message directly
-            if xray_enabled:
-                try:
-                    with xray_recorder.in_segment(runtime_name+"-queue-agent") as segment:
-                        # Retrieve x-ray trace header from SQS message
-                        if "AWSTraceHeader" in message.attributes.keys():
-                            traceHeaderStr = message.attributes['AWSTraceHeader']
-                            sqsTraceHeader = TraceHeader.from_header_str(traceHeaderStr)
-                            # Update current segment to link with SQS
-                            segment.trace_id = sqsTraceHeader.root
-                            segment.parent_id = sqsTraceHeader.parent
-                            segment.sampled = sqsTraceHeader.sampled
-
-                        # Process the message within the X-Ray segment
-                        process_message(message, topic, s3_bucket, runtime_type, runtime_name, api_base_url, dynamic_sd_model if runtime_type == "sdwebui" else None)
-                except Exception as e:
-                    logger.error(f"Error with X-Ray tracing: {str(e)}. Processing message without tracing.")
-                    process_message(message, topic, s3_bucket, runtime_type, runtime_name, api_base_url, dynamic_sd_model if runtime_type == "sdwebui" else None)
-            else:
-                # Process without X-Ray tracing
-                process_message(message, topic, s3_bucket, runtime_type, runtime_name, api_base_url, dynamic_sd_model if runtime_type == "sdwebui" else None)
+            workers.submit(run_task, message, topic)
+
+    logger.info('Received SIGTERM, shutting down...')
+    drain(workers, receiving, scheduler)
+
+def schedule(scheduler, queue, topic, workers, receiver, receiving):
+    """One turn of the fair scheduling loop: start held tasks on idle backends, keep the buffer
+    filled, and wait briefly for either to change. Returns the receive call still in progress"""
+    while len(scheduler) and backends.reserve(1, 0):
+        entry = scheduler.pop()
+        if entry is None:
+            backends.unreserve(1)
+            break
+        workers.submit(run_task, entry.message, topic, entry.payload)
+    scheduler.renew()
+
+    if receiving is not None and receiving.done():
+        scheduler.add(receiving.result())
+        receiving = None
+    if receiving is None:
+        room = scheduler.room()
+        if room > 0:
+            receiving = receiver.submit(receive, queue, min(room, SQS_MAX_MESSAGES))
+
+    if len(scheduler):
+        # Woken by a backend that frees up
+        if backends.reserve(1, 0.5):
+            backends.unreserve(1)
+    elif receiving is not None:
+        try:
+            receiving.result(timeout=0.5)
+        except TimeoutError:
+            pass
+    else:
+        time.sleep(0.5)
+    return receiving
+
+def receive(queue, count):
+    """Receive up to count messages, releasing them when shutdown started during the long poll"""
+    messages = sqs_action.receive_messages(queue, count, SQS_WAIT_TIME_SECONDS)
+    if shutdown:
+        for message in messages:
+            sqs_action.release_message(message)
+        return []
+    return messages
+
+def wait_received(receiving):
+    """Messages of a receive call, None when shutdown starts while it is still polling"""
+    while True:
+        try:
+            return receiving.result(timeout=0.5)
+        except TimeoutError:
+            if shutdown:
+                return None
+
+def drain(workers, receiving=None, scheduler=None):
+    """Let in-flight tasks finish within DRAIN_TIMEOUT_SECONDS and return every other message to the queue"""
+    deadline = time.monotonic() + DRAIN_TIMEOUT_SECONDS
+    health.set_ready(False)
+    with inflight_lock:
+        logger.info(f"Draining {len(inflight)} in-flight tasks for up to {DRAIN_TIMEOUT_SECONDS}s")
+    if scheduler is not None:
+        logger.info(f"Returned {scheduler.release_all()} held messages to the queue")
+
+    # A long poll still in progress releases its messages itself when it returns
+    if receiving is not None and receiving.done() and not receiving.exception():
+        for message in receiving.result():
+            sqs_action.release_message(message)
+
+    while time.monotonic() < deadline:
+        with inflight_lock:
+            if not inflight:
+                break
+        time.sleep(0.2)
+
+    # Tasks past the deadline are interrupted unless they are already delivering their result
+    with inflight_lock:
+        abandoned = [entry for entry in inflight.values() if not entry["finishing"]]
+        for entry in abandoned:
+            entry["abandoned"] = True
+    runtime = load_runtime(runtime_type) if abandoned else None
+    for entry in abandoned:
+        logger.warning(f"Interrupting task of message {entry['message'].message_id} on {entry['url']}")
+        sqs_action.release_message(entry["message"])
+        if entry["url"]:
+            try:
+                runtime.interrupt(entry["url"])
+            except Exception as e:
+                logger.warning(f"Failed to interrupt {entry['url']}: {str(e)}")
+    # Results of finished tasks are only acknowledged once their notifications are out
+    unsent = sns_action.get_publisher().flush(max(deadline - time.monotonic(), NOTIFY_FLUSH_SECONDS))
+    if unsent:
+        logger.warning(f"{unsent} notifications not sent, their tasks will be received again")
+    workers.shutdown(wait=False)
+    image_utils.shutdown()
+    logger.info(f"Drained, {len(abandoned)} tasks returned to the queue")
+
+def run_task(message, topic, payload=None):
+    """Process a message on a worker thread with a backend from the pool"""
+    with inflight_lock:
+        inflight[message.message_id] = {"message": message, "url": None, "finishing": False, "abandoned": False}
+    try:
+        if shutdown:
+            # Received but not started before shutdown, let another agent take it right away
+            sqs_action.release_message(message)
+            return
+        process_message(message, topic, s3_bucket, runtime_type, runtime_name, api_base_url,
+                        dynamic_sd_model if runtime_type == "sdwebui" else None, backends, payload)
+    except Exception as e:
+        logger.error(f"Error processing message {message.message_id}: {str(e)}")
+    finally:
+        with inflight_lock:
+            inflight.pop(message.message_id, None)
+        backends.task_done()
+
+def set_backend(message, url: str) -> None:
+    with inflight_lock:
+        entry = inflight.get(message.message_id)
+        if entry is not None:
+            entry["url"] = url
+
+def claim_result(message) -> bool:
+    """Whether the task may deliver its result, False when the drain has given its message back"""
+    with inflight_lock:
+        entry = inflight.get(message.message_id)
+        if entry is None:
+            return True
+        if entry["abandoned"]:
+            return False
+        entry["finishing"] = True
+        return True
+
+def process_message(message, topic, s3_bucket, runtime_type, runtime_name, api_base_url, dynamic_sd_model=None,
+                    pool=None, payload=None):
+    """Process a single SQS message, on a backend from pool when given and on api_base_url otherwise.
+    payload is the task already decoded from the message, if any"""
+    timings = time_utils.start_task(sqs_action.get_queue_wait(message))
 
-def process_message(message, topic, s3_bucket, runtime_type, runtime_name, api_base_url, dynamic_sd_model=None):
-    """Process a single SQS message"""
     # Process received message
     try:
-        payload = json.loads(json.loads(message.body)['Message'])
+        if payload is None:
+            payload = task_message.decode(message)
         metadata = payload["metadata"]
         task_id = str(metadata["id"])[:64]  # Limit task ID length
 
@@ -202,75 +360,228 @@ def process_message(message, topic, s3_bucket, runtime_type, runtime_name, api_b
         else:
             prefix = str(task_id)
 
-        if "tasktype" in metadata.keys():
-            tasktype = metadata["tasktype"]
+        tasktype = metadata.get("tasktype", "")
 
         if "context" in metadata.keys():
             context = metadata["context"]
         else:
             context = {}
 
-        body = payload["content"]
-        logger.debug(body)
+        if "content" not in payload and "content_ref" not in payload:
+            raise KeyError("content")
     except Exception as e:
         logger.error(f"Error parsing message: {e}, skipping")
-        logger.debug(payload)
+        logger.debug("Message body: %s", log_utils.redact(message.body))
         sqs_action.delete_message(message)
         return
 
-    if (exp_callback_when_running.lower() == "true"):
-        sns_response = {"runtime": runtime_name,
-                    'id': task_id,
-                    'status': "running",
-                    'context': context}
+    trace_header = (message.attributes or {}).get('AWSTraceHeader')
+    with tracing.task_span(runtime_name+"-queue-agent", tasktype, trace_header), log_utils.task_context(task_id):
+        if (exp_callback_when_running.lower() == "true"):
+            sns_response = {"runtime": runtime_name,
+                        'id': task_id,
+                        'status': "running",
+                        'context': context}
 
-        sns_action.publish_message(topic, json.dumps(sns_response))
+            sns_action.publish_async(topic, json.dumps(sns_response), required=False)
 
-    # Start handling message
-    response = {}
+        status_store.update(task_id, "running", runtime=runtime_name, tasktype=tasktype,
+                            served_by={"node": node_name, "pod": pod_name})
 
-    try:
-        if runtime_type == "sdwebui":
-            response = sdwebui.handler(api_base_url, tasktype, task_id, body, dynamic_sd_model)
+        # Start handling message
+        response = {}
+        units = None
+        degraded = None
 
-        if runtime_type == "comfyui":
-            response = comfyui.handler(api_base_url, task_id, body)
-    except Exception as e:
-        logger.error(f"Error calling handler for task {task_id}: {str(e)}")
-        response = {
-            "success": False,
-            "image": [],
-            "content": '{"code": 500, "error": "Runtime handler failed"}'
-        }
-
-    result = []
-    rand = str(uuid.uuid4())[0:4]
-
-    if response["success"]:
-        idx = 0
-        if len(response["image"]) > 0:
-            for i in response["image"]:
-                idx += 1
-                result.append(s3_action.upload_file(i, s3_bucket, prefix, str(task_id)+"-"+rand+"-"+str(idx)))
-
-    output_url = s3_action.upload_file(response["content"], s3_bucket, prefix, str(task_id)+"-"+rand, ".out")
-
-    if response["success"]:
-        status = "completed"
-    else:
-        status = "failed"
+        try:
+            with time_utils.stage("content_fetch"):
+                body = task_message.get_content(payload)
+                if runtime_type == "comfyui" and workflow_templates.is_template_request(body):
+                    body = workflow_templates.render(body)
+            logger.debug("Task %s content: %s", task_id, log_utils.redact(body))
+            body, degraded = degradation.apply(tasktype, body, metadata, timings.stages.get("queue_wait"))
+            if degraded is not None:
+                logger.info(f"Task {task_id} degraded at load {degraded['load']}: {degraded['changes']}")
+
+            runtime = load_runtime(runtime_type)
+            model = task_model(runtime, body)
+            units = cost_model.work_units(tasktype, body)
+            estimated_cost = cost_model.estimate(tasktype, model, units)
+            logger.info(f"Task {task_id} estimated at {estimated_cost:.1f} GPU-seconds ({units:.1f} work units)")
+
+            backend = pool.acquire(model) if pool is not None else None
+            try:
+                url = backend.url if backend is not None else api_base_url
+                set_backend(message, url)
+                if backend is not None and len(pool) > 1:
+                    logger.info(f"Task {task_id} dispatched to {url}")
+                if runtime_type == "sdwebui":
+                    response = runtime.handler(url, tasktype, task_id, body, dynamic_sd_model, estimated_cost,
+                                               progress_reporter(topic, task_id, context))
+
+                if runtime_type == "comfyui":
+                    response = runtime.handler(url, task_id, body)
+            finally:
+                if backend is not None:
+                    pool.release(backend, response.get("success", False), response.get("model"),
+                                 response.get("backend_error", False))
+        except workflow_templates.TemplateError as e:
+            logger.error(f"Invalid template task {task_id}: {str(e)}")
+            response = {
+                "success": False,
+                "image": [],
+                "content": json.dumps({"code": 400, "error": str(e)})
+            }
+        except Exception as e:
+            logger.error(f"Error calling handler for task {task_id}: {str(e)}")
+            response = {
+                "success": False,
+                "image": [],
+                "content": '{"code": 500, "error": "Runtime handler failed"}'
+            }
 
-    sns_response = {"runtime": runtime_name,
-                    'id': task_id,
-                    'result': response["success"],
-                    'status': status,
-                    'image_url': result,
-                    'output_url': output_url,
-                    'context': context}
+        result = []
+        rand = str(uuid.uuid4())[0:4]
 
-    # Put response handler to SNS and delete message
-    sns_action.publish_message(topic, json.dumps(sns_response))
-    sqs_action.delete_message(message)
+        try:
+            if response["success"]:
+                idx = 0
+                if len(response["image"]) > 0:
+                    with time_utils.stage("upload"):
+                        for i in response["image"]:
+                            idx += 1
+                            result.append(s3_action.upload_file(i, s3_bucket, prefix, str(task_id)+"-"+rand+"-"+str(idx)))
+        finally:
+            # Large outputs arrive as temporary files
+            for i in response.get("image", []):
+                if hasattr(i, "close"):
+                    i.close()
+
+        if not claim_result(message):
+            logger.warning(f"Task {task_id} was interrupted by shutdown and returned to the queue")
+            status_store.update(task_id, "queued")
+            return
+
+        if response["success"] and units:
+            cost_model.observe(tasktype, response.get("model"), units, timings.stages.get("inference"))
+
+        task_timings = timings.to_dict()
+        served_by = {"node": node_name, "pod": pod_name, "model": response.get("model")}
+        logger.info(f"Task {task_id} timings: {task_timings}")
+
+        output = output_fields(add_task_info(response["content"], task_timings, served_by, degraded),
+                               s3_bucket, prefix, str(task_id)+"-"+rand)
+        # Downgrades are reported along with the output, in the notification and the status record
+        if degraded is not None:
+            output["degraded"] = degraded
+
+        if response["success"]:
+            status = "completed"
+        else:
+            status = "failed"
+
+        sns_response = {"runtime": runtime_name,
+                        'id': task_id,
+                        'result': response["success"],
+                        'status': status,
+                        'image_url': result,
+                        **output,
+                        'timings': task_timings,
+                        'served_by': served_by,
+                        'context': context}
+        if PRESIGNED_URL_EXPIRY > 0:
+            sns_response.update(presigned_urls(result, output.get("output_url")))
+        fit_notification(sns_response, s3_bucket, prefix, str(task_id)+"-"+rand)
+        output = {key: sns_response[key] for key in ("output", "output_url", "degraded") if key in sns_response}
+
+        status_store.update(task_id, status, image_url=result, **output,
+                            timings=task_timings, served_by=served_by)
+
+        # Notify in the background, the message is deleted once SNS has accepted the notification
+        # and is received again after its visibility timeout if that never happens
+        sns_action.publish_async(topic, json.dumps(sns_response),
+                                 on_published=lambda: sqs_action.delete_message(message))
+        health.task_done(response["success"], response.get("model"))
+
+def progress_reporter(topic, task_id: str, context):
+    """Callback publishing the progress of a running task, as a notification and in the status store"""
+    def report(progress: dict) -> None:
+        status_store.update(task_id, "running", progress=progress)
+        sns_response = {"runtime": runtime_name,
+                        'id': task_id,
+                        'status': "running",
+                        'progress': progress,
+                        'context': context}
+        sns_action.publish_async(topic, json.dumps(sns_response), required=False)
+    return report
+
+def task_model(runtime, body: dict) -> str:
+    """Model a task asks for, None when it runs with whatever is loaded"""
+    if runtime_type == "comfyui":
+        return runtime.get_model_names(body)
+    return (body.get("alwayson_scripts") or {}).get("sd_model_checkpoint") or None
+
+def add_task_info(content: str, task_timings: dict, served_by: dict, degraded: dict = None) -> str:
+    """Attach timings, serving details and downgrades to the JSON content written to the .out object"""
+    try:
+        output = json.loads(content)
+    except (TypeError, ValueError):
+        output = None
+    if not isinstance(output, dict):
+        output = {"content": output if output is not None else content}
+    output["timings"] = task_timings
+    output["served_by"] = served_by
+    if degraded is not None:
+        output["degraded"] = degraded
+    return json.dumps(output)
+
+def output_fields(output: str, s3_bucket: str, prefix: str, file_name: str) -> dict:
+    """Task output as notification fields: inline when small enough, as an S3 URL otherwise"""
+    if len(output) <= INLINE_OUTPUT_MAX_BYTES:
+        return {"output": json.loads(output)}
+    return {"output_url": s3_action.upload_file(output, s3_bucket, prefix, file_name, ".out")}
+
+def notification_size(notification: dict) -> int:
+    return len(json.dumps(notification).encode())
+
+def fit_notification(notification: dict, s3_bucket: str, prefix: str, file_name: str) -> dict:
+    """Keep a result notification within SNS_MESSAGE_MAX_BYTES: the inline output is uploaded,
+    then the presigned image URLs are left out, then the image URLs are listed in an S3 object"""
+    if notification_size(notification) <= SNS_MESSAGE_MAX_BYTES:
+        return notification
+    task_id = notification.get("id")
+    if "output" in notification:
+        output_url = s3_action.upload_file(json.dumps(notification.pop("output")), s3_bucket, prefix, file_name, ".out")
+        notification["output_url"] = output_url
+        if PRESIGNED_URL_EXPIRY > 0:
+            urls = presigned_urls([], output_url)
+            if "output_presigned_url" in urls:
+                notification["output_presigned_url"] = urls["output_presigned_url"]
+        logger.warning(f"Task {task_id} output uploaded to keep its notification within the SNS limit")
+    if notification_size(notification) > SNS_MESSAGE_MAX_BYTES and "image_presigned_url" in notification:
+        del notification["image_presigned_url"]
+        logger.warning(f"Task {task_id} presigned image URLs left out to keep its notification within the SNS limit")
+    if notification_size(notification) > SNS_MESSAGE_MAX_BYTES and notification.get("image_url"):
+        notification["image_list_url"] = s3_action.upload_file(json.dumps(notification["image_url"]), s3_bucket,
+                                                               prefix, file_name+"-images", ".json")
+        notification["image_url"] = []
+        logger.warning(f"Task {task_id} image URLs listed in {notification['image_list_url']} "
+                       f"to keep its notification within the SNS limit")
+    if notification_size(notification) > SNS_MESSAGE_MAX_BYTES:
+        logger.error(f"Task {task_id} notification is {notification_size(notification)} bytes, "
+                     f"more than the SNS limit of {SNS_MESSAGE_MAX_BYTES}")
+    return notification
+
+def presigned_urls(image_urls: list, output_url: str = None) -> dict:
+    """Presigned GET URLs of task results, so that clients can fetch them without S3 credentials"""
+    try:
+        urls = {"image_presigned_url": [s3_action.presign(url, PRESIGNED_URL_EXPIRY) for url in image_urls]}
+        if output_url:
+            urls["output_presigned_url"] = s3_action.presign(output_url, PRESIGNED_URL_EXPIRY)
+        return urls
+    except Exception as e:
+        logger.warning(f"Failed to presign result URLs: {str(e)}")
+        return {}
 
 def print_env() -> None:
     logger.info(f'AWS_DEFAULT_REGION={aws_default_region}')
@@ -279,8 +590,24 @@ def print_env() -> None:
     logger.info(f'S3_BUCKET=***masked***')
     logger.info(f'RUNTIME_TYPE={runtime_type}')
     logger.info(f'RUNTIME_NAME={runtime_name}')
-    logger.info(f'X-Ray Tracing: {"Disabled" if DISABLE_XRAY else "Enabled"}')
-    logger.info(f'X-Ray Status: {"Active" if xray_enabled else "Inactive"}')
+    logger.info(f'BACKENDS={len(api_base_urls)}')
+    logger.info(f'DRAIN_TIMEOUT_SECONDS={DRAIN_TIMEOUT_SECONDS}')
+    logger.info(f'INLINE_OUTPUT_MAX_BYTES={INLINE_OUTPUT_MAX_BYTES}')
+    logger.info(f'PRESIGNED_URL_EXPIRY={PRESIGNED_URL_EXPIRY}')
+    logger.info(f'IMAGE_PRESIZE={image_utils.IMAGE_PRESIZE}')
+    logger.info(f'TENANT_KEY={fair_queue.TENANT_KEY}')
+    logger.info(f'WORKFLOW_TEMPLATE_PATH={workflow_templates.WORKFLOW_TEMPLATE_PATH}')
+    logger.info(f'DEGRADE_QUEUE_WAIT_SECONDS={degradation.DEGRADE_QUEUE_WAIT_SECONDS}')
+    logger.info(f'DEGRADE_BACKLOG_SECONDS={degradation.DEGRADE_BACKLOG_SECONDS}')
+    if runtime_type == "sdwebui":
+        sdwebui = load_runtime(runtime_type)
+        logger.info(f'PROGRESS_POLL_SECONDS={sdwebui.PROGRESS_POLL_SECONDS}')
+        logger.info(f'PROGRESS_STALL_SECONDS={sdwebui.PROGRESS_STALL_SECONDS}')
+    logger.info(f'TRACING_EXPORTER={tracing.TRACING_EXPORTER}')
+    logger.info(f'TRACE_SAMPLE_RATE={tracing.TRACE_SAMPLE_RATE}')
+    logger.info(f'HEALTH_PORT={health.HEALTH_PORT}')
+    logger.info(f'STATUS_STORE={status_store.STATUS_STORE}')
+    logger.info(f'BACKLOG_METRIC_INTERVAL={cost_model.BACKLOG_METRIC_INTERVAL}')
 
 def signalHandler(signum, frame):
     global shutdown
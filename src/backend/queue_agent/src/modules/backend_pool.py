@@ -0,0 +1,168 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import os
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger("queue-agent")
+
+# Consecutive tasks failed on connecting to or waiting for a backend after which a backend is taken out of rotation
+BACKEND_MAX_FAILURES = int(os.getenv("BACKEND_MAX_FAILURES", "3"))
+# Seconds before an unhealthy backend is given another task
+BACKEND_RETRY_SECONDS = int(os.getenv("BACKEND_RETRY_SECONDS", "60"))
+# Failures that point at the backend rather than the task, such as a refused connection or a
+# timeout. Others, e.g. a 422 for a bad payload, show the backend is answering
+BACKEND_FAULTS = (ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+def backend_fault(exception: BaseException, faults: tuple = ()) -> bool:
+    """Whether a task failed because of its backend, also when re-raised with raise ... from.
+    Runtimes pass their own connection and timeout exceptions as faults"""
+    while exception is not None:
+        if isinstance(exception, BACKEND_FAULTS + faults):
+            return True
+        exception = exception.__cause__
+    return False
+
+class Backend(object):
+    """One runtime API endpoint, used by one task at a time"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.ready = False
+        self.busy = False
+        self.model = None
+        self.tasks = 0
+        self.failures = 0
+        self.busy_seconds = 0.0
+        self.started = None
+        self.retry_at = None
+
+    def available(self, now: float) -> bool:
+        return self.ready and not self.busy and (self.retry_at is None or now >= self.retry_at)
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "ready": self.ready,
+            "busy": self.busy,
+            "healthy": self.retry_at is None,
+            "model": self.model,
+            "tasks": self.tasks,
+            "busy_seconds": round(self.busy_seconds, 1),
+        }
+
+class BackendPool(object):
+    """Dispatches tasks to idle backends.
+
+    The main loop reserves a slot for each message it receives, so it never takes more
+    messages than there are idle backends; each task then acquires a backend, preferring
+    one with its model loaded, and the least busy one otherwise.
+    """
+
+    def __init__(self, urls: list):
+        self.backends = [Backend(url) for url in urls]
+        self.reserved = 0
+        self.cond = threading.Condition()
+        # Whether the task handled by the current thread has acquired a backend
+        self._local = threading.local()
+
+    def __len__(self):
+        return len(self.backends)
+
+    def _available(self) -> list:
+        now = time.monotonic()
+        return [b for b in self.backends if b.available(now)]
+
+    def set_ready(self, url: str, ready: bool, model: str = None) -> None:
+        with self.cond:
+            for backend in self.backends:
+                if backend.url == url:
+                    backend.ready = ready
+                    if model is not None:
+                        backend.model = model
+            self.cond.notify_all()
+
+    def any_ready(self) -> bool:
+        with self.cond:
+            return any(b.ready for b in self.backends)
+
+    def reserve(self, max_count: int, timeout: float) -> int:
+        """Reserve up to max_count idle backends, waiting up to timeout for the first one"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                free = len(self._available()) - self.reserved
+                if free > 0:
+                    count = min(free, max_count)
+                    self.reserved += count
+                    return count
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return 0
+                # Unhealthy backends come back on their own, wake up to notice
+                self.cond.wait(min(remaining, 1))
+
+    def unreserve(self, count: int) -> None:
+        with self.cond:
+            self.reserved = max(self.reserved - count, 0)
+            self.cond.notify_all()
+
+    def acquire(self, model: str = None, reserved: bool = True) -> Backend:
+        """Take an idle backend for one task, blocking until one is available"""
+        with self.cond:
+            while True:
+                candidates = self._available()
+                if candidates:
+                    break
+                self.cond.wait(1)
+            affine = [b for b in candidates if model and b.model == model]
+            backend = min(affine or candidates, key=lambda b: (b.busy_seconds, b.tasks))
+            backend.busy = True
+            backend.started = time.monotonic()
+            if reserved:
+                self.reserved = max(self.reserved - 1, 0)
+                self._local.acquired = True
+            return backend
+
+    def task_done(self) -> None:
+        """Return the reservation of a task that ended before acquiring a backend"""
+        if not getattr(self._local, "acquired", False):
+            self.unreserve(1)
+        self._local.acquired = False
+
+    def release(self, backend: Backend, success: bool, model: str = None, backend_error: bool = False) -> None:
+        """Return a backend after a task. Only failures of the backend itself, backend_error,
+        count toward taking it out of rotation, and the last available backend is never taken out"""
+        with self.cond:
+            backend.busy = False
+            backend.tasks += 1
+            backend.busy_seconds += time.monotonic() - backend.started
+            if model is not None:
+                backend.model = model
+            if success or not backend_error:
+                if backend.retry_at is not None:
+                    logger.info(f"Backend {backend.url} recovered")
+                backend.failures = 0
+                backend.retry_at = None
+            else:
+                backend.failures += 1
+                if backend.failures >= BACKEND_MAX_FAILURES:
+                    now = time.monotonic()
+                    if any(b is not backend and b.ready and (b.retry_at is None or now >= b.retry_at)
+                           for b in self.backends):
+                        backend.retry_at = now + BACKEND_RETRY_SECONDS
+                        logger.warning(f"Backend {backend.url} failed {backend.failures} tasks in a row, "
+                                       f"retrying in {BACKEND_RETRY_SECONDS}s")
+                    else:
+                        # Taking it out would leave the agent without a backend to receive work for
+                        logger.warning(f"Backend {backend.url} failed {backend.failures} tasks in a row, "
+                                       f"keeping it as the last available backend")
+            self.cond.notify_all()
+
+    def status(self) -> list:
+        with self.cond:
+            return [b.to_dict() for b in self.backends]
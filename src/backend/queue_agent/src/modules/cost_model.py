@@ -0,0 +1,159 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import os
+import threading
+import time
+
+import boto3
+
+logger = logging.getLogger("queue-agent")
+
+# One work unit is one sampling step of one 512x512 image
+BASE_PIXELS = 512 * 512
+# Initial GPU-seconds per work unit, replaced by measured inference times as tasks complete
+COST_SECONDS_PER_UNIT = float(os.getenv("COST_SECONDS_PER_UNIT", "0.05"))
+# Weight of a new measurement in the moving averages
+COST_SMOOTHING = float(os.getenv("COST_SMOOTHING", "0.2"))
+# Work units assumed for queued tasks before any task has been received
+COST_DEFAULT_TASK_UNITS = float(os.getenv("COST_DEFAULT_TASK_UNITS", "20"))
+# Seconds between backlog metric updates, 0 disables the metric
+BACKLOG_METRIC_INTERVAL = int(os.getenv("BACKLOG_METRIC_INTERVAL", "0"))
+BACKLOG_METRIC_NAMESPACE = os.getenv("BACKLOG_METRIC_NAMESPACE", "SDonEKS")
+BACKLOG_METRIC_NAME = "BacklogGPUSeconds"
+
+SAMPLER_NODES = ['KSampler', 'KSamplerAdvanced', 'SamplerCustom', 'SamplerCustomAdvanced']
+
+_lock = threading.Lock()
+# Seconds per work unit by (task type, model), and by task type alone as fallback
+_seconds_per_unit = {}
+# Moving average of the estimated cost of received tasks, stands in for the queued ones
+_mean_task_cost = None
+
+def work_units(tasktype: str, payload: dict) -> float:
+    """Relative amount of GPU work in a task, from its parameters"""
+    try:
+        if tasktype == 'pipeline':
+            units = _workflow_units(payload)
+        elif tasktype in ('text-to-image', 'image-to-image'):
+            units = _sdwebui_units(tasktype, payload)
+        elif tasktype == 'extra-batch-image':
+            units = len(payload.get('imageList') or []) or 1
+        else:
+            units = 1
+    except Exception as e:
+        logger.debug(f"Failed to estimate work units: {str(e)}")
+        units = 1
+    return max(float(units), 1.0)
+
+def _sdwebui_units(tasktype: str, payload: dict) -> float:
+    steps = int(payload.get('steps') or 20)
+    width = int(payload.get('width') or 512)
+    height = int(payload.get('height') or 512)
+    images = int(payload.get('batch_size') or 1) * int(payload.get('n_iter') or 1)
+    denoise = float(payload.get('denoising_strength') or 0.75)
+    if tasktype == 'image-to-image':
+        # SD Web UI only runs the denoised fraction of the steps
+        steps = max(int(steps * denoise), 1)
+    units = steps * width * height / BASE_PIXELS
+    if tasktype == 'text-to-image' and payload.get('enable_hr'):
+        hr_steps = int(payload.get('hr_second_pass_steps') or 0) or steps
+        hr_width = int(payload.get('hr_resize_x') or 0) or width * float(payload.get('hr_scale') or 2)
+        hr_height = int(payload.get('hr_resize_y') or 0) or height * float(payload.get('hr_scale') or 2)
+        units += max(int(hr_steps * denoise), 1) * hr_width * hr_height / BASE_PIXELS
+    return units * images
+
+def _workflow_units(workflow: dict) -> float:
+    units = 0.0
+    for node in workflow.values():
+        if not isinstance(node, dict) or node.get('class_type') not in SAMPLER_NODES:
+            continue
+        inputs = node.get('inputs', {})
+        steps = inputs.get('steps')
+        steps = steps if isinstance(steps, (int, float)) else 20
+        denoise = inputs.get('denoise')
+        denoise = denoise if isinstance(denoise, (int, float)) else 1.0
+        pixels, batch = _latent_size(workflow, inputs.get('latent_image'))
+        units += max(steps * denoise, 1) * pixels / BASE_PIXELS * batch
+    return units
+
+def _latent_size(workflow: dict, link, depth: int = 0) -> tuple:
+    """Pixels and batch size of the latent a node input is linked to"""
+    if not isinstance(link, list) or not link or depth > 10:
+        return BASE_PIXELS, 1
+    node = workflow.get(str(link[0]))
+    inputs = node.get('inputs', {}) if isinstance(node, dict) else {}
+    width, height = inputs.get('width'), inputs.get('height')
+    if isinstance(width, (int, float)) and isinstance(height, (int, float)):
+        batch = inputs.get('batch_size')
+        return width * height, batch if isinstance(batch, int) else 1
+    pixels, batch = _latent_size(workflow, inputs.get('samples', inputs.get('pixels')), depth + 1)
+    scale = inputs.get('scale_by')
+    if isinstance(scale, (int, float)):
+        pixels *= scale * scale
+    return pixels, batch
+
+def _average(old: float, new: float) -> float:
+    return new if old is None else old + COST_SMOOTHING * (new - old)
+
+def seconds_per_unit(tasktype: str, model: str = None) -> float:
+    with _lock:
+        return _seconds_per_unit.get((tasktype, model), _seconds_per_unit.get((tasktype, None), COST_SECONDS_PER_UNIT))
+
+def estimate(tasktype: str, model: str, units: float) -> float:
+    """Estimated GPU-seconds of a received task, also feeds the backlog estimate"""
+    global _mean_task_cost
+    cost = units * seconds_per_unit(tasktype, model)
+    with _lock:
+        _mean_task_cost = _average(_mean_task_cost, cost)
+    return cost
+
+def observe(tasktype: str, model: str, units: float, seconds: float) -> None:
+    """Learn from the measured inference time of a completed task"""
+    if not seconds or seconds <= 0:
+        return
+    rate = seconds / units
+    with _lock:
+        for key in ((tasktype, model), (tasktype, None)):
+            _seconds_per_unit[key] = _average(_seconds_per_unit.get(key), rate)
+
+def mean_task_cost() -> float:
+    with _lock:
+        if _mean_task_cost is not None:
+            return _mean_task_cost
+    return COST_DEFAULT_TASK_UNITS * COST_SECONDS_PER_UNIT
+
+def backlog_seconds(queue) -> float:
+    """GPU-seconds of work waiting in the queue"""
+    queue.load()
+    return int(queue.attributes.get('ApproximateNumberOfMessages', 0)) * mean_task_cost()
+
+def _publish_loop(queue, runtime_name: str, interval: int):
+    cloudwatch = boto3.client('cloudwatch')
+    while True:
+        try:
+            value = backlog_seconds(queue)
+            cloudwatch.put_metric_data(
+                Namespace=BACKLOG_METRIC_NAMESPACE,
+                MetricData=[{
+                    'MetricName': BACKLOG_METRIC_NAME,
+                    'Dimensions': [{'Name': 'Runtime', 'Value': runtime_name}],
+                    'Value': value,
+                    'Unit': 'Seconds'
+                }]
+            )
+            logger.debug(f"Published {BACKLOG_METRIC_NAME}={value:.1f}")
+        except Exception as e:
+            logger.warning(f"Failed to publish {BACKLOG_METRIC_NAME}: {str(e)}")
+        time.sleep(interval)
+
+def start_publisher(queue, runtime_name: str, interval: int = BACKLOG_METRIC_INTERVAL):
+    """Publish the backlog in GPU-seconds to CloudWatch every `interval` seconds in a background thread"""
+    if interval <= 0:
+        return None
+    thread = threading.Thread(target=_publish_loop, args=(queue, runtime_name, interval),
+                              name="backlog-metric", daemon=True)
+    thread.start()
+    logger.info(f"Publishing {BACKLOG_METRIC_NAMESPACE}/{BACKLOG_METRIC_NAME} every {interval}s")
+    return thread
@@ -0,0 +1,140 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import os
+import threading
+import time
+
+from . import cost_model
+
+logger = logging.getLogger("queue-agent")
+
+# Load is measured against these thresholds, a task is degraded once either is exceeded:
+# its own queue wait in seconds, and the queue's backlog in GPU-seconds. 0 ignores the signal,
+# and with both at 0 tasks always run as requested
+DEGRADE_QUEUE_WAIT_SECONDS = float(os.getenv("DEGRADE_QUEUE_WAIT_SECONDS", "0"))
+DEGRADE_BACKLOG_SECONDS = float(os.getenv("DEGRADE_BACKLOG_SECONDS", "0"))
+# Seconds between backlog checks
+DEGRADE_BACKLOG_INTERVAL = int(os.getenv("DEGRADE_BACKLOG_INTERVAL", "15"))
+# Load, as a multiple of the thresholds, from which hires fix is turned off
+HIRES_OFF_LOAD = 2.0
+
+# Generation task types and the ComfyUI sampler nodes whose steps can be lowered safely,
+# KSamplerAdvanced has step ranges that depend on them
+TASK_TYPES = ('text-to-image', 'image-to-image', 'pipeline')
+STEP_SAMPLER_NODES = ['KSampler']
+
+_backlog = None
+_lock = threading.Lock()
+
+def enabled() -> bool:
+    return DEGRADE_QUEUE_WAIT_SECONDS > 0 or DEGRADE_BACKLOG_SECONDS > 0
+
+def _backlog_loop(queue, interval: int):
+    global _backlog
+    while True:
+        try:
+            value = cost_model.backlog_seconds(queue)
+        except Exception as e:
+            logger.warning(f"Failed to read the backlog for degradation: {str(e)}")
+            value = None
+        with _lock:
+            _backlog = value
+        time.sleep(interval)
+
+def start(queue, interval: int = DEGRADE_BACKLOG_INTERVAL):
+    """Track the backlog in a background thread when it is one of the load signals"""
+    if DEGRADE_BACKLOG_SECONDS <= 0:
+        return None
+    thread = threading.Thread(target=_backlog_loop, args=(queue, interval), name="degrade-backlog", daemon=True)
+    thread.start()
+    return thread
+
+def load(queue_wait: float = None) -> float:
+    """Current load as a multiple of the thresholds, 1 and above degrades tasks"""
+    with _lock:
+        backlog = _backlog
+    values = []
+    if DEGRADE_QUEUE_WAIT_SECONDS > 0 and queue_wait is not None:
+        values.append(queue_wait / DEGRADE_QUEUE_WAIT_SECONDS)
+    if DEGRADE_BACKLOG_SECONDS > 0 and backlog is not None:
+        values.append(backlog / DEGRADE_BACKLOG_SECONDS)
+    return max(values, default=0.0)
+
+def limits_of(metadata: dict) -> dict:
+    """What the client allows to be degraded, from metadata.degrade. Empty when it didn't opt in"""
+    limits = metadata.get("degrade") if isinstance(metadata, dict) else None
+    if not isinstance(limits, dict):
+        return {}
+    result = {}
+    min_steps = limits.get("min_steps")
+    if isinstance(min_steps, int) and not isinstance(min_steps, bool) and min_steps >= 1:
+        result["min_steps"] = min_steps
+    if limits.get("drop_hires") is True:
+        result["drop_hires"] = True
+    if isinstance(limits.get("sampler"), str) and limits["sampler"]:
+        result["sampler"] = limits["sampler"]
+    return result
+
+def _steps(requested, load: float, min_steps: int):
+    """Steps scaled down with the load, never below min_steps or above the request"""
+    if not isinstance(requested, int) or isinstance(requested, bool) or requested <= min_steps:
+        return requested
+    return max(min_steps, int(round(requested / load)))
+
+def _change(changes: dict, target: dict, key: str, value, add: bool = False) -> None:
+    """Set target[key] to value and record it, fields the request leaves out only if add"""
+    if value is None or (key not in target and not add):
+        return
+    if target.get(key) != value:
+        changes[key] = [target.get(key), value]
+        target[key] = value
+
+def apply(tasktype: str, body: dict, metadata: dict, queue_wait: float = None) -> tuple:
+    """Degrade a generation task within the limits its client opted into, scaled with the load.
+
+    Returns the content to run and a record of the downgrades, None when nothing was changed.
+    Changes are recorded as {field: [requested, used]}
+    """
+    if not enabled() or tasktype not in TASK_TYPES or not isinstance(body, dict):
+        return body, None
+    limits = limits_of(metadata)
+    if not limits:
+        return body, None
+    current = load(queue_wait)
+    if current < 1:
+        return body, None
+
+    changes = {}
+    if tasktype == 'pipeline':
+        body = dict(body)
+        for node_id, node in body.items():
+            if not isinstance(node, dict) or node.get('class_type') not in cost_model.SAMPLER_NODES:
+                continue
+            # Nodes may be shared with a cached workflow template
+            node = dict(node)
+            node['inputs'] = dict(node.get('inputs') or {})
+            node_changes = {}
+            if "min_steps" in limits and node['class_type'] in STEP_SAMPLER_NODES:
+                _change(node_changes, node['inputs'], 'steps',
+                        _steps(node['inputs'].get('steps'), current, limits["min_steps"]))
+            if "sampler" in limits:
+                _change(node_changes, node['inputs'], 'sampler_name', limits["sampler"])
+            for key, value in node_changes.items():
+                changes[f"{node_id}.{key}"] = value
+            body[node_id] = node
+    else:
+        if "min_steps" in limits:
+            _change(changes, body, 'steps', _steps(body.get('steps'), current, limits["min_steps"]))
+            if body.get('hr_second_pass_steps'):
+                _change(changes, body, 'hr_second_pass_steps',
+                        _steps(body['hr_second_pass_steps'], current, limits["min_steps"]))
+        if "sampler" in limits:
+            _change(changes, body, 'sampler_name', limits["sampler"], add=True)
+        if limits.get("drop_hires") and body.get('enable_hr') and current >= HIRES_OFF_LOAD:
+            _change(changes, body, 'enable_hr', False)
+
+    if not changes:
+        return body, None
+    return body, {"load": round(current, 2), "changes": changes}
@@ -0,0 +1,250 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from . import cost_model, sqs_action, task_message
+
+logger = logging.getLogger("queue-agent")
+
+# Task metadata field identifying the tenant, e.g. "prefix" or "context.team". Values are cut
+# at the first "/", so prefixes like "team-a/renders" belong to "team-a". Empty disables
+# fair scheduling and tasks are run in the order they are received
+TENANT_KEY = os.getenv("TENANT_KEY", "")
+# Relative share of the GPU time per tenant, e.g. "team-a=3,team-b=1". Others get 1
+TENANT_WEIGHTS = os.getenv("TENANT_WEIGHTS", "")
+# Messages held by the agent to choose from
+TENANT_PREFETCH = int(os.getenv("TENANT_PREFETCH", "20"))
+# Messages of one tenant held at most, further ones are put back for a while so that the
+# agent keeps seeing the other tenants' tasks behind a large batch
+TENANT_MAX_BUFFERED = int(os.getenv("TENANT_MAX_BUFFERED", str(max(TENANT_PREFETCH // 2, 1))))
+# Seconds a put back message stays invisible
+TENANT_DEFER_SECONDS = int(os.getenv("TENANT_DEFER_SECONDS", "30"))
+# Visibility timeout of held messages, renewed while they wait
+TENANT_VISIBILITY_SECONDS = int(os.getenv("TENANT_VISIBILITY_SECONDS", "600"))
+
+DEFAULT_TENANT = "default"
+# GPU-seconds, the least a task is estimated at and a turn's credit is based on, so that
+# every turn gets a tenant closer to its next task before the cost model has a rate
+MIN_TASK_COST = 0.001
+# Exponentially weighted average of the queue wait reported per tenant
+WAIT_SMOOTHING = 0.2
+
+def parse_weights(value: str) -> dict:
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if not name.strip():
+            continue
+        try:
+            weights[name.strip()] = float(weight)
+        except ValueError:
+            weights[name.strip()] = 0
+        if weights[name.strip()] <= 0:
+            logger.warning(f"Ignoring invalid weight in TENANT_WEIGHTS: {item}")
+            del weights[name.strip()]
+    return weights
+
+def tenant_of(payload: dict, key: str = TENANT_KEY) -> str:
+    """Tenant of a task from the metadata field named by key"""
+    value = (payload or {}).get("metadata", {})
+    for part in key.split("."):
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                return DEFAULT_TENANT
+        if not isinstance(value, dict):
+            return DEFAULT_TENANT
+        value = value.get(part)
+    if value is None or isinstance(value, (dict, list)):
+        return DEFAULT_TENANT
+    return str(value).strip("/").split("/")[0] or DEFAULT_TENANT
+
+def task_cost(payload: dict) -> float:
+    """Estimated GPU-seconds of a task, the average task when its content is in S3"""
+    try:
+        tasktype = payload["metadata"].get("tasktype", "")
+        if "content" in payload:
+            units = cost_model.work_units(tasktype, payload["content"])
+            return max(units * cost_model.seconds_per_unit(tasktype), MIN_TASK_COST)
+    except Exception:
+        pass
+    return max(cost_model.mean_task_cost(), MIN_TASK_COST)
+
+class Entry(object):
+    __slots__ = ("message", "payload", "cost", "held_at", "extended_at")
+
+    def __init__(self, message, payload: dict, cost: float):
+        self.message = message
+        self.payload = payload
+        self.cost = cost
+        self.held_at = time.monotonic()
+        self.extended_at = self.held_at
+
+class Tenant(object):
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.entries = collections.deque()
+        self.deficit = 0.0
+        self.turn = False
+        self.dispatched = 0
+        self.deferred = 0
+        self.gpu_seconds = 0.0
+        self.mean_wait = None
+        self.max_wait = 0.0
+
+    def to_dict(self) -> dict:
+        oldest = sqs_action.get_queue_wait(self.entries[0].message) if self.entries else None
+        return {
+            "weight": self.weight,
+            "held": len(self.entries),
+            "oldest_wait_seconds": round(oldest, 1) if oldest is not None else None,
+            "dispatched": self.dispatched,
+            "deferred": self.deferred,
+            "estimated_gpu_seconds": round(self.gpu_seconds, 1),
+            "mean_wait_seconds": round(self.mean_wait, 1) if self.mean_wait is not None else None,
+            "max_wait_seconds": round(self.max_wait, 1),
+        }
+
+class FairQueue(object):
+    """Prefetch buffer that hands out tasks by deficit round-robin across tenants.
+
+    Each tenant with waiting tasks takes turns. A turn adds its weight times the mean task
+    cost to the tenant's deficit, and the tenant's tasks are dispatched while their estimated
+    GPU-seconds fit in it. Over time each tenant with work gets GPU time in proportion to its
+    weight, however many tasks the others have queued.
+    """
+
+    def __init__(self, queue, weights: dict = None):
+        self.queue = queue
+        self.weights = parse_weights(TENANT_WEIGHTS) if weights is None else weights
+        self.tenants = {}
+        self.active = collections.deque()
+        self.held = 0
+        self.receive_after = 0.0
+        self.backoff = 1.0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return self.held
+
+    def room(self) -> int:
+        """Messages to receive to fill the buffer, 0 while backing off after deferring them all"""
+        with self.lock:
+            if time.monotonic() < self.receive_after:
+                return 0
+            return max(TENANT_PREFETCH - self.held, 0)
+
+    def _tenant(self, name: str) -> Tenant:
+        tenant = self.tenants.get(name)
+        if tenant is None:
+            tenant = Tenant(name, self.weights.get(name, 1.0))
+            self.tenants[name] = tenant
+        return tenant
+
+    def add(self, messages: list) -> None:
+        """Hold received messages, putting back those of tenants that already have enough held"""
+        held, deferred = [], []
+        with self.lock:
+            for message in messages:
+                try:
+                    payload = task_message.decode(message)
+                except Exception:
+                    # Left for process_message to report
+                    payload = None
+                tenant = self._tenant(tenant_of(payload))
+                if len(tenant.entries) >= TENANT_MAX_BUFFERED:
+                    tenant.deferred += 1
+                    deferred.append(message)
+                    continue
+                if not tenant.entries:
+                    self.active.append(tenant.name)
+                tenant.entries.append(Entry(message, payload, task_cost(payload) if payload else 0.0))
+                held.append(message)
+                self.held += 1
+            if held or not deferred:
+                self.backoff = 1.0
+            else:
+                # Everything received was put back, the queue holds little else right now
+                self.receive_after = time.monotonic() + self.backoff
+                self.backoff = min(self.backoff * 2, TENANT_DEFER_SECONDS)
+        sqs_action.change_visibility_batch(self.queue, held, TENANT_VISIBILITY_SECONDS)
+        sqs_action.change_visibility_batch(self.queue, deferred, TENANT_DEFER_SECONDS)
+        if deferred:
+            logger.debug(f"Put back {len(deferred)} messages of tenants with {TENANT_MAX_BUFFERED} tasks held")
+
+    def pop(self) -> Entry:
+        """Next task to run, None when the buffer is empty"""
+        # 0 with COST_SECONDS_PER_UNIT=0 until a task has been observed
+        quantum = max(cost_model.mean_task_cost(), MIN_TASK_COST)
+        with self.lock:
+            while self.active:
+                tenant = self.tenants[self.active[0]]
+                if not tenant.turn:
+                    tenant.deficit += quantum * tenant.weight
+                    tenant.turn = True
+                entry = tenant.entries[0]
+                if entry.cost <= tenant.deficit:
+                    tenant.entries.popleft()
+                    tenant.deficit -= entry.cost
+                    if not tenant.entries:
+                        # No credit is saved up while a tenant has nothing waiting
+                        tenant.deficit = 0.0
+                        tenant.turn = False
+                        self.active.popleft()
+                    self.held -= 1
+                    self._dispatched(tenant, entry)
+                    break
+                tenant.turn = False
+                self.active.rotate(-1)
+            else:
+                return None
+        if time.monotonic() - entry.extended_at > TENANT_VISIBILITY_SECONDS / 2:
+            sqs_action.change_visibility_batch(self.queue, [entry.message], TENANT_VISIBILITY_SECONDS)
+        return entry
+
+    def _dispatched(self, tenant: Tenant, entry: Entry) -> None:
+        tenant.dispatched += 1
+        tenant.gpu_seconds += entry.cost
+        wait = sqs_action.get_queue_wait(entry.message)
+        if wait is not None:
+            tenant.mean_wait = wait if tenant.mean_wait is None else tenant.mean_wait + WAIT_SMOOTHING * (wait - tenant.mean_wait)
+            tenant.max_wait = max(tenant.max_wait, wait)
+
+    def renew(self) -> None:
+        """Extend the visibility of messages held for half their visibility timeout"""
+        now = time.monotonic()
+        with self.lock:
+            due = [e for t in self.tenants.values() for e in t.entries
+                   if now - e.extended_at > TENANT_VISIBILITY_SECONDS / 2]
+            for entry in due:
+                entry.extended_at = now
+        sqs_action.change_visibility_batch(self.queue, [e.message for e in due], TENANT_VISIBILITY_SECONDS)
+
+    def release_all(self) -> int:
+        """Return every held message to the queue"""
+        with self.lock:
+            messages = [e.message for t in self.tenants.values() for e in t.entries]
+            for tenant in self.tenants.values():
+                tenant.entries.clear()
+                tenant.deficit = 0.0
+                tenant.turn = False
+            self.active.clear()
+            self.held = 0
+        sqs_action.change_visibility_batch(self.queue, messages, 0)
+        return len(messages)
+
+    def status(self) -> dict:
+        """Per tenant counters and queue wait for the status endpoint"""
+        with self.lock:
+            return {"key": TENANT_KEY, "held": self.held,
+                    "tenants": {name: t.to_dict() for name, t in self.tenants.items()}}
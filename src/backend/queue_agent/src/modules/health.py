@@ -0,0 +1,124 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("queue-agent")
+
+# Port of the probe endpoint, 0 disables it
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "8081"))
+# Main loop is considered hung when it has not completed an iteration for this long
+LIVENESS_TIMEOUT_SECONDS = int(os.getenv("LIVENESS_TIMEOUT_SECONDS", "900"))
+
+_started = time.monotonic()
+_lock = threading.Lock()
+_state = {
+    "ready": False,
+    "model": None,
+    "tasks": 0,
+}
+# Startup events as (name, seconds since the agent started)
+_timeline = []
+# Extra sections of /status, by name
+_status_providers = {}
+_last_heartbeat = None
+
+def mark(event: str) -> float:
+    """Record a startup event on the timeline and return its offset in seconds"""
+    offset = round(time.monotonic() - _started, 3)
+    with _lock:
+        _timeline.append((event, offset))
+    logger.info(f"Startup: {event} at {offset}s")
+    return offset
+
+def timeline() -> dict:
+    with _lock:
+        return dict(_timeline)
+
+def set_ready(ready: bool, model: str = None) -> None:
+    with _lock:
+        _state["ready"] = ready
+        if model is not None:
+            _state["model"] = model
+
+def task_done(success: bool, model: str = None) -> None:
+    with _lock:
+        _state["tasks"] += 1
+        first = _state["tasks"] == 1
+        # A runtime that failed its startup check is evidently serving now
+        if success:
+            _state["ready"] = True
+        if model is not None:
+            _state["model"] = model
+    if first:
+        mark("first_task_done")
+
+def add_status(name: str, provider) -> None:
+    """Include the result of provider() in /status under name"""
+    _status_providers[name] = provider
+
+def heartbeat() -> None:
+    """Called by the main loop on every iteration"""
+    global _last_heartbeat
+    _last_heartbeat = time.monotonic()
+
+def alive() -> bool:
+    # Not in the main loop yet: startup is covered by the readiness probe
+    if _last_heartbeat is None:
+        return True
+    return time.monotonic() - _last_heartbeat < LIVENESS_TIMEOUT_SECONDS
+
+def status() -> dict:
+    with _lock:
+        result = dict(_state)
+        result["startup"] = dict(_timeline)
+    result["alive"] = alive()
+    result["uptime_seconds"] = round(time.monotonic() - _started, 1)
+    if _last_heartbeat is not None:
+        result["last_heartbeat_seconds"] = round(time.monotonic() - _last_heartbeat, 1)
+    for name, provider in _status_providers.items():
+        result[name] = provider()
+    return result
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/healthz":
+            self._reply(200 if alive() else 503, {"alive": alive()})
+        elif self.path == "/readyz":
+            ready = _state["ready"] and alive()
+            self._reply(200 if ready else 503, {"ready": ready})
+        elif self.path == "/status":
+            self._reply(200, status())
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def _reply(self, code: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Probes hit the server every few seconds, keep them out of the agent log
+        pass
+
+def start(port: int = HEALTH_PORT):
+    """Serve /healthz, /readyz and /status in a background thread"""
+    if port == 0:
+        return None
+    try:
+        server = ThreadingHTTPServer(("", port), _Handler)
+    except OSError as e:
+        logger.warning(f"Failed to start health server on port {port}: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="health-server", daemon=True).start()
+    logger.info(f"Health server listening on port {port}")
+    return server
@@ -1,55 +1,260 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import gzip
+import json
 import logging
+import os
+import socket
+import tempfile
+import threading
+import urllib.parse
 
-import aioboto3
 import boto3
 import requests
-import requests_cache
-from aiohttp_client_cache import CacheBackend, CachedSession
+import urllib3
+import urllib3.response
 from requests.adapters import HTTPAdapter, Retry
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
 
-from . import s3_action, time_utils
+from . import log_utils, s3_action, time_utils
 
 logger = logging.getLogger("queue-agent")
 
+# Accept-Encoding sent to the runtime. SD Web UI gzips responses at level 9 when asked to,
+# which on the pod's loopback costs far more time than the bytes it saves
+RUNTIME_ACCEPT_ENCODING = os.getenv("RUNTIME_ACCEPT_ENCODING", "identity")
+# Compress request bodies with "gzip" or "zstd", only for runtimes that decode them
+RUNTIME_REQUEST_ENCODING = os.getenv("RUNTIME_REQUEST_ENCODING", "none").lower()
+# Fast levels, bodies are mostly base64 images that compress by about a quarter at any level
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 1
+# Smaller bodies are not worth compressing
+COMPRESS_MIN_BYTES = 1024
+# One task runs on a backend at a time, plus the odd control call such as an interrupt
+POOL_MAXSIZE = 2
 
-ab3_session = aioboto3.Session()
+class UnixHTTPConnection(HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
 
-apiClient = requests.Session()
+    def __init__(self, socket_path: str, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = UnixHTTPConnection
+
+    def __init__(self, socket_path: str, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        self.num_connections += 1
+        return self.ConnectionCls(self.socket_path, timeout=self.timeout.connect_timeout, **self.conn_kw)
+
+class UnixSocketAdapter(HTTPAdapter):
+    """Serves http+unix://<url-encoded socket path>/<path> URLs, e.g. http+unix://%2Frun%2Fsd.sock/sdapi/v1/"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.unix_pools = {}
+        self.unix_lock = threading.Lock()
+
+    def _unix_pool(self, url: str) -> UnixHTTPConnectionPool:
+        socket_path = urllib.parse.unquote(urllib.parse.urlparse(url).netloc)
+        with self.unix_lock:
+            pool = self.unix_pools.get(socket_path)
+            if pool is None:
+                pool = UnixHTTPConnectionPool(socket_path, maxsize=self._pool_maxsize)
+                self.unix_pools[socket_path] = pool
+            return pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self._unix_pool(request.url)
+
+    def get_connection(self, url, proxies=None):
+        return self._unix_pool(url)
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        super().close()
+        with self.unix_lock:
+            for pool in self.unix_pools.values():
+                pool.close()
+            self.unix_pools.clear()
+
+def _accept_encoding() -> str:
+    """RUNTIME_ACCEPT_ENCODING without the codings this urllib3 can't decode"""
+    supported = {"identity", "gzip", "deflate"}
+    if getattr(urllib3.response, "HAS_ZSTD", False):
+        supported.add("zstd")
+    if getattr(urllib3.response, "brotli", None) is not None:
+        supported.add("br")
+    codings = [c.strip() for c in RUNTIME_ACCEPT_ENCODING.split(",") if c.strip()]
+    accepted = [c for c in codings if c.split(";")[0].strip().lower() in supported]
+    if len(accepted) < len(codings):
+        logger.warning(f"Ignoring unsupported runtime encodings in RUNTIME_ACCEPT_ENCODING={RUNTIME_ACCEPT_ENCODING}")
+    return ", ".join(accepted) or "identity"
+
+def _runtime_session(max_retries) -> requests.Session:
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = _accepted_encodings
+    session.mount('http://', HTTPAdapter(max_retries=max_retries, pool_maxsize=POOL_MAXSIZE))
+    session.mount('http+unix://', UnixSocketAdapter(max_retries=max_retries, pool_maxsize=POOL_MAXSIZE))
+    return session
+
+_accepted_encodings = _accept_encoding()
 retries = Retry(
     total=3,
     connect=100,
     backoff_factor=0.1,
     allowed_methods=["GET", "POST"])
-apiClient.mount('http://', HTTPAdapter(max_retries=retries))
+apiClient = _runtime_session(retries)
+# Without the connect retries, for callers that poll with their own backoff
+_probeClient = _runtime_session(0)
 
 REQUESTS_TIMEOUT_SECONDS = 300
 
-cache = CacheBackend(
-    cache_name='memory-cache',
-    expire_after=600
-)
+# requests_cache, aioboto3 and aiohttp_client_cache are imported on first use
+# to keep them off the startup path
+_cache = None
+_ab3_session = None
+
+def init():
+    """Load requests_cache ahead of the first download"""
+    import requests_cache
+
+def encode_body(body) -> tuple:
+    """JSON request body and its headers, compressed as RUNTIME_REQUEST_ENCODING asks"""
+    data = json.dumps(body).encode()
+    headers = {"Content-Type": "application/json"}
+    if len(data) >= COMPRESS_MIN_BYTES:
+        if RUNTIME_REQUEST_ENCODING == "gzip":
+            data = gzip.compress(data, GZIP_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+        elif RUNTIME_REQUEST_ENCODING == "zstd":
+            # Optional dependency, only needed when zstd is chosen
+            import zstandard
+            data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+            headers["Content-Encoding"] = "zstd"
+    return data, headers
+
+def read_json(response):
+    """Parse a streamed response from one read of the whole body, instead of requests' 10 KB chunks"""
+    with response:
+        try:
+            data = response.raw.read(decode_content=True)
+        # Raised as requests would from response.content, for the callers' handlers
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise requests.exceptions.ReadTimeout(e, response=response)
+        except urllib3.exceptions.DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e, response=response)
+        except (urllib3.exceptions.ProtocolError, urllib3.exceptions.SSLError) as e:
+            raise requests.exceptions.ChunkedEncodingError(e, response=response)
+        if not response.ok:
+            # Keep the body on the response, callers report the runtime's error from it
+            response._content = data
+            response._content_consumed = True
+            response.raise_for_status()
+        return json.loads(data)
 
 @time_utils.get_time
 def do_invocations(url: str, body:str=None) -> str:
     if body is None:
-        logger.debug(f"Invoking {url}")
+        logger.debug("Invoking %s", url)
         response = apiClient.get(
-            url=url, timeout=(1, REQUESTS_TIMEOUT_SECONDS))
+            url=url, timeout=(1, REQUESTS_TIMEOUT_SECONDS), stream=True)
     else:
-        logger.debug(f"Invoking {url} with body: {body}")
+        logger.debug("Invoking %s with body: %s", url, log_utils.redact(body))
+        data, headers = encode_body(body)
         response = apiClient.post(
-            url=url, json=body, timeout=(1, REQUESTS_TIMEOUT_SECONDS))
-    response.raise_for_status()
-    logger.debug(response.text)
-    return response.json()
+            url=url, data=data, headers=headers, timeout=(1, REQUESTS_TIMEOUT_SECONDS), stream=True)
+    result = read_json(response)
+    logger.debug("Response from %s: %s", url, log_utils.redact(result))
+    return result
+
+def probe(url: str, body: dict = None) -> dict:
+    """Single GET, or POST of body, without connect retries, for callers that poll with their
+    own backoff or must not wait on a runtime that stopped answering"""
+    if body is None:
+        return read_json(_probeClient.get(url=url, timeout=(1, 10), stream=True))
+    data, headers = encode_body(body)
+    return read_json(_probeClient.post(url=url, data=data, headers=headers, timeout=(1, 10), stream=True))
+
+# Bytes of a task's streamed downloads kept in memory together, beyond which they spill to temporary files
+SPOOL_MEMORY_BYTES = int(os.getenv("SPOOL_MEMORY_BYTES", str(8 * 1024 * 1024)))
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+class ResponseTooLarge(Exception):
+    pass
+
+class SpoolBudget(object):
+    """Memory shared by the spooled downloads of one task, which stay open until they are uploaded"""
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = SPOOL_MEMORY_BYTES if max_bytes is None else max_bytes
+        self.used = 0
+
+    def take(self, size: int) -> bool:
+        if self.used + size > self.max_bytes:
+            return False
+        self.used += size
+        return True
+
+    def give(self, size: int) -> None:
+        self.used -= size
+
+def download_spooled(url: str, max_bytes: int = 0, budget: SpoolBudget = None):
+    """Stream a runtime response into a temporary file, in memory while budget allows and on disk
+    beyond it, by default SPOOL_MEMORY_BYTES for this file alone. Raises ResponseTooLarge past
+    max_bytes, 0 for no limit. The caller closes the returned file, which is positioned at its start"""
+    logger.debug("Streaming %s", log_utils.redact(url))
+    budget = budget if budget is not None else SpoolBudget()
+    # Rolled over by hand against the budget, max_size=0 never rolls over by itself
+    spool = tempfile.SpooledTemporaryFile(max_size=0)
+    in_memory = 0
+    try:
+        with apiClient.get(url=url, timeout=(1, REQUESTS_TIMEOUT_SECONDS), stream=True) as response:
+            response.raise_for_status()
+            length = int(response.headers.get("Content-Length") or 0)
+            if max_bytes and length > max_bytes:
+                raise ResponseTooLarge(f"{url} is {length} bytes, more than the limit of {max_bytes}")
+            size = 0
+            for chunk in response.iter_content(STREAM_CHUNK_BYTES):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ResponseTooLarge(f"{url} is more than the limit of {max_bytes} bytes")
+                if in_memory is not None:
+                    if budget.take(len(chunk)):
+                        in_memory += len(chunk)
+                    else:
+                        spool.rollover()
+                        budget.give(in_memory)
+                        in_memory = None
+                spool.write(chunk)
+        spool.seek(0)
+        return spool
+    except BaseException:
+        spool.close()
+        if in_memory:
+            budget.give(in_memory)
+        raise
 
 def get(url: str) -> bytes:
-    logger.debug(f"Downloading {url}")
+    logger.debug("Downloading %s", log_utils.redact(url))
     try:
         if url.lower().startswith("http://") or url.lower().startswith("https://"):
+            import requests_cache
             with requests_cache.CachedSession('demo_cache') as session:
                 with session.get(url) as res:
                     res.raise_for_status()
@@ -64,15 +269,25 @@ def get(url: str) -> bytes:
         raise e
 
 async def async_get(url: str) -> None:
+    global _cache, _ab3_session
     try:
         if url.lower().startswith("http://") or url.lower().startswith("https://"):
-            async with CachedSession(cache=cache) as session:
+            from aiohttp_client_cache import CacheBackend, CachedSession
+            if _cache is None:
+                _cache = CacheBackend(
+                    cache_name='memory-cache',
+                    expire_after=600
+                )
+            async with CachedSession(cache=_cache) as session:
                 async with session.get(url) as res:
                     res.raise_for_status()
                     return await res.read()
         elif url.lower().startswith("s3://"):
             bucket_name, key = s3_action.get_bucket_and_key(url)
-            async with ab3_session.resource("s3") as s3:
+            if _ab3_session is None:
+                import aioboto3
+                _ab3_session = aioboto3.Session()
+            async with _ab3_session.resource("s3") as s3:
                 obj = await s3.Object(bucket_name, key)
                 res = await obj.get()
                 return await res['Body'].read()
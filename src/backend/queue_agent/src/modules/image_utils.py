@@ -0,0 +1,169 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger("queue-agent")
+
+# Downscale input images to the size they are generated at before sending them to the runtime
+IMAGE_PRESIZE = os.getenv("IMAGE_PRESIZE", "false").lower() == "true"
+# Processes resizing images, each takes about one CPU while busy
+IMAGE_PRESIZE_WORKERS = int(os.getenv("IMAGE_PRESIZE_WORKERS", "2"))
+# Bytes of resized images kept for inputs that are sent again
+IMAGE_PRESIZE_CACHE_BYTES = int(os.getenv("IMAGE_PRESIZE_CACHE_BYTES", str(256 * 1024 * 1024)))
+JPEG_QUALITY = 95
+
+# EXIF orientations that swap width and height
+_TRANSPOSED = (5, 6, 7, 8)
+
+_pool = None
+_lock = threading.Lock()
+_cache = OrderedDict()
+_cache_bytes = 0
+_stats = {"images": 0, "resized": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0}
+
+def init():
+    """Start the resize processes ahead of the first task"""
+    if IMAGE_PRESIZE:
+        _get_pool().submit(_ping).result()
+
+def _ping():
+    return True
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _lock:
+        if _pool is None:
+            # Forking a process with running threads is unsafe, start clean interpreters instead
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_PRESIZE_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def _reset_pool():
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def shutdown():
+    """Stop the resize processes"""
+    _reset_pool()
+
+def target_size(payload: dict) -> tuple:
+    """Smallest (width, height) input images of a generation request must cover"""
+    width = int(payload.get('width') or 512)
+    height = int(payload.get('height') or 512)
+    if payload.get('enable_hr'):
+        scale = float(payload.get('hr_scale') or 2)
+        width = int(payload.get('hr_resize_x') or 0) or int(width * scale)
+        height = int(payload.get('hr_resize_y') or 0) or int(height * scale)
+    # ControlNet preprocessors work at processor_res on the short side
+    controlnet = (payload.get('alwayson_scripts') or {}).get('controlnet') or {}
+    for unit in controlnet.get('args') or []:
+        if isinstance(unit, dict) and isinstance(unit.get('processor_res'), int):
+            short = min(width, height)
+            if unit['processor_res'] > short:
+                scale = unit['processor_res'] / short
+                width, height = int(width * scale), int(height * scale)
+    return width, height
+
+def _scaled_size(size: tuple, orientation: int, target: tuple):
+    """Size of the downscaled image, None when it is not larger than target"""
+    width, height = size
+    if orientation in _TRANSPOSED:
+        width, height = height, width
+    scale = max(target[0] / width, target[1] / height)
+    if scale >= 1:
+        return None
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+def _resize(data: bytes, size: tuple) -> bytes:
+    """Runs in a resize process"""
+    from PIL import Image, ImageOps
+    image = Image.open(io.BytesIO(data))
+    image_format = image.format
+    # JPEG can decode straight to a fraction of its size, much faster than decoding it whole
+    if image.getexif().get(0x0112) in _TRANSPOSED:
+        image.draft(image.mode, (size[1], size[0]))
+    else:
+        image.draft(image.mode, size)
+    image = ImageOps.exif_transpose(image)
+    image = image.resize(size, Image.LANCZOS)
+    output = io.BytesIO()
+    if image_format == 'JPEG' and image.mode in ('RGB', 'L', 'CMYK'):
+        image.save(output, format='JPEG', quality=JPEG_QUALITY)
+    else:
+        image.save(output, format='PNG')
+    return output.getvalue()
+
+def presize(data: bytes, target: tuple, name: str = "") -> bytes:
+    """Image downscaled to cover target, keeping its aspect ratio and orientation. Unchanged when
+    it is already small enough or can't be read"""
+    try:
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as image:
+            size = _scaled_size(image.size, image.getexif().get(0x0112), target)
+    except Exception as e:
+        logger.debug(f"Not presizing {name}: {str(e)}")
+        return data
+    with _lock:
+        _stats["images"] += 1
+    if size is None:
+        return data
+
+    key = (hashlib.sha256(data).hexdigest(), size)
+    with _lock:
+        resized = _cache.get(key)
+        if resized is not None:
+            _cache.move_to_end(key)
+            _stats["cache_hits"] += 1
+    if resized is None:
+        try:
+            resized = _get_pool().submit(_resize, data, size).result()
+        except BrokenProcessPool as e:
+            # A resize process died, e.g. killed for memory, start new ones for the next image
+            _reset_pool()
+            logger.warning(f"Failed to presize {name}, sending it as is: {str(e)}")
+            return data
+        except Exception as e:
+            logger.warning(f"Failed to presize {name}, sending it as is: {str(e)}")
+            return data
+        _remember(key, resized)
+    if len(resized) >= len(data):
+        return data
+
+    with _lock:
+        _stats["resized"] += 1
+        _stats["bytes_in"] += len(data)
+        _stats["bytes_out"] += len(resized)
+    logger.info(f"Presized {name} to {size[0]}x{size[1]}, {len(data)} -> {len(resized)} bytes")
+    return resized
+
+def _remember(key, resized: bytes):
+    global _cache_bytes
+    if len(resized) > IMAGE_PRESIZE_CACHE_BYTES:
+        return
+    with _lock:
+        if key in _cache:
+            return
+        _cache[key] = resized
+        _cache_bytes += len(resized)
+        while _cache_bytes > IMAGE_PRESIZE_CACHE_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
+
+def stats() -> dict:
+    """Counters for the status endpoint"""
+    with _lock:
+        result = dict(_stats)
+    result["bytes_saved"] = result["bytes_in"] - result["bytes_out"]
+    return result
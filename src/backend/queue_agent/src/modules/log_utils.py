@@ -0,0 +1,119 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import os
+import random
+import re
+import threading
+from contextlib import contextmanager
+
+# "text" keeps the classic format, "json" writes one JSON object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Longer strings in logged payloads are truncated, base64 data is replaced by its length
+LOG_FIELD_MAX_CHARS = int(os.getenv("LOG_FIELD_MAX_CHARS", "256"))
+# Items of logged lists and dicts beyond this count are summarized
+LOG_MAX_ITEMS = int(os.getenv("LOG_MAX_ITEMS", "20"))
+# Fraction of tasks logged at DEBUG level whatever LOGLEVEL is
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0"))
+
+_BASE64 = re.compile(r'[A-Za-z0-9+/=]+')
+_DATA_URI = re.compile(r'data:[\w/+.-]+;base64,')
+
+# Task handled by the current thread, and whether it is sampled for debug logging
+_context = threading.local()
+
+def _looks_like_base64(value: str) -> bool:
+    head = _DATA_URI.sub('', value[:128], count=1)
+    return _BASE64.fullmatch(head) is not None
+
+def summarize(obj, depth: int = 0):
+    """Copy of obj that is cheap to log: long strings cut, base64 and bytes replaced by their size"""
+    if isinstance(obj, str):
+        if len(obj) <= LOG_FIELD_MAX_CHARS:
+            return obj
+        if _looks_like_base64(obj):
+            return f"<base64, {len(obj)} chars>"
+        return f"{obj[:LOG_FIELD_MAX_CHARS]}... <{len(obj)} chars>"
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return f"<{len(obj)} bytes>"
+    if depth >= 8:
+        return "<...>"
+    if isinstance(obj, dict):
+        items = list(obj.items())
+        result = {str(k): summarize(v, depth + 1) for k, v in items[:LOG_MAX_ITEMS]}
+        if len(items) > LOG_MAX_ITEMS:
+            result["..."] = f"<{len(items) - LOG_MAX_ITEMS} more keys>"
+        return result
+    if isinstance(obj, (list, tuple)):
+        result = [summarize(v, depth + 1) for v in obj[:LOG_MAX_ITEMS]]
+        if len(obj) > LOG_MAX_ITEMS:
+            result.append(f"<{len(obj) - LOG_MAX_ITEMS} more items>")
+        return result
+    return obj
+
+class Redacted(object):
+    """Log argument that summarizes its object only when the record is actually emitted"""
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        value = summarize(self.obj)
+        if isinstance(value, str):
+            return value
+        return json.dumps(value, ensure_ascii=False, default=repr)
+
+def redact(obj) -> Redacted:
+    """Wrap a payload for logging with %-style arguments: logger.debug("Body: %s", redact(body))"""
+    return Redacted(obj)
+
+@contextmanager
+def task_context(task_id: str):
+    """Tag log records of the current thread with task_id, and sample the task for debug logging"""
+    _context.task_id = task_id
+    _context.debug = LOG_DEBUG_SAMPLE_RATE > 0 and random.random() < LOG_DEBUG_SAMPLE_RATE
+    try:
+        yield
+    finally:
+        _context.task_id = None
+        _context.debug = False
+
+class _TaskFilter(logging.Filter):
+    """Adds the task ID to records, and drops records below level outside of sampled tasks"""
+
+    def __init__(self, level: int):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record):
+        record.task_id = getattr(_context, "task_id", None)
+        return record.levelno >= self.level or getattr(_context, "debug", False)
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "task_id", None):
+            entry["task_id"] = record.task_id
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup(logger: logging.Logger, handler: logging.Handler) -> None:
+    """Apply LOG_FORMAT and LOG_DEBUG_SAMPLE_RATE to the agent logger"""
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    level = logger.getEffectiveLevel()
+    if LOG_DEBUG_SAMPLE_RATE > 0 and level > logging.DEBUG:
+        # Debug records are then created everywhere, and dropped unless their task is sampled
+        logger.setLevel(logging.DEBUG)
+    logger.addFilter(_TaskFilter(level))
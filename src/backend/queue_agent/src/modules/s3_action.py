@@ -4,33 +4,80 @@
 import datetime
 import logging
 import mimetypes
+import threading
 import uuid
 
-import aioboto3
 import boto3
-import magic
 
 logger = logging.getLogger("queue-agent")
-s3Res = boto3.resource('s3')
 
-ab3_session = aioboto3.Session()
+# Created on first use so that importing this module stays cheap, see init(). Clients, unlike
+# resources, can be shared by the task threads
+_s3_client = None
+_ab3_session = None
+_presign_client = None
+_transfer_config_obj = None
+_client_lock = threading.Lock()
 
-def upload_file(object_bytes: bytes, bucket_name: str, prefix: str, file_name: str=None, extension: str=None) -> str:
+# Part size and parallel parts of streamed uploads
+MULTIPART_CHUNK_BYTES = 16 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+# Enough of a file for libmagic to recognize its type
+MAGIC_HEADER_BYTES = 8192
+
+def init():
+    """Create the S3 client and load libmagic ahead of the first upload"""
+    get_client()
+    import magic
+
+def get_client():
+    global _s3_client
+    with _client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3')
+        return _s3_client
+
+def _mime_type(object_bytes: bytes) -> str:
+    import magic
+    return magic.from_buffer(object_bytes, mime=True)
+
+def _transfer_config():
+    global _transfer_config_obj
+    if _transfer_config_obj is None:
+        # Memory held by a streamed upload is about max_concurrency * multipart_chunksize
+        from boto3.s3.transfer import TransferConfig
+        _transfer_config_obj = TransferConfig(multipart_threshold=MULTIPART_CHUNK_BYTES,
+                                              multipart_chunksize=MULTIPART_CHUNK_BYTES,
+                                              max_concurrency=MULTIPART_CONCURRENCY)
+    return _transfer_config_obj
+
+def upload_file(object_bytes, bucket_name: str, prefix: str, file_name: str=None, extension: str=None) -> str:
+    """Upload bytes, or a binary file object positioned at its start, which is streamed in parts"""
     if file_name is None:
         file_name = datetime.datetime.now().strftime(f"%Y%m%d%H%M%S-{uuid.uuid4()[0:5]}")
+    streamed = hasattr(object_bytes, "read")
 
     # Auto determine file type and extension using magic
     if extension is None:
-        content_type = magic.from_buffer(object_bytes, mime=True)
+        if streamed:
+            content_type = _mime_type(object_bytes.read(MAGIC_HEADER_BYTES))
+            object_bytes.seek(0)
+        else:
+            content_type = _mime_type(object_bytes)
         extension = mimetypes.guess_extension(content_type, True)
 
-    if extension == '.out':
+    if extension in ('.out', '.json'):
         content_type = f'application/json'
 
     try:
-        bucket = s3Res.Bucket(bucket_name)
+        s3 = get_client()
         logger.info(f"Uploading s3://{bucket_name}/{prefix}/{file_name}{extension}")
-        bucket.put_object(Body=object_bytes, Key=f'{prefix}/{file_name}{extension}', ContentType=content_type)
+        if streamed:
+            s3.upload_fileobj(object_bytes, bucket_name, f'{prefix}/{file_name}{extension}',
+                              ExtraArgs={'ContentType': content_type}, Config=_transfer_config())
+        else:
+            s3.put_object(Bucket=bucket_name, Body=object_bytes, Key=f'{prefix}/{file_name}{extension}',
+                          ContentType=content_type)
         return f's3://{bucket_name}/{prefix}/{file_name}{extension}'
     except Exception as error:
         logger.error('Failed to upload content to S3', exc_info=True)
@@ -38,25 +85,50 @@ def upload_file(object_bytes: bytes, bucket_name: str, prefix: str, file_name: s
 
 
 async def async_upload(object_bytes: bytes, bucket_name: str, prefix: str, file_name: str=None, extension: str=None) -> str:
+    global _ab3_session
     if file_name is None:
         file_name = datetime.datetime.now().strftime(f"%Y%m%d%H%M%S-{uuid.uuid4()[0:5]}")
 
     # Auto determine file type and extension using magic
     if extension is None:
-        content_type = magic.from_buffer(object_bytes, mime=True)
+        content_type = _mime_type(object_bytes)
         extension = mimetypes.guess_extension(content_type, True)
 
     if extension == '.out':
         content_type = f'application/json'
 
     try:
-        async with ab3_session.resource("s3") as s3:
+        if _ab3_session is None:
+            import aioboto3
+            _ab3_session = aioboto3.Session()
+        async with _ab3_session.resource("s3") as s3:
             bucket = await s3.Bucket(bucket_name)
             await bucket.put_object(Body=object_bytes, Key=f'{prefix}/{file_name}{extension}', ContentType=content_type)
             return f's3://{bucket_name}/{prefix}/{file_name}{extension}'
     except Exception as e:
         raise e
 
+def download(s3uri: str) -> bytes:
+    bucket_name, key = get_bucket_and_key(s3uri)
+    try:
+        return get_client().get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    except Exception as error:
+        logger.error(f'Failed to download {s3uri}', exc_info=True)
+        raise error
+
+def presign(s3uri: str, expires_in: int) -> str:
+    """Time-limited HTTPS URL to GET an object, signed locally without a request to S3"""
+    global _presign_client
+    with _client_lock:
+        if _presign_client is None:
+            # SigV4 on the regional endpoint, as required outside of the oldest regions
+            from botocore.config import Config
+            _presign_client = boto3.client('s3', config=Config(signature_version='s3v4',
+                                                               s3={'addressing_style': 'virtual'}))
+    bucket_name, key = get_bucket_and_key(s3uri)
+    return _presign_client.generate_presigned_url(
+        'get_object', Params={'Bucket': bucket_name, 'Key': key}, ExpiresIn=expires_in)
+
 def get_bucket_and_key(s3uri):
     pos = s3uri.find('/', 5)
     bucket = s3uri[5: pos]
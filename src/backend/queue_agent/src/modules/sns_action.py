@@ -1,15 +1,40 @@
 import logging
+import os
+import queue
+import threading
+import time
 
-import aioboto3
+import boto3
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger("queue-agent")
 
-ab3_session = aioboto3.Session()
+# Notifications waiting for the background publisher. Results wait for room when it is
+# full, running and progress updates are dropped
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "100"))
+# Attempts at publishing a notification before giving up on it
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "5"))
+NOTIFY_WORKERS = 2
+# Delay before the first retry, doubled for each further one
+NOTIFY_RETRY_DELAY = 0.5  # seconds
+
+# aioboto3 is only needed by the async helpers, imported on first use
+_ab3_session = None
+_sns_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """SNS client shared by the publisher threads, clients are thread-safe where resources are not"""
+    global _sns_client
+    with _client_lock:
+        if _sns_client is None:
+            _sns_client = boto3.client('sns')
+        return _sns_client
 
 def publish_message(topic, message: str) -> str:
+    """Publish to a Topic resource, through the shared client"""
     try:
-        response = topic.publish(Message=message)
+        response = get_client().publish(TopicArn=topic.arn, Message=message)
         message_id = response['MessageId']
     except ClientError as error:
         logger.error('Failed to send message to SNS', exc_info=True)
@@ -18,10 +43,108 @@ def publish_message(topic, message: str) -> str:
         return message_id
 
 async def async_publish_message(topic, content: str):
+    global _ab3_session
     try:
-        async with ab3_session.resource("sns") as sns:
+        if _ab3_session is None:
+            import aioboto3
+            _ab3_session = aioboto3.Session()
+        async with _ab3_session.resource("sns") as sns:
             topic = await sns.Topic(topic)
             response = await topic.publish(Message=content)
             return response['MessageId']
     except Exception as e:
-        raise e
\ No newline at end of file
+        raise e
+
+
+class Publisher(object):
+    """Publishes notifications from background threads, so tasks don't wait on SNS.
+
+    Notifications may be published out of order, as with any standard SNS topic.
+    """
+
+    def __init__(self, workers: int = NOTIFY_WORKERS, size: int = NOTIFY_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=size)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0
+        self.counters = {"published": 0, "retried": 0, "failed": 0, "dropped": 0}
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f"notify-{i}", daemon=True).start()
+
+    def submit(self, topic, message: str, on_published=None, required: bool = True) -> bool:
+        """Queue a notification, calling on_published() once SNS has accepted it. Required ones
+        wait for room in the queue, others are dropped when it is full"""
+        with self.lock:
+            self.pending += 1
+        try:
+            self.queue.put((topic, message, on_published), block=required)
+        except queue.Full:
+            with self.lock:
+                self.counters["dropped"] += 1
+            self._done()
+            logger.warning("Notification queue is full, dropping a notification")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            topic, message, on_published = self.queue.get()
+            try:
+                if self._publish(topic, message) and on_published is not None:
+                    on_published()
+            except Exception:
+                logger.error('Failed to complete a published notification', exc_info=True)
+            finally:
+                self._done()
+
+    def _publish(self, topic, message: str) -> bool:
+        delay = NOTIFY_RETRY_DELAY
+        for attempt in range(1, NOTIFY_MAX_ATTEMPTS + 1):
+            try:
+                publish_message(topic, message)
+            except Exception as e:
+                if attempt == NOTIFY_MAX_ATTEMPTS:
+                    with self.lock:
+                        self.counters["failed"] += 1
+                    logger.error(f"Giving up on a notification after {attempt} attempts: {str(e)}")
+                    return False
+                with self.lock:
+                    self.counters["retried"] += 1
+                time.sleep(delay)
+                delay *= 2
+            else:
+                with self.lock:
+                    self.counters["published"] += 1
+                return True
+
+    def _done(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.idle.notify_all()
+
+    def flush(self, timeout: float) -> int:
+        """Wait up to timeout seconds for queued notifications, returns how many are left"""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.pending and self.idle.wait(max(deadline - time.monotonic(), 0)):
+                pass
+            return self.pending
+
+    def status(self) -> dict:
+        with self.lock:
+            return {"pending": self.pending, **self.counters}
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+def get_publisher() -> Publisher:
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher()
+    return _publisher
+
+def publish_async(topic, message: str, on_published=None, required: bool = True) -> bool:
+    """Publish from the background publisher, see Publisher.submit"""
+    return get_publisher().submit(topic, message, on_published, required)
@@ -2,11 +2,26 @@
 # SPDX-License-Identifier: MIT-0
 
 import logging
+import threading
+import time
 
+import boto3
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger("queue-agent")
 
+# Messages are deleted and released from the task and notification threads, through one client
+# as resources are not thread-safe
+_sqs_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _sqs_client
+    with _client_lock:
+        if _sqs_client is None:
+            _sqs_client = boto3.client('sqs')
+        return _sqs_client
+
 def receive_messages(queue, max_number, wait_time):
     try:
         messages = queue.receive_messages(
@@ -23,7 +38,35 @@ def receive_messages(queue, max_number, wait_time):
 
 def delete_message(message):
     try:
-        message.delete()
+        get_client().delete_message(QueueUrl=message.queue_url, ReceiptHandle=message.receipt_handle)
     except ClientError as error:
         logger.error('Failed to delete message from SQS', exc_info=True)
-        raise error
\ No newline at end of file
+        raise error
+
+def release_message(message):
+    """Make a received message visible again right away, for another consumer to take"""
+    try:
+        get_client().change_message_visibility(QueueUrl=message.queue_url, ReceiptHandle=message.receipt_handle,
+                                               VisibilityTimeout=0)
+    except ClientError:
+        logger.error('Failed to release message to SQS', exc_info=True)
+
+def change_visibility_batch(queue, messages: list, timeout: int) -> None:
+    """Set the visibility timeout of received messages, ten per request"""
+    for start in range(0, len(messages), 10):
+        entries = [{'Id': str(i), 'ReceiptHandle': m.receipt_handle, 'VisibilityTimeout': timeout}
+                   for i, m in enumerate(messages[start:start + 10])]
+        try:
+            response = get_client().change_message_visibility_batch(QueueUrl=queue.url, Entries=entries)
+        except ClientError:
+            logger.error('Failed to change message visibility in SQS', exc_info=True)
+            continue
+        for failure in response.get('Failed', []):
+            logger.warning(f"Failed to change message visibility: {failure.get('Message')}")
+
+def get_queue_wait(message) -> float:
+    """Seconds between the message being sent to SQS and now, None if unknown"""
+    try:
+        return time.time() - int(message.attributes['SentTimestamp']) / 1000
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import os
+import threading
+import time
+from decimal import Decimal
+
+import boto3
+
+logger = logging.getLogger("queue-agent")
+
+# DynamoDB table keyed by task ID, status updates are skipped when not set
+STATUS_TABLE_NAME = os.getenv("STATUS_TABLE_NAME", "")
+# "memory" keeps statuses in process, for local runs and the benchmark
+STATUS_STORE = os.getenv("STATUS_STORE", "dynamodb" if STATUS_TABLE_NAME else "none").lower()
+# Items expire this long after their last update
+STATUS_TTL_DAYS = int(os.getenv("STATUS_TTL_DAYS", "7"))
+
+class DynamoDBStatusStore(object):
+    """Status items in DynamoDB, each transition updates only the fields it sets"""
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        # One resource per thread, boto3 resources are not thread-safe
+        self.local = threading.local()
+
+    @property
+    def table(self):
+        if not hasattr(self.local, "table"):
+            self.local.table = boto3.session.Session().resource('dynamodb').Table(self.table_name)
+        return self.local.table
+
+    def update(self, task_id: str, fields: dict) -> None:
+        # DynamoDB stores numbers as Decimal and rejects floats
+        fields = json.loads(json.dumps(fields), parse_float=Decimal)
+        names = {f"#f{i}": name for i, name in enumerate(fields)}
+        values = {f":v{i}": value for i, value in enumerate(fields.values())}
+        self.table.update_item(
+            Key={"id": task_id},
+            UpdateExpression="SET " + ", ".join(f"#f{i} = :v{i}" for i in range(len(fields))),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+
+    def get(self, task_id: str) -> dict:
+        return self.table.get_item(Key={"id": task_id}).get("Item")
+
+class MemoryStatusStore(object):
+    """In-process stand-in for DynamoDBStatusStore"""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def update(self, task_id: str, fields: dict) -> None:
+        with self.lock:
+            self.items.setdefault(task_id, {"id": task_id}).update(json.loads(json.dumps(fields)))
+
+    def get(self, task_id: str) -> dict:
+        with self.lock:
+            item = self.items.get(task_id)
+            return dict(item) if item is not None else None
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    if STATUS_STORE == "none":
+        return None
+    with _store_lock:
+        if _store is None:
+            if STATUS_STORE == "memory":
+                _store = MemoryStatusStore()
+            else:
+                _store = DynamoDBStatusStore(STATUS_TABLE_NAME)
+    return _store
+
+def update(task_id: str, status: str, **fields) -> None:
+    """Record a status transition, failures are logged and never fail the task"""
+    store = get_store()
+    if store is None:
+        return
+    now = time.time()
+    fields.update({
+        "status": status,
+        "updated_at": round(now, 3),
+        "expires_at": int(now) + STATUS_TTL_DAYS * 86400,
+    })
+    try:
+        store.update(task_id, fields)
+    except Exception as e:
+        logger.warning(f"Failed to update status of task {task_id} to {status}: {str(e)}")
@@ -0,0 +1,90 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import base64
+import collections
+import gzip
+import json
+import logging
+import os
+import threading
+
+from . import s3_action
+
+logger = logging.getLogger("queue-agent")
+
+# Bytes of claim-checked task content kept in memory, 0 disables the cache
+CONTENT_CACHE_BYTES = int(os.getenv("CONTENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# SNS message attribute marking a compressed message body, e.g. "gzip+base64"
+ENCODING_ATTRIBUTE = "content-encoding"
+
+_cache = collections.OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+
+def decode(message) -> dict:
+    """Return the task published to SNS from an SQS message, decompressing it if needed"""
+    envelope = json.loads(message.body)
+    body = envelope['Message']
+    encoding = envelope.get('MessageAttributes', {}).get(ENCODING_ATTRIBUTE, {}).get('Value')
+    if encoding:
+        body = decompress(body, encoding)
+    return json.loads(body)
+
+def compress(body: str, encoding: str) -> str:
+    data = body.encode()
+    if encoding == "gzip+base64":
+        data = gzip.compress(data)
+    elif encoding == "zstd+base64":
+        import zstandard
+        data = zstandard.ZstdCompressor().compress(data)
+    else:
+        raise ValueError(f"Unsupported message encoding {encoding}")
+    return base64.b64encode(data).decode()
+
+def decompress(body: str, encoding: str) -> str:
+    data = base64.b64decode(body)
+    if encoding == "gzip+base64":
+        data = gzip.decompress(data)
+    elif encoding == "zstd+base64":
+        # Optional dependency, only needed by producers that choose zstd
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        raise ValueError(f"Unsupported message encoding {encoding}")
+    return data.decode()
+
+def get_content(payload: dict):
+    """Return the task content, loading it from S3 when the input function stored it there"""
+    if "content_ref" not in payload:
+        return payload["content"]
+
+    ref = payload["content_ref"]
+    data = _cache_get(ref)
+    if data is None:
+        logger.info(f"Loading task content from {ref}")
+        data = s3_action.download(ref)
+        _cache_put(ref, data)
+    # Parsed on every call, runtimes modify the content they are given
+    return json.loads(data)
+
+def _cache_get(ref: str) -> bytes:
+    with _lock:
+        data = _cache.get(ref)
+        if data is not None:
+            _cache.move_to_end(ref)
+        return data
+
+def _cache_put(ref: str, data: bytes) -> None:
+    global _cache_bytes
+    if len(data) > CONTENT_CACHE_BYTES:
+        return
+    with _lock:
+        if ref in _cache:
+            return
+        _cache[ref] = data
+        _cache_bytes += len(data)
+        while _cache_bytes > CONTENT_CACHE_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
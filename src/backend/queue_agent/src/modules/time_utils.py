@@ -1,11 +1,16 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import contextlib
+import contextvars
 import logging
 from time import perf_counter
 
 logger = logging.getLogger("queue-agent")
 
+# Timings of the task being processed in the current thread
+_current_timings = contextvars.ContextVar("task_timings", default=None)
+
 def get_time(f):
     def inner(*arg, **kwarg):
         s_time = perf_counter()
@@ -13,4 +18,41 @@ def get_time(f):
         e_time = perf_counter()
         logger.info('Used: {:.4f} seconds on api: {}.'.format(e_time - s_time, arg[0]))
         return res
-    return inner
\ No newline at end of file
+    return inner
+
+class TaskTimings(object):
+    """Accumulates the time one task spends in each processing stage"""
+
+    def __init__(self, queue_wait: float = None):
+        self.started = perf_counter()
+        self.stages = {}
+        if queue_wait is not None:
+            self.stages["queue_wait"] = max(queue_wait, 0.0)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def to_dict(self) -> dict:
+        result = {f"{name}_ms": round(seconds * 1000, 1) for name, seconds in self.stages.items()}
+        result["total_ms"] = round((perf_counter() - self.started) * 1000, 1)
+        return result
+
+def start_task(queue_wait: float = None) -> TaskTimings:
+    """Start collecting stage timings for the task handled by the current thread"""
+    timings = TaskTimings(queue_wait)
+    _current_timings.set(timings)
+    return timings
+
+def current_task() -> TaskTimings:
+    return _current_timings.get()
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Add the duration of the enclosed block to stage `name` of the current task, if any"""
+    s_time = perf_counter()
+    try:
+        yield
+    finally:
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(name, perf_counter() - s_time)
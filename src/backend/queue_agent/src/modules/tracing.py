@@ -0,0 +1,191 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import contextlib
+import contextvars
+import functools
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+logger = logging.getLogger("queue-agent")
+
+# Exporter used for traces: xray, otlp or none
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "xray").lower()
+DISABLE_XRAY = os.environ.get('DISABLE_XRAY', 'false').lower() == 'true'
+
+# Fraction of tasks traced, optionally overridden per task type,
+# e.g. TRACE_SAMPLE_RATES="text-to-image=0.1,pipeline=0.5"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_SAMPLE_RATES = {}
+for item in os.getenv("TRACE_SAMPLE_RATES", "").split(","):
+    if "=" in item:
+        key, value = item.split("=", 1)
+        TRACE_SAMPLE_RATES[key.strip()] = float(value)
+
+MAX_INIT_ATTEMPTS = 5
+INIT_RETRY_DELAY = 3  # seconds
+
+# Exporter that finished initialising, None until then
+active_exporter = None
+_tracer = None
+
+# Whether the task handled by the current thread is being traced
+_task_sampled = contextvars.ContextVar("task_sampled", default=False)
+
+def init(service_name: str) -> None:
+    """Initialise tracing in a background thread so startup never waits for it"""
+    if TRACING_EXPORTER == "none" or (TRACING_EXPORTER == "xray" and DISABLE_XRAY):
+        logger.info("Tracing disabled")
+        return
+    threading.Thread(target=_init_worker, args=(service_name,), name="tracing-init", daemon=True).start()
+
+def _init_worker(service_name: str) -> None:
+    global active_exporter
+    for attempt in range(MAX_INIT_ATTEMPTS):
+        try:
+            logger.info(f"Initializing {TRACING_EXPORTER} tracing (attempt {attempt+1}/{MAX_INIT_ATTEMPTS})")
+            if TRACING_EXPORTER == "otlp":
+                _init_otlp(service_name)
+            else:
+                _init_xray()
+            active_exporter = TRACING_EXPORTER
+            logger.info(f"{TRACING_EXPORTER} tracing initialized successfully")
+            return
+        except ImportError as e:
+            logger.warning(f"Tracing exporter {TRACING_EXPORTER} is not installed: {str(e)}. Tracing will be disabled.")
+            return
+        except Exception as e:
+            logger.warning(f"Error initializing tracing: {str(e)} (attempt {attempt+1}/{MAX_INIT_ATTEMPTS})")
+            if attempt < MAX_INIT_ATTEMPTS - 1:
+                time.sleep(INIT_RETRY_DELAY)
+    logger.warning("Tracing initialization failed after all attempts. Tracing will be disabled.")
+
+def _init_xray() -> None:
+    from aws_xray_sdk.core import patch_all
+    patch_all()
+
+def _init_otlp(service_name: str) -> None:
+    global _tracer
+    from opentelemetry import trace
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    # Endpoint and headers come from the standard OTEL_EXPORTER_OTLP_* variables
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer("queue-agent")
+    try:
+        from opentelemetry.instrumentation.botocore import BotocoreInstrumentor
+        from opentelemetry.instrumentation.requests import RequestsInstrumentor
+        BotocoreInstrumentor().instrument()
+        RequestsInstrumentor().instrument()
+    except ImportError:
+        logger.info("OpenTelemetry instrumentation packages not installed, tracing task spans only")
+
+def enabled() -> bool:
+    return active_exporter is not None
+
+def sample_rate(task_type: str) -> float:
+    return TRACE_SAMPLE_RATES.get(task_type, TRACE_SAMPLE_RATE)
+
+@contextlib.contextmanager
+def task_span(name: str, task_type: str, trace_header: str = None):
+    """Trace one task, linked to the upstream trace header, if its task type is sampled"""
+    if not enabled():
+        yield
+        return
+
+    sampled = random.random() < sample_rate(task_type)
+    try:
+        if active_exporter == "otlp":
+            span = _otlp_span(name, task_type, trace_header) if sampled else contextlib.nullcontext()
+        else:
+            span = _xray_segment(name, trace_header, sampled)
+    except Exception as e:
+        logger.warning(f"Error starting trace for {name}: {str(e)}. Processing without tracing.")
+        sampled = False
+        span = contextlib.nullcontext()
+
+    token = _task_sampled.set(sampled)
+    try:
+        with _guarded(span, name) as traced:
+            if not traced:
+                _task_sampled.set(False)
+            yield
+    finally:
+        _task_sampled.reset(token)
+
+@contextlib.contextmanager
+def _guarded(span, name: str):
+    """Enter and exit a span so that tracing errors are logged, never raised into the task.
+    Yields whether the span was started"""
+    try:
+        span.__enter__()
+        traced = True
+    except Exception as e:
+        logger.warning(f"Error starting trace for {name}: {str(e)}. Processing without tracing.")
+        span = contextlib.nullcontext()
+        traced = False
+    exc_info = (None, None, None)
+    try:
+        yield traced
+    except BaseException:
+        exc_info = sys.exc_info()
+        raise
+    finally:
+        try:
+            span.__exit__(*exc_info)
+        except Exception as e:
+            logger.warning(f"Error ending trace for {name}: {str(e)}")
+
+def _xray_segment(name: str, trace_header: str, sampled: bool):
+    from aws_xray_sdk.core import xray_recorder
+    from aws_xray_sdk.core.models.trace_header import TraceHeader
+
+    kwargs = {"sampling": 1 if sampled else 0}
+    if trace_header:
+        header = TraceHeader.from_header_str(trace_header)
+        kwargs["traceid"] = header.root
+        kwargs["parent_id"] = header.parent
+        # Respect an upstream decision not to sample
+        if header.sampled == 0:
+            kwargs["sampling"] = 0
+    return xray_recorder.in_segment(name, **kwargs)
+
+def _otlp_span(name: str, task_type: str, trace_header: str):
+    parent = None
+    if trace_header:
+        try:
+            from opentelemetry.propagators.aws import AwsXRayPropagator
+            parent = AwsXRayPropagator().extract({"X-Amzn-Trace-Id": trace_header})
+        except ImportError:
+            pass
+    return _tracer.start_as_current_span(name, context=parent, attributes={"task.type": task_type})
+
+def capture(name):
+    """Decorator that traces a function as a child of the current task when the task is sampled"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (enabled() and _task_sampled.get()):
+                return func(*args, **kwargs)
+            try:
+                if active_exporter == "otlp":
+                    span = _tracer.start_as_current_span(name)
+                else:
+                    from aws_xray_sdk.core import xray_recorder
+                    span = xray_recorder.in_subsegment(name)
+            except Exception as e:
+                logger.warning(f"Tracing instrumentation failed for {name}: {str(e)}")
+                return func(*args, **kwargs)
+            with _guarded(span, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,158 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import logging
+import os
+import threading
+import time
+
+from . import s3_action
+
+logger = logging.getLogger("queue-agent")
+
+# Directory or s3://bucket/prefix/ holding workflow templates as <template_id>.json. Empty
+# disables templates, tasks then have to carry their whole workflow
+WORKFLOW_TEMPLATE_PATH = os.getenv("WORKFLOW_TEMPLATE_PATH", "")
+# Seconds a loaded template is used before checking for a newer version
+WORKFLOW_TEMPLATE_CACHE_SECONDS = int(os.getenv("WORKFLOW_TEMPLATE_CACHE_SECONDS", "300"))
+
+TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+}
+
+class TemplateError(ValueError):
+    """A template or the parameters of a task using it are invalid"""
+
+class Template(object):
+    """A validated workflow graph and the node inputs its parameters are written to"""
+
+    def __init__(self, template_id: str, definition: dict, version: str = None):
+        self.template_id = template_id
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.workflow = definition.get("workflow")
+        self.parameters = definition.get("parameters") or {}
+        self._validate()
+        # Nodes written by any parameter, copied per task while the others are shared
+        self.touched = {node for spec in self.parameters.values() for node, _ in spec["targets"]}
+
+    def _validate(self):
+        if not isinstance(self.workflow, dict) or not self.workflow:
+            raise TemplateError(f"Template {self.template_id} has no workflow")
+        for node_id, node in self.workflow.items():
+            if not isinstance(node, dict) or "class_type" not in node or not isinstance(node.get("inputs"), dict):
+                raise TemplateError(f"Template {self.template_id}: node {node_id} needs class_type and inputs")
+            for name, value in node["inputs"].items():
+                # Links are [node ID, output index]
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int) \
+                        and str(value[0]) not in self.workflow:
+                    raise TemplateError(f"Template {self.template_id}: {node_id}.{name} links to missing node {value[0]}")
+        for name, spec in self.parameters.items():
+            if not isinstance(spec, dict) or spec.get("type") not in TYPES:
+                raise TemplateError(f"Template {self.template_id}: parameter {name} needs a type of {', '.join(TYPES)}")
+            targets = spec.get("targets")
+            if not targets or not all(isinstance(t, list) and len(t) == 2 for t in targets):
+                raise TemplateError(f"Template {self.template_id}: parameter {name} needs targets as [node, input] pairs")
+            spec["targets"] = [(str(node), input_name) for node, input_name in targets]
+            for node, _ in spec["targets"]:
+                if node not in self.workflow:
+                    raise TemplateError(f"Template {self.template_id}: parameter {name} targets missing node {node}")
+            if "default" in spec:
+                _check_type(self.template_id, name, spec, spec["default"])
+
+    def render(self, parameters: dict) -> dict:
+        """Workflow with parameters filled in. Nodes no parameter writes to are shared with
+        the template and must not be modified"""
+        unknown = set(parameters) - set(self.parameters)
+        if unknown:
+            raise TemplateError(f"Template {self.template_id} has no parameters {', '.join(sorted(unknown))}")
+        workflow = dict(self.workflow)
+        for node_id in self.touched:
+            node = dict(workflow[node_id])
+            node["inputs"] = dict(node["inputs"])
+            workflow[node_id] = node
+        for name, spec in self.parameters.items():
+            if name in parameters:
+                value = parameters[name]
+                _check_type(self.template_id, name, spec, value)
+            elif "default" in spec:
+                value = spec["default"]
+            else:
+                raise TemplateError(f"Template {self.template_id} requires parameter {name}")
+            for node_id, input_name in spec["targets"]:
+                workflow[node_id]["inputs"][input_name] = value
+        return workflow
+
+def _check_type(template_id: str, name: str, spec: dict, value) -> None:
+    # bool is an int in Python, but not an integer here
+    if not isinstance(value, TYPES[spec["type"]]) or (spec["type"] != "boolean" and isinstance(value, bool)):
+        raise TemplateError(f"Template {template_id}: parameter {name} must be a {spec['type']}")
+
+_cache = {}
+_lock = threading.Lock()
+
+def is_template_request(body) -> bool:
+    return isinstance(body, dict) and "template_id" in body
+
+def _load(template_id: str, cached: Template = None) -> Template:
+    """Read a template, returning cached when it did not change"""
+    if WORKFLOW_TEMPLATE_PATH.startswith("s3://"):
+        bucket, prefix = s3_action.get_bucket_and_key(WORKFLOW_TEMPLATE_PATH.rstrip("/") + "/")
+        kwargs = {"IfNoneMatch": cached.version} if cached is not None and cached.version else {}
+        try:
+            response = s3_action.get_client().get_object(Bucket=bucket, Key=f"{prefix}{template_id}.json", **kwargs)
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in ("304", "NotModified"):
+                return cached
+            raise
+        data, version = response["Body"].read(), response.get("ETag")
+    else:
+        path = os.path.join(WORKFLOW_TEMPLATE_PATH, f"{template_id}.json")
+        version = str(os.stat(path).st_mtime_ns)
+        if cached is not None and cached.version == version:
+            return cached
+        with open(path, "rb") as f:
+            data = f.read()
+    template = Template(template_id, json.loads(data), version)
+    logger.info(f"Loaded workflow template {template_id} with {len(template.workflow)} nodes "
+                f"and parameters {', '.join(template.parameters) or 'none'}")
+    return template
+
+def get(template_id: str) -> Template:
+    """Validated template, from the cache while it is fresh"""
+    if not WORKFLOW_TEMPLATE_PATH:
+        raise TemplateError("Workflow templates are not enabled, set WORKFLOW_TEMPLATE_PATH")
+    if not isinstance(template_id, str) or not template_id.replace("-", "").replace("_", "").isalnum():
+        raise TemplateError(f"Invalid template ID {template_id}")
+    with _lock:
+        cached = _cache.get(template_id)
+    if cached is not None and time.monotonic() - cached.loaded_at < WORKFLOW_TEMPLATE_CACHE_SECONDS:
+        return cached
+    try:
+        template = _load(template_id, cached)
+    except (OSError, ValueError) as e:
+        if isinstance(e, TemplateError):
+            raise
+        raise TemplateError(f"Failed to load template {template_id}: {str(e)}") from e
+    except Exception as e:
+        if cached is not None:
+            # Keep serving the last good version while the store is unavailable
+            logger.warning(f"Failed to refresh template {template_id}, using the cached one: {str(e)}")
+            template = cached
+        else:
+            raise TemplateError(f"Failed to load template {template_id}: {str(e)}") from e
+    template.loaded_at = time.monotonic()
+    with _lock:
+        _cache[template_id] = template
+    return template
+
+def render(body: dict) -> dict:
+    """Workflow of a task given as {"template_id": ..., "parameters": {...}}"""
+    parameters = body.get("parameters") or {}
+    if not isinstance(parameters, dict):
+        raise TemplateError("Template parameters must be an object")
+    return get(body["template_id"]).render(parameters)
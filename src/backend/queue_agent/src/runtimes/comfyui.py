@@ -3,6 +3,8 @@
 
 import json
 import logging
+import os
+import threading
 import time
 import traceback
 import urllib.parse
@@ -10,37 +12,31 @@ import uuid
 from typing import Optional, Dict, List, Any, Union
 
 import websocket  # NOTE: websocket-client (https://github.com/websocket-client/websocket-client)
-from modules import http_action
+from modules import backend_pool, http_action, log_utils, time_utils, tracing
 
 logger = logging.getLogger("queue-agent")
 
-# Import the safe_xray_capture decorator from main module
-try:
-    from src.main import safe_xray_capture, xray_enabled
-except ImportError:
-    try:
-        # Try alternative import path
-        from ..main import safe_xray_capture, xray_enabled
-    except ImportError:
-        # Fallback if import fails - create a simple pass-through decorator
-        logger.warning("Failed to import safe_xray_capture from main, using fallback")
-        def safe_xray_capture(name):
-            def decorator(func):
-                return func
-            return decorator
-        xray_enabled = False
-
 # Constants for websocket reconnection
 MAX_RECONNECT_ATTEMPTS = 5
 RECONNECT_DELAY = 2  # seconds
 
+# Workflow inputs naming the model files a task runs with
+MODEL_INPUT_KEYS = ['ckpt_name', 'unet_name']
+
+# Total bytes of the outputs of one task, larger tasks fail instead of filling the agent's disk. 0 for no limit
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", str(4 * 1024 * 1024 * 1024)))
+
 def singleton(cls):
+    """One instance per backend URL"""
     _instance = {}
-
-    def inner():
-        if cls not in _instance:
-            _instance[cls] = cls()
-        return _instance[cls]
+    _lock = threading.Lock()
+
+    def inner(api_base_url: str = None):
+        with _lock:
+            if api_base_url not in _instance:
+                _instance[api_base_url] = cls()
+                _instance[api_base_url].setUrl(api_base_url)
+            return _instance[api_base_url]
     return inner
 
 @singleton
@@ -139,14 +135,18 @@ class comfyuiCaller(object):
             logger.error(f"Error in queue_prompt: {str(e)}")
             return None
 
-    def get_image(self, filename, subfolder, folder_type):
+    def get_image(self, filename, subfolder, folder_type, max_bytes=0, budget=None):
+        """Output file streamed into a temporary file, which the caller closes. Outputs of one
+        task share budget, the memory they may hold before spilling to disk"""
         try:
             data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
             url_values = urllib.parse.urlencode(data)
             url = f"http://{self.api_base_url}/view?{url_values}"
 
-            # Use http_action.get which returns bytes directly
-            return http_action.get(url)
+            # Videos can be larger than the agent's memory, they are spooled to disk
+            return http_action.download_spooled(url, max_bytes, budget)
+        except http_action.ResponseTooLarge:
+            raise
         except Exception as e:
             logger.error(f"Error getting image {filename}: {str(e)}")
             return b''  # Return empty bytes on error
@@ -175,7 +175,7 @@ class comfyuiCaller(object):
                 if isinstance(out, str):
                     try:
                         message = json.loads(out)
-                        logger.debug(out)
+                        logger.debug("Websocket message: %s", log_utils.redact(out))
                         if message['type'] == 'progress':
                             data = message['data']
                             current_step = data['value']
@@ -212,6 +212,37 @@ class comfyuiCaller(object):
 
         return True
 
+    def get_outputs(self, prompt_id):
+        output_images = {}
+        history = self.get_history(prompt_id)[prompt_id]
+        total = 0
+        budget = http_action.SpoolBudget()
+        try:
+            for node_id in history['outputs']:
+                node_output = history['outputs'][node_id]
+                # image branch, then video branch
+                for kind in ('images', 'videos'):
+                    if kind not in node_output:
+                        continue
+                    # A node may output both, keep the files of each
+                    files_output = output_images.setdefault(node_id, [])
+                    for item in node_output[kind]:
+                        remaining = OUTPUT_MAX_BYTES - total if OUTPUT_MAX_BYTES else 0
+                        try:
+                            if OUTPUT_MAX_BYTES and remaining <= 0:
+                                raise http_action.ResponseTooLarge(item['filename'])
+                            file_data = self.get_image(item['filename'], item['subfolder'], item['type'], remaining,
+                                                       budget)
+                        except http_action.ResponseTooLarge as e:
+                            raise http_action.ResponseTooLarge(
+                                f"Outputs of prompt {prompt_id} are more than OUTPUT_MAX_BYTES={OUTPUT_MAX_BYTES}") from e
+                        files_output.append(file_data)
+                        total += output_size(file_data)
+        except BaseException:
+            close_outputs(post_invocations(output_images))
+            raise
+        return output_images
+
     def get_images(self, prompt):
         max_retries = 3
         retry_count = 0
@@ -223,32 +254,20 @@ class comfyuiCaller(object):
                     raise RuntimeError("Failed to queue prompt - internal error")
 
                 prompt_id = output['prompt_id']
-                output_images = {}
-
-                self.track_progress(prompt, prompt_id)
-
-                history = self.get_history(prompt_id)[prompt_id]
-                for o in history['outputs']:
-                    for node_id in history['outputs']:
-                        node_output = history['outputs'][node_id]
-                        # image branch
-                        if 'images' in node_output:
-                            images_output = []
-                            for image in node_output['images']:
-                                image_data = self.get_image(image['filename'], image['subfolder'], image['type'])
-                                images_output.append(image_data)
-                            output_images[node_id] = images_output
-                        # video branch
-                        if 'videos' in node_output:
-                            videos_output = []
-                            for video in node_output['videos']:
-                                video_data = self.get_image(video['filename'], video['subfolder'], video['type'])
-                                videos_output.append(video_data)
-                            output_images[node_id] = videos_output
+
+                with time_utils.stage("inference"):
+                    self.track_progress(prompt, prompt_id)
+
+                with time_utils.stage("output_fetch"):
+                    output_images = self.get_outputs(prompt_id)
 
                 # If we got here, everything worked
                 return output_images
 
+            except http_action.ResponseTooLarge:
+                # Running the prompt again would produce the same outputs
+                raise
+
             except websocket.WebSocketConnectionClosedException as e:
                 retry_count += 1
                 logger.warning(f"WebSocket connection closed during processing (attempt {retry_count}/{max_retries})")
@@ -284,13 +303,12 @@ class comfyuiCaller(object):
         raise RuntimeError(f"Failed to process images after {max_retries} attempts")
 
     def parse_worflow(self, prompt_data):
-        logger.debug(prompt_data)
+        logger.debug("Workflow: %s", log_utils.redact(prompt_data))
         return self.get_images(prompt_data)
 
 
 def check_readiness(api_base_url: str) -> bool:
-    cf = comfyuiCaller()
-    cf.setUrl(api_base_url)
+    cf = comfyuiCaller(api_base_url)
     logger.info("Init health check... ")
     try:
         logger.info(f"Try to connect to ComfyUI backend {api_base_url} ... ")
@@ -305,11 +323,18 @@ def check_readiness(api_base_url: str) -> bool:
         return False
 
 
+def interrupt(api_base_url: str) -> None:
+    """Stop the prompt in progress"""
+    response = http_action.apiClient.post(f"http://{api_base_url}/interrupt", timeout=(1, 10))
+    response.raise_for_status()
+
+
 def handler(api_base_url: str, task_id: str, payload: dict) -> dict:
     response = {
         "success": False,
         "image": [],
-        "content": '{"code": 500}'
+        "content": '{"code": 500}',
+        "model": get_model_names(payload)
     }
 
     try:
@@ -320,7 +345,8 @@ def handler(api_base_url: str, task_id: str, payload: dict) -> dict:
             images = invoke_pipeline(api_base_url, payload)
 
             # Process images if available
-            imgOutputs = post_invocations(images)
+            with time_utils.stage("decode"):
+                imgOutputs = post_invocations(images)
             logger.info(f"Received {len(imgOutputs)} images")
 
             # Set success response
@@ -328,9 +354,13 @@ def handler(api_base_url: str, task_id: str, payload: dict) -> dict:
             response["image"] = imgOutputs
             response["content"] = '{"code": 200}'
             logger.info(f"End process pipeline task with ID: {task_id}")
+        except http_action.ResponseTooLarge as e:
+            logger.error(f"Pipeline task {task_id} failed: {str(e)}")
+            response["content"] = json.dumps({"code": 413, "error": str(e)})
         except Exception as e:
             logger.error(f"Error processing pipeline: {str(e)}")
             # Keep default failure response
+            response["backend_error"] = backend_pool.backend_fault(e, (websocket.WebSocketException,))
     except Exception as e:
         # This is a catch-all for any unexpected errors
         logger.error(f"Unexpected error in handler for task ID {task_id}: {str(e)}")
@@ -338,10 +368,9 @@ def handler(api_base_url: str, task_id: str, payload: dict) -> dict:
 
     return response
 
-@safe_xray_capture('comfyui-pipeline')
+@tracing.capture('comfyui-pipeline')
 def invoke_pipeline(api_base_url: str, body) -> str:
-    cf = comfyuiCaller()
-    cf.setUrl(api_base_url)
+    cf = comfyuiCaller(api_base_url)
 
     # Ensure websocket connection is established before proceeding
     if not cf.wss_connect():
@@ -357,4 +386,28 @@ def post_invocations(image):
             for image_data in image[node_id]:
                 img_bytes.append(image_data)
 
-    return img_bytes
\ No newline at end of file
+    return img_bytes
+
+def output_size(output) -> int:
+    if isinstance(output, bytes):
+        return len(output)
+    size = output.seek(0, os.SEEK_END)
+    output.seek(0)
+    return size
+
+def close_outputs(outputs) -> None:
+    """Release the temporary files of downloaded outputs"""
+    for output in outputs:
+        if hasattr(output, 'close'):
+            output.close()
+
+def get_model_names(workflow) -> str:
+    """Return the model files referenced by a workflow, comma separated"""
+    names = []
+    if isinstance(workflow, dict):
+        for node in workflow.values():
+            inputs = node.get('inputs', {}) if isinstance(node, dict) else {}
+            for key in MODEL_INPUT_KEYS:
+                if isinstance(inputs.get(key), str) and inputs[key] not in names:
+                    names.append(inputs[key])
+    return ','.join(names) if names else None
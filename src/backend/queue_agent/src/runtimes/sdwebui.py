@@ -2,46 +2,56 @@
 # SPDX-License-Identifier: MIT-0
 
 import base64
+import contextlib
 import json
 import logging
+import os
+import threading
 import time
 import traceback
 
 from requests.exceptions import ReadTimeout, HTTPError
-from modules import http_action, misc
+from modules import backend_pool, http_action, image_utils, log_utils, misc, time_utils, tracing
 
 logger = logging.getLogger("queue-agent")
 
+# Checkpoint currently loaded in each SD Web UI backend, reported with every task result
+current_models = {}
+
+# Backoff between readiness checks while SD Web UI is starting
+READINESS_INITIAL_DELAY = 0.5  # seconds
+READINESS_MAX_DELAY = 5  # seconds
+
+# Seconds between polls of /progress while SD Web UI generates, 0 disables the watchdog
+PROGRESS_POLL_SECONDS = float(os.getenv("PROGRESS_POLL_SECONDS", "2"))
+# A generation whose sampling step has not advanced for this long is interrupted
+PROGRESS_STALL_SECONDS = float(os.getenv("PROGRESS_STALL_SECONDS", "60"))
+# A generation whose elapsed time plus SD Web UI's ETA is more than this many times the
+# task's estimated GPU-seconds, and at least PROGRESS_STALL_SECONDS, is interrupted. 0 only
+# interrupts generations that are not going to finish within the request timeout
+PROGRESS_BUDGET_FACTOR = float(os.getenv("PROGRESS_BUDGET_FACTOR", "0"))
+# Seconds between progress notifications of a running task, 0 sends none
+PROGRESS_UPDATE_SECONDS = float(os.getenv("PROGRESS_UPDATE_SECONDS", "0"))
+# SD Web UI extrapolates its ETA from the progress so far, too roughly before this much
+ETA_MIN_PROGRESS = 0.1
+
 ALWAYSON_SCRIPTS_EXCLUDE_KEYS = ['task', 'id_task', 'uid',
                                  'sd_model_checkpoint', 'image_link', 'save_dir', 'sd_vae', 'override_settings']
 
-# Import the safe_xray_capture decorator from main module
-try:
-    from src.main import safe_xray_capture, xray_enabled
-except ImportError:
-    try:
-        # Try alternative import path
-        from ..main import safe_xray_capture, xray_enabled
-    except ImportError:
-        # Fallback if import fails - create a simple pass-through decorator
-        logger.warning("Failed to import safe_xray_capture from main, using fallback")
-        def safe_xray_capture(name):
-            def decorator(func):
-                return func
-            return decorator
-        xray_enabled = False
-
 def check_readiness(api_base_url: str, dynamic_sd_model: bool) -> bool:
     """Check if SD Web UI is ready by invoking /option endpoint"""
+    delay = READINESS_INITIAL_DELAY
     while True:
         try:
             logger.info('Checking service readiness...')
             # checking with options "sd_model_checkpoint" also for caching current model
-            opts = invoke_get_options(api_base_url)
+            # probe() bypasses the connect retries of the API client, which back off for up to 2 minutes
+            opts = http_action.probe(api_base_url+"options")
             logger.info('Service is ready.')
             if "sd_model_checkpoint" in opts:
                 if opts['sd_model_checkpoint'] != None:
                     current_model_name = opts['sd_model_checkpoint']
+                    current_models[api_base_url] = current_model_name
                     logger.info(f'Init model is: {current_model_name}.')
                 else:
                     if dynamic_sd_model:
@@ -51,12 +61,107 @@ def check_readiness(api_base_url: str, dynamic_sd_model: bool) -> bool:
             break
         except Exception as e:
             logger.debug(repr(e))
-            time.sleep(1)
+            time.sleep(delay)
+            delay = min(delay * 2, READINESS_MAX_DELAY)
     return True
 
-def handler(api_base_url: str, task_type: str, task_id: str, payload: dict, dynamic_sd_model: bool) -> dict:
-    """Main handler for SD Web UI request"""
+class TaskStalled(Exception):
+    pass
+
+class ProgressWatchdog(object):
+    """Polls /progress while a generation runs and interrupts it when its sampling step stops
+    advancing, or when it is not going to finish within its budget. Used as a context manager
+    around the generation request, which then raises TaskStalled if it was interrupted.
+
+    Before the first sampling step, e.g. while a checkpoint from override_settings loads,
+    only the budget applies.
+    """
+
+    def __init__(self, api_base_url: str, task_id: str, estimated_cost: float = None, on_progress=None):
+        self.api_base_url = api_base_url
+        self.task_id = task_id
+        self.budget = http_action.REQUESTS_TIMEOUT_SECONDS
+        if PROGRESS_BUDGET_FACTOR > 0 and estimated_cost:
+            self.budget = min(self.budget, max(estimated_cost * PROGRESS_BUDGET_FACTOR, PROGRESS_STALL_SECONDS))
+        self.on_progress = on_progress
+        self.reason = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def __enter__(self):
+        if PROGRESS_POLL_SECONDS > 0:
+            threading.Thread(target=self._run, name=f"watchdog-{self.task_id}", daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Not joined, a poll of a runtime that stopped answering takes up to its timeout
+        with self.lock:
+            self.done.set()
+            reason = self.reason
+        if reason is not None:
+            raise TaskStalled(f"Generation interrupted, {reason}") from exc
+        return False
+
+    def _run(self):
+        started = time.monotonic()
+        last_state, changed_at, updated_at = None, started, started
+        sampling = False
+        step = steps = 0
+        while not self.done.wait(PROGRESS_POLL_SECONDS):
+            now = time.monotonic()
+            try:
+                progress = http_action.probe(self.api_base_url + "progress?skip_current_image=true")
+            except Exception as e:
+                # Counts as no progress, a runtime that doesn't answer is stalled too
+                logger.debug(f"Failed to poll progress of task {self.task_id}: {str(e)}")
+                progress = {}
+            if progress:
+                state = progress.get("state") or {}
+                step, steps = state.get("sampling_step") or 0, state.get("sampling_steps") or 0
+                current = (state.get("job"), state.get("job_no"), step, progress.get("progress"))
+                if current != last_state:
+                    last_state, changed_at = current, now
+                # Idle SD Web UI reports a job count of 0, and the steps of its last job
+                sampling = sampling or bool(state.get("job_count") and step > 0)
+
+            fraction, eta = progress.get("progress") or 0.0, progress.get("eta_relative") or 0.0
+            if sampling and now - changed_at > PROGRESS_STALL_SECONDS:
+                reason = f"no progress for {now - changed_at:.0f}s at step {step}/{steps}"
+            elif fraction >= ETA_MIN_PROGRESS and now - started + eta > self.budget:
+                reason = f"expected to take {now - started + eta:.0f}s, more than the budget of {self.budget:.0f}s"
+            else:
+                reason = None
+            if reason is not None:
+                self._interrupt(reason)
+                return
+
+            if self.on_progress is not None and PROGRESS_UPDATE_SECONDS > 0 and fraction > 0 \
+                    and now - updated_at >= PROGRESS_UPDATE_SECONDS:
+                updated_at = now
+                try:
+                    self.on_progress({"progress": round(fraction, 3), "eta_seconds": round(eta, 1),
+                                      "step": step, "steps": steps})
+                except Exception as e:
+                    logger.warning(f"Failed to report progress of task {self.task_id}: {str(e)}")
+
+    def _interrupt(self, reason: str):
+        with self.lock:
+            # The generation finished while this poll was in flight
+            if self.done.is_set():
+                return
+            self.reason = reason
+        logger.warning(f"Interrupting task {self.task_id} on {self.api_base_url}: {reason}")
+        try:
+            http_action.probe(self.api_base_url + "interrupt", {})
+        except Exception as e:
+            logger.error(f"Failed to interrupt task {self.task_id}: {str(e)}")
+
+def handler(api_base_url: str, task_type: str, task_id: str, payload: dict, dynamic_sd_model: bool,
+            estimated_cost: float = None, on_progress=None) -> dict:
+    """Main handler for SD Web UI request. txt2img and img2img run under a ProgressWatchdog
+    budgeted from estimated_cost, which calls on_progress(progress) with throttled updates"""
     response = {}
+    watchdog = ProgressWatchdog(api_base_url, task_id, estimated_cost, on_progress)
     try:
         logger.info(f"Start process {task_type} task with ID: {task_id}")
         match task_type:
@@ -67,14 +172,15 @@ def handler(api_base_url: str, task_type: str, task_id: str, payload: dict, dyna
                     if dynamic_sd_model and payload['alwayson_scripts']['sd_model_checkpoint']:
                         new_model = payload['alwayson_scripts']['sd_model_checkpoint']
                         logger.info(f'Try to switching model to: {new_model}.')
-                        current_model_name = switch_model(api_base_url, new_model)
+                        with time_utils.stage("model_switch"):
+                            current_model_name = switch_model(api_base_url, new_model)
                         if current_model_name is None:
                             raise Exception(f'Failed to switch model to {new_model}')
                         logger.info(f'Current model is: {current_model_name}.')
                 else:
                     payload.update({'alwayson_scripts': {}})
 
-                task_response = invoke_txt2img(api_base_url, payload)
+                task_response = invoke_txt2img(api_base_url, payload, watchdog)
 
             case 'image-to-image':
                 # Compatiability for v1alpha1: Ensure there is an alwayson_scripts
@@ -83,14 +189,15 @@ def handler(api_base_url: str, task_type: str, task_id: str, payload: dict, dyna
                     if dynamic_sd_model and payload['alwayson_scripts']['sd_model_checkpoint']:
                         new_model = payload['alwayson_scripts']['sd_model_checkpoint']
                         logger.info(f'Try to switching model to: {new_model}.')
-                        current_model_name = switch_model(api_base_url, new_model)
+                        with time_utils.stage("model_switch"):
+                            current_model_name = switch_model(api_base_url, new_model)
                         if current_model_name is None:
                             raise Exception(f'Failed to switch model to {new_model}')
                         logger.info(f'Current model is: {current_model_name}.')
                 else:
                     payload.update({'alwayson_scripts': {}})
 
-                task_response = invoke_img2img(api_base_url, payload)
+                task_response = invoke_img2img(api_base_url, payload, watchdog)
             case 'extra-single-image':
                 # There is no alwayson_script in API spec
                 task_response = invoke_extra_single_image(api_base_url, payload)
@@ -100,7 +207,8 @@ def handler(api_base_url: str, task_type: str, task_id: str, payload: dict, dyna
                 # Catch all
                 logger.error(f'Unsupported task type: {task_type}, ignoring')
 
-        imgOutputs = post_invocations(task_response)
+        with time_utils.stage("decode"):
+            imgOutputs = post_invocations(task_response)
         logger.info(f"Received {len(imgOutputs)} images")
         content = json.dumps(succeed(task_id, task_response))
         response["success"] = True
@@ -113,17 +221,22 @@ def handler(api_base_url: str, task_type: str, task_id: str, payload: dict, dyna
         logger.error(f"{task_type} task with ID: {task_id} timeouted")
         traceback.print_exc()
         response["success"] = False
+        response["image"] = []
         response["content"] = content
+        response["backend_error"] = True
     except Exception as e:
         content = json.dumps(failed(task_id, e))
         logger.error(f"{task_type} task with ID: {task_id} finished with error")
         traceback.print_exc()
         response["success"] = False
+        response["image"] = []
         response["content"] = content
+        response["backend_error"] = backend_pool.backend_fault(e, (TaskStalled,))
+    response["model"] = current_models.get(api_base_url)
     return response
 
-@safe_xray_capture('text-to-image')
-def invoke_txt2img(api_base_url: str, body) -> str:
+@tracing.capture('text-to-image')
+def invoke_txt2img(api_base_url: str, body, watchdog: ProgressWatchdog = None) -> str:
     # Compatiability for v1alpha1: Move override_settings from header to body
     override_settings = {}
     if 'override_settings' in body['alwayson_scripts']:
@@ -138,16 +251,19 @@ def invoke_txt2img(api_base_url: str, body) -> str:
     body.update({'alwayson_scripts': misc.exclude_keys(body['alwayson_scripts'], ALWAYSON_SCRIPTS_EXCLUDE_KEYS)})
 
     # Process image link in elsewhere in body
-    body = download_image(body)
+    with time_utils.stage("download"):
+        body = download_image(body, target=presize_target(body))
 
-    response = http_action.do_invocations(api_base_url+"txt2img", body)
+    with time_utils.stage("inference"), watchdog or contextlib.nullcontext():
+        response = http_action.do_invocations(api_base_url+"txt2img", body)
     return response
 
-@safe_xray_capture('image-to-image')
-def invoke_img2img(api_base_url: str, body: dict) -> str:
+@tracing.capture('image-to-image')
+def invoke_img2img(api_base_url: str, body: dict, watchdog: ProgressWatchdog = None) -> str:
     """Image-to-Image request"""
     # Process image link
-    body = download_image(body)
+    with time_utils.stage("download"):
+        body = download_image(body, target=presize_target(body))
 
     # Compatiability for v1alpha1: Move override_settings from header to body
     override_settings = {}
@@ -167,19 +283,24 @@ def invoke_img2img(api_base_url: str, body: dict) -> str:
     # Compatiability for v1alpha1: Remove header used for routing in v1alpha1 API request
     body.update({'alwayson_scripts': misc.exclude_keys(body['alwayson_scripts'], ALWAYSON_SCRIPTS_EXCLUDE_KEYS)})
 
-    response = http_action.do_invocations(api_base_url+"img2img", body)
+    with time_utils.stage("inference"), watchdog or contextlib.nullcontext():
+        response = http_action.do_invocations(api_base_url+"img2img", body)
     return response
 
-@safe_xray_capture('extra-single-image')
+@tracing.capture('extra-single-image')
 def invoke_extra_single_image(api_base_url: str, body) -> str:
-    body = download_image(body)
-    response = http_action.do_invocations(api_base_url+"extra-single-image", body)
+    with time_utils.stage("download"):
+        body = download_image(body)
+    with time_utils.stage("inference"):
+        response = http_action.do_invocations(api_base_url+"extra-single-image", body)
     return response
 
-@safe_xray_capture('extra-batch-images')
+@tracing.capture('extra-batch-images')
 def invoke_extra_batch_images(api_base_url: str, body) -> str:
-    body = download_image(body)
-    response = http_action.do_invocations(api_base_url+"extra-batch-images", body)
+    with time_utils.stage("download"):
+        body = download_image(body)
+    with time_utils.stage("inference"):
+        response = http_action.do_invocations(api_base_url+"extra-batch-images", body)
     return response
 
 def invoke_set_options(api_base_url: str, options: dict) -> str:
@@ -200,6 +321,10 @@ def invoke_unload_checkpoints(api_base_url: str) -> str:
 def invoke_interrupt(api_base_url: str) -> str:
     return http_action.do_invocations(api_base_url+"interrupt", {})
 
+def interrupt(api_base_url: str) -> None:
+    """Stop the generation in progress"""
+    invoke_interrupt(api_base_url)
+
 def switch_model(api_base_url: str, name: str) -> str:
     opts = invoke_get_options(api_base_url)
     current_model_name = opts['sd_model_checkpoint']
@@ -225,6 +350,7 @@ def switch_model(api_base_url: str, name: str) -> str:
             logger.error(f"Model {name} not found, keeping current model.")
             return None
 
+    current_models[api_base_url] = current_model_name
     return current_model_name
 
 # Customizable for success responses
@@ -253,29 +379,42 @@ def failed(task_id, exception):
     parameters['id_task'] = task_id
     parameters['status'] = 0
     parameters['error_msg'] = repr(exception)
-    parameters['reason'] = exception.response.json() if hasattr(exception, "response") else None
+    parameters['reason'] = None
+    if getattr(exception, "response", None) is not None:
+        try:
+            parameters['reason'] = exception.response.json()
+        except ValueError:
+            # Not every runtime error is JSON, e.g. a proxy's error page
+            parameters['reason'] = exception.response.text
     return {
         'images': [''],
         'parameters': parameters,
         'info': ''
     }
 
-def download_image(obj, path=""):
-    """Search URL in object, and replace all URL with content of URL"""
+def presize_target(body: dict):
+    """Size input images of a generation request are downscaled to, None when presizing is off"""
+    return image_utils.target_size(body) if image_utils.IMAGE_PRESIZE else None
+
+def download_image(obj, path="", target=None):
+    """Search URL in object, and replace all URL with content of URL, downscaled to cover target if given"""
     if isinstance(obj, dict):
         for key, value in obj.items():
             new_path = f"{path}.{key}" if path else key
-            obj[key] = download_image(value, new_path)
+            obj[key] = download_image(value, new_path, target)
     elif isinstance(obj, list):
         for index, item in enumerate(obj):
             new_path = f"{path}[{index}]"
-            obj[index] = download_image(item, new_path)
+            obj[index] = download_image(item, new_path, target)
     elif isinstance(obj, str):
         if (obj.startswith('http') or obj.startswith('s3://')):
-            logger.info(f"Found URL {obj} in {path}, replacing... ")
+            logger.info("Found URL %s in %s, replacing... ", log_utils.redact(obj), path)
             try:
-                image_byte = misc.encode_to_base64(http_action.get(obj))
-                logger.info(f"Replaced {path} with content")
+                data = http_action.get(obj)
+                if target is not None:
+                    data = image_utils.presize(data, target, path)
+                image_byte = misc.encode_to_base64(data)
+                logger.info("Replaced %s with content", path)
             except Exception as e:
                 logger.error(f"Error fetching URL: {obj}")
                 logger.error(f"Error: {str(e)}")
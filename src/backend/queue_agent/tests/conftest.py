@@ -0,0 +1,12 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import sys
+
+# The agent's modules are imported the way main.py imports them, from src/
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# main.py reads its settings at import time
+os.environ.setdefault("RUNTIME_TYPE", "comfyui")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
@@ -0,0 +1,45 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import threading
+
+import pytest
+
+from modules import cost_model, fair_queue, sqs_action
+
+
+class _Message(object):
+    def __init__(self, tenant: str, index: int):
+        self.body = json.dumps({"Message": json.dumps({
+            "metadata": {"id": f"{tenant}-{index}", "tasktype": "text-to-image", "prefix": tenant},
+            "content": {"steps": 20, "width": 512, "height": 512}})})
+        self.attributes = {}
+        self.receipt_handle = f"{tenant}-{index}"
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    monkeypatch.setattr(fair_queue, "TENANT_KEY", "prefix")
+    monkeypatch.setattr(fair_queue.tenant_of, "__defaults__", ("prefix",))
+    monkeypatch.setattr(sqs_action, "change_visibility_batch", lambda queue, messages, timeout: None)
+    return fair_queue.FairQueue(queue=None, weights={})
+
+
+def test_pop_with_zero_quantum(queue, monkeypatch):
+    # COST_SECONDS_PER_UNIT=0 and no task observed yet
+    monkeypatch.setattr(cost_model, "COST_SECONDS_PER_UNIT", 0.0)
+    monkeypatch.setattr(cost_model, "_mean_task_cost", None)
+    monkeypatch.setattr(cost_model, "seconds_per_unit", lambda tasktype: 0.0)
+    assert cost_model.mean_task_cost() == 0
+    queue.add([_Message("team-a", i) for i in range(3)] + [_Message("team-b", i) for i in range(3)])
+
+    popped = []
+    thread = threading.Thread(target=lambda: popped.extend(iter(queue.pop, None)), daemon=True)
+    thread.start()
+    thread.join(5)
+
+    assert not thread.is_alive(), "pop did not return"
+    assert len(popped) == 6
+    # Tenants still take turns
+    assert [e.payload["metadata"]["prefix"] for e in popped[:2]] == ["team-a", "team-b"]
@@ -0,0 +1,67 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import pytest
+
+import main
+
+BUCKET = "outputs"
+PREFIX = "sdruntime"
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Uploads by S3 URL, nothing is sent to S3"""
+    objects = {}
+
+    def upload_file(body, bucket_name, prefix, file_name=None, extension=None):
+        url = f"s3://{bucket_name}/{prefix}/{file_name}{extension}"
+        objects[url] = body
+        return url
+
+    monkeypatch.setattr(main.s3_action, "upload_file", upload_file)
+    # Presigned URLs with a session token are about 2 KB
+    monkeypatch.setattr(main.s3_action, "presign", lambda url, expires_in: "https://" + url[5:] + "?" + "x" * 2000)
+    monkeypatch.setattr(main, "PRESIGNED_URL_EXPIRY", 3600)
+    return objects
+
+
+def _notification(images: int, output_bytes: int) -> dict:
+    image_urls = [f"s3://{BUCKET}/{PREFIX}/task-abcd-{i}.png" for i in range(images)]
+    notification = {"runtime": "sdruntime", "id": "task", "result": True, "status": "completed",
+                    "image_url": image_urls, "output": {"info": "x" * output_bytes}, "context": {}}
+    notification.update(main.presigned_urls(image_urls))
+    return notification
+
+
+def test_small_notification_is_unchanged(uploads):
+    notification = _notification(4, 1024)
+    expected = json.loads(json.dumps(notification))
+    assert main.fit_notification(notification, BUCKET, PREFIX, "task-abcd") == expected
+    assert uploads == {}
+
+
+def test_large_image_list_fits_sns_limit(uploads):
+    notification = _notification(200, 120 * 1024)
+    assert main.notification_size(notification) > main.SNS_MESSAGE_MAX_BYTES
+
+    main.fit_notification(notification, BUCKET, PREFIX, "task-abcd")
+
+    assert main.notification_size(notification) <= main.SNS_MESSAGE_MAX_BYTES
+    assert "output" not in notification
+    assert json.loads(uploads[notification["output_url"]]) == {"info": "x" * 120 * 1024}
+    assert notification["output_presigned_url"].startswith("https://")
+    assert "image_presigned_url" not in notification
+    assert len(notification["image_url"]) == 200
+
+
+def test_image_urls_move_to_s3_when_still_too_large(uploads):
+    notification = _notification(6000, 0)
+
+    main.fit_notification(notification, BUCKET, PREFIX, "task-abcd")
+
+    assert main.notification_size(notification) <= main.SNS_MESSAGE_MAX_BYTES
+    assert notification["image_url"] == []
+    assert len(json.loads(uploads[notification["image_list_url"]])) == 6000
@@ -0,0 +1,79 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from modules import http_action
+from runtimes import comfyui
+
+BUDGET = 1024 * 1024
+# Just under the budget, so that each output alone would be kept in memory
+OUTPUT_BYTES = BUDGET - 1
+OUTPUTS = 20
+
+
+class _ViewHandler(BaseHTTPRequestHandler):
+    """ComfyUI /view serving OUTPUT_BYTES for every file"""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(OUTPUT_BYTES))
+        self.end_headers()
+        self.wfile.write(b"\0" * OUTPUT_BYTES)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _ViewHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _in_memory_bytes(outputs) -> int:
+    # A SpooledTemporaryFile keeps its content in a BytesIO until it is rolled over
+    return sum(len(output._file.getvalue()) for output in outputs if not output._rolled)
+
+
+def test_shared_budget_limits_memory_of_all_downloads(server):
+    budget = http_action.SpoolBudget(BUDGET)
+    outputs = []
+    try:
+        for i in range(OUTPUTS):
+            url = f"http://{server}/view?" + urllib.parse.urlencode({"filename": f"{i}.png"})
+            outputs.append(http_action.download_spooled(url, 0, budget))
+            assert _in_memory_bytes(outputs) <= BUDGET
+        assert all(len(output.read()) == OUTPUT_BYTES for output in outputs)
+        assert sum(1 for output in outputs if output._rolled) == OUTPUTS - 1
+    finally:
+        for output in outputs:
+            output.close()
+    assert budget.used <= BUDGET
+
+
+def test_comfyui_outputs_share_one_budget(server, monkeypatch):
+    monkeypatch.setattr(http_action, "SPOOL_MEMORY_BYTES", BUDGET)
+    caller = comfyui.comfyuiCaller(server)
+    history = {"p": {"outputs": {
+        "9": {"images": [{"filename": f"{i}.png", "subfolder": "", "type": "output"} for i in range(OUTPUTS // 2)]},
+        "10": {"videos": [{"filename": f"{i}.mp4", "subfolder": "", "type": "output"}
+                          for i in range(OUTPUTS // 2)]},
+    }}}
+    monkeypatch.setattr(caller, "get_history", lambda prompt_id: history)
+
+    outputs = comfyui.post_invocations(caller.get_outputs("p"))
+    try:
+        assert len(outputs) == OUTPUTS
+        assert all(comfyui.output_size(o) == OUTPUT_BYTES for o in outputs)
+        assert _in_memory_bytes(outputs) <= BUDGET
+    finally:
+        comfyui.close_outputs(outputs)
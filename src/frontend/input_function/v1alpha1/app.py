@@ -1,6 +1,8 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import base64
+import gzip
 import os
 import boto3
 import json
@@ -11,6 +13,11 @@ logger.setLevel(logging.INFO)
 
 sns_client = boto3.client('sns')
 
+# Optional compression of message bodies, "none" or "gzip+base64". Marked with the
+# content-encoding message attribute, which the queue agent decodes
+MESSAGE_ENCODING = os.environ.get('MESSAGE_ENCODING', 'none')
+MESSAGE_ENCODING_MIN_BYTES = int(os.environ.get('MESSAGE_ENCODING_MIN_BYTES', '1024'))
+
 
 def lambda_handler(event, context):
     if event['httpMethod'] == 'POST':
@@ -42,15 +49,23 @@ def lambda_handler(event, context):
                 "context": {}
                 },"content": payload}
 
+            message, encoding = encode_message(json.dumps(msg))
+            attributes = {
+                'sd_model_checkpoint': {
+                    'DataType': 'String',
+                    'StringValue': sd_model_checkpoint
+                }
+            }
+            if encoding:
+                attributes['content-encoding'] = {
+                    'DataType': 'String',
+                    'StringValue': encoding
+                }
+
             sns_client.publish(
                 TargetArn=os.environ['SNS_TOPIC_ARN'],
-                Message=json.dumps(msg),
-                MessageAttributes={
-                    'sd_model_checkpoint': {
-                        'DataType': 'String',
-                        'StringValue': sd_model_checkpoint
-                    }
-                }
+                Message=message,
+                MessageAttributes=attributes
             )
 
             return {
@@ -74,6 +89,15 @@ def lambda_handler(event, context):
             'body': "Unsupported HTTP method"
         }
 
+def encode_message(message: str) -> tuple:
+    """Compress a message body when MESSAGE_ENCODING is set and it makes the body smaller"""
+    if MESSAGE_ENCODING != "gzip+base64" or len(message.encode()) < MESSAGE_ENCODING_MIN_BYTES:
+        return message, None
+    encoded = base64.b64encode(gzip.compress(message.encode())).decode()
+    if len(encoded) >= len(message.encode()):
+        return message, None
+    return encoded, MESSAGE_ENCODING
+
 def validate(body: dict) -> str:
     # Check payload size (1MB limit)
     if len(json.dumps(body)) > 1024 * 1024:
@@ -1,9 +1,16 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import base64
+import gzip
 import json
 import os
 import logging
+import math
+import re
+import time
+import uuid
+from decimal import Decimal
 
 import boto3
 
@@ -11,11 +18,55 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 sns_client = boto3.client('sns')
+s3_client = boto3.client('s3')
+sqs_client = boto3.client('sqs')
+cloudwatch_client = boto3.client('cloudwatch')
+
+# Largest request body accepted for a single task
+MAX_PAYLOAD_BYTES = int(os.environ.get('MAX_PAYLOAD_BYTES', str(5 * 1024 * 1024)))
+
+# Task content larger than this is stored in S3 and the message carries a reference to it
+CLAIM_CHECK_THRESHOLD_BYTES = int(os.environ.get('CLAIM_CHECK_THRESHOLD_BYTES', str(200 * 1024)))
+CLAIM_CHECK_BUCKET = os.environ.get('CLAIM_CHECK_BUCKET', os.environ.get('S3_OUTPUT_BUCKET'))
+CLAIM_CHECK_PREFIX = os.environ.get('CLAIM_CHECK_PREFIX', 'claim-check')
+
+# Optional compression of message bodies, "none" or "gzip+base64". Marked with the
+# content-encoding message attribute, which the queue agent decodes
+MESSAGE_ENCODING = os.environ.get('MESSAGE_ENCODING', 'none')
+MESSAGE_ENCODING_MIN_BYTES = int(os.environ.get('MESSAGE_ENCODING_MIN_BYTES', '1024'))
+
+# Maximum number of tasks accepted in one batch request
+MAX_BATCH_TASKS = int(os.environ.get('MAX_BATCH_TASKS', '100'))
+
+# Limits of a single SNS PublishBatch call
+SNS_BATCH_MAX_ENTRIES = 10
+SNS_BATCH_MAX_BYTES = 256 * 1024
+
+# DynamoDB table where tasks are recorded as queued, the queue agents record later transitions
+STATUS_TABLE_NAME = os.environ.get('STATUS_TABLE_NAME', '')
+STATUS_TTL_DAYS = int(os.environ.get('STATUS_TTL_DAYS', '7'))
+status_table = boto3.resource('dynamodb').Table(STATUS_TABLE_NAME) if STATUS_TABLE_NAME else None
+
+# Admission control. Each runtime stack sets RUNTIME_QUEUE_<RUNTIME> to its queue URL and
+# optionally RUNTIME_MAX_WAIT_<RUNTIME>; tasks whose estimated wait exceeds the limit get a 429.
+# MAX_QUEUE_WAIT_SECONDS applies to runtimes without their own limit, 0 disables it
+MAX_QUEUE_WAIT_SECONDS = int(os.environ.get('MAX_QUEUE_WAIT_SECONDS', '0'))
+BACKLOG_CACHE_SECONDS = int(os.environ.get('BACKLOG_CACHE_SECONDS', '10'))
+THROUGHPUT_CACHE_SECONDS = int(os.environ.get('THROUGHPUT_CACHE_SECONDS', '60'))
+THROUGHPUT_WINDOW_SECONDS = int(os.environ.get('THROUGHPUT_WINDOW_SECONDS', '900'))
+MAX_RETRY_AFTER_SECONDS = 600
+
+# Queue depth and completion rate per runtime, kept across invocations of a warm container
+backlog_cache = {}
 
 def lambda_handler(event, context):
     if event['httpMethod'] == 'POST':
         try:
-            payload = json.loads(event['body'])["task"]
+            request = json.loads(event['body'])
+            if "tasks" in request:
+                return submit_batch(request["tasks"])
+
+            payload = request["task"]
             val = validate(payload)
             if val != "success":
                 return {
@@ -28,26 +79,37 @@ def lambda_handler(event, context):
             prefix = payload["metadata"]["prefix"]
             s3_output_path = f"{os.environ['S3_OUTPUT_BUCKET']}/{prefix}/{id}"
 
+            admitted, estimated_wait, retry_after = admit(runtime)
+            if not admitted:
+                return {
+                    'statusCode': 429,
+                    'headers': {'Retry-After': str(retry_after)},
+                    'body': f"Runtime {runtime} is overloaded, estimated wait {int(estimated_wait)} seconds"
+                }
+
             print(event['headers'])
             print(event['queryStringParameters'])
 
-            sns_client.publish(
-                TargetArn=os.environ['SNS_TOPIC_ARN'],
-                Message=json.dumps(payload),
-                MessageAttributes={
-                    'runtime': {
-                        'DataType': 'String',
-                        'StringValue': runtime
-                    }
-                }
-            )
+            message, encoding = build_message(payload)
+            item = queued_item(id, runtime, payload["metadata"]["tasktype"], f"s3://{s3_output_path}")
+            record_status([item])
+            try:
+                sns_client.publish(
+                    TargetArn=os.environ['SNS_TOPIC_ARN'],
+                    Message=message,
+                    MessageAttributes=message_attributes(runtime, encoding)
+                )
+            except Exception:
+                record_status([dict(item, status="failed")])
+                raise
 
             return {
                 'statusCode': 200,
                 'body': json.dumps({
                     "id": id,
                     "runtime": runtime,
-                    "output_location": f"s3://{s3_output_path}"
+                    "output_location": f"s3://{s3_output_path}",
+                    "estimated_wait_seconds": round_wait(estimated_wait)
                 })
             }
 
@@ -57,6 +119,8 @@ def lambda_handler(event, context):
                 'statusCode': 400,
                 'body': "Invalid request format"
             }
+    elif event['httpMethod'] == 'GET':
+        return get_status((event.get('pathParameters') or {}).get('id'))
     else:
         return {
             'statusCode': 400,
@@ -64,9 +128,328 @@ def lambda_handler(event, context):
         }
 
 
+def submit_batch(tasks: list) -> dict:
+    """Validate every task on its own and publish the valid ones with SNS PublishBatch"""
+    if not isinstance(tasks, list) or len(tasks) == 0:
+        return {
+            'statusCode': 400,
+            'body': 'Incorrect payload structure, tasks should be a non-empty list'
+        }
+    if len(tasks) > MAX_BATCH_TASKS:
+        return {
+            'statusCode': 400,
+            'body': f'Incorrect payload structure, at most {MAX_BATCH_TASKS} tasks per request'
+        }
+
+    results = []
+    pending = []
+    items = {}
+    seen_ids = set()
+    for index, task in enumerate(tasks):
+        result = {"index": index}
+        results.append(result)
+        try:
+            val = validate(task) if isinstance(task, dict) else "task is not an object"
+            if val == "success" and task["metadata"]["id"] in seen_ids:
+                val = "duplicate id in batch"
+            if val != "success":
+                result.update({"status": "rejected", "error": "Incorrect payload structure, " + val})
+                continue
+
+            id = task["metadata"]["id"]
+            runtime = task["metadata"]["runtime"]
+            prefix = task["metadata"]["prefix"]
+            admitted, estimated_wait, retry_after = admit(runtime)
+            if not admitted:
+                result.update({
+                    "status": "throttled",
+                    "error": f"Runtime {runtime} is overloaded, estimated wait {int(estimated_wait)} seconds",
+                    "retry_after_seconds": retry_after
+                })
+                continue
+            message, encoding = build_message(task)
+            attributes = message_attributes(runtime, encoding)
+            size = len(message.encode()) + len(json.dumps(attributes))
+            if size > SNS_BATCH_MAX_BYTES:
+                result.update({"status": "rejected", "error": "Incorrect payload structure, payload too large"})
+                continue
+        except Exception as e:
+            result.update({"status": "rejected", "error": f"Invalid task format, {type(e).__name__}"})
+            continue
+
+        seen_ids.add(id)
+        result.update({
+            "id": id,
+            "runtime": runtime,
+            "status": "queued",
+            "output_location": f"s3://{os.environ['S3_OUTPUT_BUCKET']}/{prefix}/{id}",
+            "estimated_wait_seconds": round_wait(estimated_wait)
+        })
+        items[index] = queued_item(id, runtime, task["metadata"]["tasktype"], result["output_location"])
+        pending.append((result, size, {
+            'Id': str(index),
+            'Message': message,
+            'MessageAttributes': attributes
+        }))
+
+    record_status(list(items.values()))
+    for chunk in chunk_entries(pending):
+        publish_batch(chunk)
+    record_status([dict(items[r["index"]], status="failed") for r in results if r["status"] == "failed"])
+
+    counts = {status: sum(1 for r in results if r["status"] == status)
+              for status in ("queued", "rejected", "throttled", "failed")}
+    headers = {}
+    if counts["queued"] == len(results):
+        status_code = 200
+    elif counts["queued"] > 0:
+        status_code = 207
+    elif counts["failed"] > 0:
+        status_code = 500
+    elif counts["throttled"] > 0:
+        status_code = 429
+        headers['Retry-After'] = str(max(r["retry_after_seconds"] for r in results if r["status"] == "throttled"))
+    else:
+        status_code = 400
+    logger.info(f"Batch of {len(results)} tasks: {counts}")
+
+    return {
+        'statusCode': status_code,
+        'headers': headers,
+        'body': json.dumps({**counts, "tasks": results})
+    }
+
+
+def chunk_entries(pending: list):
+    """Group entries into chunks that fit the PublishBatch count and size limits"""
+    chunk = []
+    chunk_bytes = 0
+    for item in pending:
+        size = item[1]
+        if chunk and (len(chunk) == SNS_BATCH_MAX_ENTRIES or chunk_bytes + size > SNS_BATCH_MAX_BYTES):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(item)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def publish_batch(chunk: list) -> None:
+    """Publish one chunk, marking the result of every entry SNS did not accept as failed"""
+    results = {entry['Id']: result for result, _, entry in chunk}
+    try:
+        response = sns_client.publish_batch(
+            TopicArn=os.environ['SNS_TOPIC_ARN'],
+            PublishBatchRequestEntries=[entry for _, _, entry in chunk]
+        )
+    except Exception as e:
+        logger.error(f"Error publishing batch: {type(e).__name__}")
+        for result in results.values():
+            result.update({"status": "failed", "error": "Failed to queue task"})
+            result.pop("output_location", None)
+        return
+
+    for failed in response.get('Failed', []):
+        logger.error(f"Error publishing task: {failed.get('Code')}")
+        results[failed['Id']].update({"status": "failed", "error": f"Failed to queue task, {failed.get('Code')}"})
+        results[failed['Id']].pop("output_location", None)
+
+
+def message_attributes(runtime: str, encoding: str = None) -> dict:
+    attributes = {
+        'runtime': {
+            'DataType': 'String',
+            'StringValue': runtime
+        }
+    }
+    if encoding:
+        attributes['content-encoding'] = {
+            'DataType': 'String',
+            'StringValue': encoding
+        }
+    return attributes
+
+
+def encode_message(message: str) -> tuple:
+    """Compress a message body when MESSAGE_ENCODING is set and it makes the body smaller"""
+    if MESSAGE_ENCODING != "gzip+base64" or len(message.encode()) < MESSAGE_ENCODING_MIN_BYTES:
+        return message, None
+    encoded = base64.b64encode(gzip.compress(message.encode())).decode()
+    if len(encoded) >= len(message.encode()):
+        return message, None
+    return encoded, MESSAGE_ENCODING
+
+
+def build_message(payload: dict) -> tuple:
+    """Serialise a task, moving large content to S3 so that the message fits SNS and SQS limits.
+
+    Returns the message body and its content encoding, None when it is plain JSON.
+    """
+    message, encoding = encode_message(json.dumps(payload))
+    if len(message.encode()) <= CLAIM_CHECK_THRESHOLD_BYTES:
+        return message, encoding
+
+    metadata = payload["metadata"]
+    key = f"{CLAIM_CHECK_PREFIX}/{metadata['runtime']}/{metadata['id']}-{uuid.uuid4().hex[:8]}.json"
+    s3_client.put_object(
+        Bucket=CLAIM_CHECK_BUCKET,
+        Key=key,
+        Body=json.dumps(payload["content"]).encode(),
+        ContentType='application/json'
+    )
+    logger.info(f"Stored content of task {metadata['id']} in S3")
+
+    pointer = {k: v for k, v in payload.items() if k != "content"}
+    pointer["content_ref"] = f"s3://{CLAIM_CHECK_BUCKET}/{key}"
+    return json.dumps(pointer), None
+
+
+def admit(runtime: str) -> tuple:
+    """Decide whether to accept a task for a runtime.
+
+    Returns whether the task is admitted, the estimated wait in seconds (None when unknown)
+    and, for rejected tasks, the number of seconds after which to retry.
+    """
+    try:
+        estimated_wait = estimate_wait(runtime)
+    except Exception as e:
+        # Fail open, admission control must not take the API down with it
+        logger.error(f"Error estimating wait for runtime {runtime}: {type(e).__name__}")
+        return True, None, None
+
+    limit = int(os.environ.get('RUNTIME_MAX_WAIT_' + env_key(runtime), MAX_QUEUE_WAIT_SECONDS))
+    if estimated_wait is not None and limit > 0 and estimated_wait > limit:
+        logger.info(f"Rejecting task for runtime {runtime}, estimated wait {estimated_wait:.0f}s over {limit}s")
+        return False, estimated_wait, min(math.ceil(estimated_wait - limit), MAX_RETRY_AFTER_SECONDS)
+
+    if runtime in backlog_cache:
+        backlog_cache[runtime]["admitted"] += 1
+    return True, estimated_wait, None
+
+
+def estimate_wait(runtime: str):
+    """Queue depth divided by the recent completion rate, None when either is unknown"""
+    queue_url = os.environ.get('RUNTIME_QUEUE_' + env_key(runtime))
+    if not queue_url:
+        return None
+
+    now = time.time()
+    state = backlog_cache.setdefault(runtime, {"depth": 0, "depth_at": 0, "rate": None, "rate_at": 0, "admitted": 0})
+    if now - state["depth_at"] > BACKLOG_CACHE_SECONDS:
+        attributes = sqs_client.get_queue_attributes(
+            QueueUrl=queue_url,
+            AttributeNames=['ApproximateNumberOfMessages']
+        )['Attributes']
+        # Tasks admitted since the last refresh are counted on top of the reported depth
+        state.update(depth=int(attributes['ApproximateNumberOfMessages']), depth_at=now, admitted=0)
+    if now - state["rate_at"] > THROUGHPUT_CACHE_SECONDS:
+        state.update(rate=completion_rate(queue_url, now), rate_at=now)
+
+    if not state["rate"]:
+        # Nothing completed recently, e.g. scaling up from zero
+        return None
+    return (state["depth"] + state["admitted"]) / state["rate"]
+
+
+def completion_rate(queue_url: str, now: float) -> float:
+    """Tasks per second deleted from the queue over the last THROUGHPUT_WINDOW_SECONDS"""
+    response = cloudwatch_client.get_metric_data(
+        MetricDataQueries=[{
+            'Id': 'deleted',
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': 'AWS/SQS',
+                    'MetricName': 'NumberOfMessagesDeleted',
+                    'Dimensions': [{'Name': 'QueueName', 'Value': queue_url.rstrip('/').split('/')[-1]}]
+                },
+                'Period': THROUGHPUT_WINDOW_SECONDS,
+                'Stat': 'Sum'
+            }
+        }],
+        StartTime=now - THROUGHPUT_WINDOW_SECONDS,
+        EndTime=now
+    )
+    deleted = sum(sum(result['Values']) for result in response['MetricDataResults'])
+    return deleted / THROUGHPUT_WINDOW_SECONDS
+
+
+def env_key(runtime: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_]', '_', runtime).upper()
+
+
+def round_wait(estimated_wait):
+    return round(estimated_wait, 1) if estimated_wait is not None else None
+
+
+def queued_item(id: str, runtime: str, tasktype: str, output_location: str) -> dict:
+    now = time.time()
+    return {
+        # The queue agents key statuses by the ID truncated to 64 characters
+        "id": str(id)[:64],
+        "status": "queued",
+        "runtime": runtime,
+        "tasktype": tasktype,
+        "output_location": output_location,
+        "queued_at": Decimal(str(round(now, 3))),
+        "updated_at": Decimal(str(round(now, 3))),
+        "expires_at": int(now) + STATUS_TTL_DAYS * 86400
+    }
+
+
+def record_status(items: list) -> None:
+    """Write task status items, failing to do so does not reject the tasks"""
+    if status_table is None or not items:
+        return
+    try:
+        with status_table.batch_writer(overwrite_by_pkeys=['id']) as writer:
+            for item in items:
+                writer.put_item(Item=item)
+    except Exception as e:
+        logger.error(f"Error recording task status: {type(e).__name__}")
+
+
+def get_status(id: str) -> dict:
+    if status_table is None:
+        return {
+            'statusCode': 404,
+            'body': "Task status is not enabled"
+        }
+    if not id:
+        return {
+            'statusCode': 400,
+            'body': "Task ID is missing"
+        }
+    try:
+        item = status_table.get_item(Key={"id": str(id)[:64]}).get("Item")
+    except Exception as e:
+        logger.error(f"Error reading task status: {type(e).__name__}")
+        return {
+            'statusCode': 500,
+            'body': "Failed to read task status"
+        }
+    if item is None:
+        return {
+            'statusCode': 404,
+            'body': "Task not found"
+        }
+    item.pop("expires_at", None)
+    return {
+        'statusCode': 200,
+        'body': json.dumps(item, default=decimal_to_number)
+    }
+
+
+def decimal_to_number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
 def validate(body: dict) -> str:
-    # Check payload size (1MB limit)
-    if len(json.dumps(body)) > 1024 * 1024:
+    # Check payload size, large content is moved to S3 by build_message
+    if len(json.dumps(body)) > MAX_PAYLOAD_BYTES:
         return "payload too large"
     
     result = "success"
@@ -87,15 +470,35 @@ def validate(body: dict) -> str:
             
         # Validate tasktype
         tasktype = body["metadata"].get("tasktype", "")
-        if tasktype not in ["text-to-image", "image-to-image", "extra-single-image"]:
+        if tasktype not in ["text-to-image", "image-to-image", "extra-single-image", "pipeline"]:
             result = "invalid tasktype"
             
         # Validate runtime format
         runtime = body["metadata"].get("runtime", "")
         if not isinstance(runtime, str) or not runtime.replace("-", "").replace("_", "").isalnum():
             result = "invalid runtime format"
+
+        # Optional limits within which the queue agent may degrade the task under load
+        degrade = body["metadata"].get("degrade")
+        if degrade is not None:
+            if not isinstance(degrade, dict):
+                result = "degrade should be an object"
+            elif "min_steps" in degrade and (not isinstance(degrade["min_steps"], int) or isinstance(degrade["min_steps"], bool)
+                                             or degrade["min_steps"] < 1):
+                result = "degrade.min_steps should be a positive integer"
+            elif "drop_hires" in degrade and not isinstance(degrade["drop_hires"], bool):
+                result = "degrade.drop_hires should be a boolean"
+            elif "sampler" in degrade and not isinstance(degrade["sampler"], str):
+                result = "degrade.sampler should be a string"
     
     if "content" not in body.keys():
         result = "content is missing"
+    elif isinstance(body["content"], dict) and "template_id" in body["content"]:
+        # Workflow template filled in by the queue agent
+        template_id = body["content"]["template_id"]
+        if not isinstance(template_id, str) or not template_id.replace("-", "").replace("_", "").isalnum():
+            result = "invalid template_id format"
+        if not isinstance(body["content"].get("parameters", {}), dict):
+            result = "template parameters should be an object"
     
     return result
\ No newline at end of file
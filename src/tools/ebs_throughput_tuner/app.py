@@ -1,17 +1,21 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
-import boto3, os
+import boto3, json, os
+from concurrent.futures import ThreadPoolExecutor
 
-def get_ebs_volume_id(instance_id):
-    ec2 = boto3.client('ec2')
-    try:
-        response = ec2.describe_instances(InstanceIds=[instance_id])
-        volume_id = response['Reservations'][0]['Instances'][0]['BlockDeviceMappings'][-1]['Ebs']['VolumeId']
-        return volume_id
-    except Exception as e:
-        print("Error:", e)
-        return None
+ec2 = boto3.client('ec2')
+
+TARGET_EC2_TAG_KEY = os.environ['TARGET_EC2_TAG_KEY']
+TARGET_EC2_TAG_VALUE = os.environ['TARGET_EC2_TAG_VALUE']
+THROUGHPUT_VALUE = int(os.environ['THROUGHPUT_VALUE'])
+IOPS_VALUE = int(os.environ['IOPS_VALUE'])
+# Data volume is the one attached at this device, or carrying this tag key when set
+DATA_DEVICE_NAME = os.environ.get('DATA_DEVICE_NAME', '/dev/xvdb')
+DATA_VOLUME_TAG_KEY = os.environ.get('DATA_VOLUME_TAG_KEY', '')
+MAX_CONCURRENCY = int(os.environ.get('MAX_CONCURRENCY', '10'))
+# Errors worth retrying through the queue, anything else will fail again
+RETRYABLE_ERRORS = ['RequestLimitExceeded', 'Throttling', 'InternalError', 'ServiceUnavailable']
 
 def get_instance_tag(instance, key):
     for tag in instance.get('Tags', []):
@@ -19,32 +23,91 @@ def get_instance_tag(instance, key):
             return tag['Value']
     return None
 
-def modify_ebs_throughput_and_iops(volume_id, throughput, iops):
-    ec2 = boto3.client('ec2')
+def get_instance_ids(event):
+    """Instance IDs with their SQS message IDs, from a batch of queued state-change events or a single event"""
+    if 'Records' in event:
+        return [(json.loads(record['body'])['detail']['instance-id'], record['messageId']) for record in event['Records']]
+    return [(event['detail']['instance-id'], None)]
+
+def describe_instances(instance_ids):
+    """Matching instances by ID. Filtering instead of passing IDs skips instances that are already gone"""
+    instances = {}
+    paginator = ec2.get_paginator('describe_instances')
+    for i in range(0, len(instance_ids), 200):
+        filters = [{'Name': 'instance-id', 'Values': instance_ids[i:i + 200]}]
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    tag_value = get_instance_tag(instance, TARGET_EC2_TAG_KEY)
+                    if tag_value and TARGET_EC2_TAG_VALUE in tag_value:
+                        instances[instance['InstanceId']] = instance
+                    else:
+                        print(f"Skipped {instance['InstanceId']}, tag {TARGET_EC2_TAG_KEY} does not match")
+    return instances
+
+def describe_volumes(volume_ids):
+    volumes = {}
+    paginator = ec2.get_paginator('describe_volumes')
+    for i in range(0, len(volume_ids), 200):
+        for page in paginator.paginate(Filters=[{'Name': 'volume-id', 'Values': volume_ids[i:i + 200]}]):
+            for volume in page['Volumes']:
+                volumes[volume['VolumeId']] = volume
+    return volumes
+
+def get_data_volume(instance, volumes):
+    """Data volume of an instance, None when it only has the root volume"""
+    candidates = [m for m in instance.get('BlockDeviceMappings', [])
+                  if 'Ebs' in m and m['DeviceName'] != instance.get('RootDeviceName')]
+    if DATA_VOLUME_TAG_KEY:
+        for mapping in candidates:
+            volume = volumes.get(mapping['Ebs']['VolumeId'], {})
+            if get_instance_tag(volume, DATA_VOLUME_TAG_KEY) is not None:
+                return volume
+    for mapping in candidates:
+        if mapping['DeviceName'] == DATA_DEVICE_NAME:
+            return volumes.get(mapping['Ebs']['VolumeId'])
+    return None
+
+def modify_ebs_throughput_and_iops(volume):
+    """Returns False when the modification failed and should be retried"""
+    volume_id = volume['VolumeId']
+    if volume.get('VolumeType') != 'gp3':
+        print(f"Skipped {volume_id}, volume type {volume.get('VolumeType')} has no configurable throughput")
+        return True
+    if volume.get('Throughput') == THROUGHPUT_VALUE and volume.get('Iops') == IOPS_VALUE:
+        print(f"Skipped {volume_id}, already at {THROUGHPUT_VALUE} MiB/s and {IOPS_VALUE} IOPS")
+        return True
     try:
-        response = ec2.modify_volume(VolumeId=volume_id, Throughput=throughput, Iops=iops)
-        print("Successfully modified EBS throughput of " + volume_id)
+        ec2.modify_volume(VolumeId=volume_id, Throughput=THROUGHPUT_VALUE, Iops=IOPS_VALUE)
+        print(f"Successfully modified EBS throughput of {volume_id} "
+              f"from {volume.get('Throughput')} to {THROUGHPUT_VALUE} MiB/s, {volume.get('Iops')} to {IOPS_VALUE} IOPS")
+        return True
     except Exception as e:
-        print("Error:", e)
+        code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+        print(f"Error modifying {volume_id}:", e)
+        return code not in RETRYABLE_ERRORS
 
 # Entrypoint
 def lambda_handler(event, context):
-    ec2 = boto3.client('ec2')
-    instance_id = event['detail']['instance-id']
-    print (f"Process with instance " + instance_id)
-    target_ec2_tag_key = os.environ['TARGET_EC2_TAG_KEY']
-    target_ec2_tag_value = os.environ['TARGET_EC2_TAG_VALUE']
-    # Get the instance tag
-    response = ec2.describe_instances(InstanceIds=[instance_id])
-    instance = response['Reservations'][0]['Instances'][0]
-    instance_tag_value = get_instance_tag(instance, target_ec2_tag_key)
-    volume_id = get_ebs_volume_id(instance_id)
-    if instance_tag_value:
-        # Determine if EBS throughput needs to be modified based on instance name
-        if target_ec2_tag_value in instance_tag_value:
-            print (f"Got matching tag from " + instance_id + " ,processing...")
-            throughput_value = int(os.environ['THROUGHPUT_VALUE'])  # Modify throughput
-            IOPS_value = int(os.environ['IOPS_VALUE']) # Modify IOPS
-            modify_ebs_throughput_and_iops(volume_id, throughput_value, IOPS_value)
+    records = get_instance_ids(event)
+    instance_ids = sorted({instance_id for instance_id, _ in records})
+    print(f"Process with instances {', '.join(instance_ids)}")
+
+    instances = describe_instances(instance_ids)
+    volume_ids = [m['Ebs']['VolumeId'] for instance in instances.values()
+                  for m in instance.get('BlockDeviceMappings', []) if 'Ebs' in m]
+    volumes = describe_volumes(volume_ids) if volume_ids else {}
+
+    targets = {}
+    for instance_id, instance in instances.items():
+        volume = get_data_volume(instance, volumes)
+        if volume is None:
+            print(f"Skipped {instance_id}, no data volume found")
         else:
-            print (f"Skipped " + instance_id)
+            targets[instance_id] = volume
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as pool:
+        results = dict(zip(targets, pool.map(modify_ebs_throughput_and_iops, targets.values())))
+
+    failed = [message_id for instance_id, message_id in records if message_id and not results.get(instance_id, True)]
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed]}